@@ -1,10 +1,25 @@
 #!/usr/bin/python
 
+import copy
+import json
+import multiprocessing
 import os
+import shutil
+import tempfile
 
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from converter import capabilities
 from converter.avcodecs import video_codec_list, audio_codec_list, subtitle_codec_list
 from converter.formats import format_list
-from converter.ffmpeg import FFMpeg, parse_time, timecode_to_seconds, FFMpegError
+from converter.ffmpeg import (FFMpeg, FFMpegJob, MediaInfo, MediaFormatInfo, MediaStreamInfo, OutputCapture,
+                              parse_time, timecode_to_seconds, FFMpegError, FFMpegConvertError)
+from converter.probecache import ProbeCache
+from converter.containers import ContainerError, is_faststart, make_faststart
+from converter.chunks import run_jobs, split_ranges
 
 
 class ConverterError(Exception):
@@ -18,13 +33,23 @@ class Converter(object):
     >>> c = Converter()
     """
 
-    def __init__(self, ffmpeg_path=None, ffprobe_path=None):
+    def __init__(self, ffmpeg_path=None, ffprobe_path=None, probe_cache=None, probe_profile='full',
+                 check_capabilities=False):
         """
-        Initialize a new Converter object.
+        Initialize a new Converter object. probe_cache is an optional
+        ProbeCache shared by all the methods probing their source, and
+        probe_profile the ffprobe profile they use (see FFMpeg.probe()).
+        If check_capabilities is True, parse_options() rejects the formats
+        and codecs the ffmpeg binary doesn't support (see
+        FFMpeg.capabilities). If they can't be discovered, nothing is
+        rejected.
         """
+        self.check_capabilities = check_capabilities
 
         self.ffmpeg = FFMpeg(ffmpeg_path=ffmpeg_path,
-                             ffprobe_path=ffprobe_path)
+                             ffprobe_path=ffprobe_path,
+                             probe_cache=probe_cache,
+                             probe_profile=probe_profile)
         self.video_codecs = {}
         self.audio_codecs = {}
         self.subtitle_codecs = {}
@@ -46,9 +71,30 @@ class Converter(object):
             name = cls.format_name
             self.formats[name] = cls
 
-    def parse_options(self, opt, twopass=None):
+    def parse_options(self, opt, twopass=None, passlogfile=None):
         """
         Parse format/codec options and prepare raw ffmpeg option list.
+
+        For the first pass of a two-pass encoding (twopass=1) only the
+        video is encoded, and muxed to the null format. passlogfile is the
+        prefix of the pass statistics files, which ffmpeg writes to the
+        working directory by default.
+
+        The option list of a Preset is built once for each source size
+        and reused.
+        """
+        if isinstance(opt, Preset):
+            return opt.optlist(twopass, passlogfile)
+
+        optlist = self._stream_options(opt, twopass)
+        optlist.extend(self._time_options(opt))
+        optlist.extend(self._pass_options(twopass, passlogfile))
+        return optlist
+
+    def _stream_options(self, opt, twopass=None):
+        """
+        Return the format and codec options of parse_options(), without
+        the time range and pass options.
         """
         if not isinstance(opt, dict):
             raise ConverterError('Invalid output specification')
@@ -63,6 +109,9 @@ class Converter(object):
         format_options = self.formats[f]().parse_options(opt)
         if format_options is None:
             raise ConverterError('Unknown container format error')
+        self._check_capability('muxers', 'format', self.formats[f].ffmpeg_format_name)
+        if twopass == 1:
+            format_options = ['-f', 'null']
 
         if 'audio' not in opt and 'video' not in opt:
             raise ConverterError('Neither audio nor video streams requested')
@@ -82,6 +131,7 @@ class Converter(object):
         audio_options = self.audio_codecs[c]().parse_options(opt_audio)
         if audio_options is None:
             raise ConverterError('Unknown audio codec error')
+        self._check_capability('encoders', 'audio codec', self.audio_codecs[c].ffmpeg_codec_name)
 
         # video options
         if 'video' not in opt:
@@ -98,8 +148,9 @@ class Converter(object):
         video_options = self.video_codecs[c]().parse_options(opt_video)
         if video_options is None:
             raise ConverterError('Unknown video codec error')
+        self._check_capability('encoders', 'video codec', self.video_codecs[c].ffmpeg_codec_name)
 
-        if 'subtitle' not in opt:
+        if 'subtitle' not in opt or twopass == 1:
             opt_subtitle = {'codec': None}
         else:
             opt_subtitle = opt['subtitle']
@@ -113,6 +164,7 @@ class Converter(object):
         subtitle_options = self.subtitle_codecs[c]().parse_options(opt_subtitle)
         if subtitle_options is None:
             raise ConverterError('Unknown subtitle codec error')
+        self._check_capability('encoders', 'subtitle codec', self.subtitle_codecs[c].ffmpeg_codec_name)
 
         if 'map' in opt:
             m = opt['map']
@@ -121,32 +173,65 @@ class Converter(object):
             else:
                 format_options.extend(['-map', str(m)])
 
+        # aggregate all options
+        return audio_options + video_options + subtitle_options + format_options
+
+    @staticmethod
+    def _time_options(opt):
+        """
+        Return the ffmpeg options selecting the converted time range.
+        """
+        optlist = []
         if 'start' in opt:
-            start = parse_time(opt['start'])
-            format_options.extend(['-ss', start])
+            optlist.extend(['-ss', parse_time(opt['start'])])
 
         if 'duration' in opt:
-            duration = parse_time(opt['duration'])
-            format_options.extend(['-t', duration])
+            optlist.extend(['-t', parse_time(opt['duration'])])
         elif 'end' in opt:
-            end = parse_time(opt['end'])
-            format_options.extend(['-to', end])
-
-        # aggregate all options
-        optlist = audio_options + video_options + subtitle_options + format_options
+            optlist.extend(['-to', parse_time(opt['end'])])
+        return optlist
 
+    @staticmethod
+    def _pass_options(twopass, passlogfile):
+        optlist = []
         if twopass == 1:
             optlist.extend(['-pass', '1'])
         elif twopass == 2:
             optlist.extend(['-pass', '2'])
-
+        if twopass and passlogfile:
+            optlist.extend(['-passlogfile', passlogfile])
         return optlist
 
-    def convert(self, infile, outfile, options, twopass=False, timeout=10, nice=None, title=None):
+    def preset(self, options):
+        """
+        Validate the conversion options and compile them into a Preset,
+        to convert many files with.
+        """
+        return Preset(self, options)
+
+    def _check_capability(self, kind, what, name):
+        """
+        Raise ConverterError if the ffmpeg binary lacks the muxer or
+        encoder name.
+        """
+        if not self.check_capabilities or name is None:
+            return
+        caps = capabilities.discover(self.ffmpeg.ffmpeg_path)
+        if caps is None or not getattr(caps, kind):
+            # Unknown capabilities, let ffmpeg decide.
+            return
+        if name not in getattr(caps, kind):
+            raise ConverterError('Requested %s %s is not supported by %s' % (what, name, self.ffmpeg.ffmpeg_path))
+
+    def convert(self, infile, outfile, options, twopass=False, timeout=10, nice=None, title=None,
+                progress=False, stats_period=None, stall_timeout=None, deadline=None, info=None,
+                chunks=None, chunk_retries=1, smart_copy=False, chunk_workers=None):
         """
         Convert media file (infile) according to specified options, and
-        save it to outfile. For two-pass encoding, specify the pass (1 or 2)
-        in the twopass parameter.
+        save it to outfile. For two-pass encoding, set twopass to True. The
+        first pass only analyses the video, without writing any output,
+        and its statistics are kept in a temporary directory of the job,
+        removed when it ends, so several two-pass jobs can run at once.
 
         Options should be passed as a dictionary. The keys are:
             * format (mandatory, string) - container format; see
@@ -160,20 +245,67 @@ class Converter(object):
         Multiple audio/video streams are not supported. The output has to
         have at least an audio or a video stream (or both).
 
-        Convert returns a generator that needs to be iterated to drive the
-        conversion process. The generator will periodically yield timecode
-        of currently processed part of the file (ie. at which second in the
-        content is the conversion process currently).
+        Convert returns a job (see converter.ffmpeg.FFMpegJob) that needs to
+        be iterated to drive the conversion process. It will periodically
+        yield the percentage of the conversion done so far. The job can also
+        be stopped from another thread, and gives the exit status and
+        resource usage of ffmpeg once done.
 
         The optional timeout argument specifies how long should the operation
         be blocked in case ffmpeg gets stuck and doesn't report back. This
         doesn't limit the total conversion time, just the amount of time
         Converter will wait for each update from ffmpeg. As it's usually
         less than a second, the default of 10 is a reasonable default. To
-        disable the timeout, set it to None. You may need to do this if
-        using Converter in a threading environment, since the way the
-        timeout is handled (using signals) has special restriction when
-        using threads.
+        disable the timeout, set it to None.
+
+        The optional stall_timeout argument stops the conversion if the
+        reported timecode doesn't advance for that many seconds (ffmpeg is
+        alive but stuck), and deadline limits the total wall-clock time of
+        each ffmpeg run. When any limit is hit, ffmpeg is asked to quit,
+        then terminated and finally killed, and FFMpegTimeoutError is
+        raised. The limits don't use signals, so they are safe to use from
+        any thread.
+
+        The optional progress argument makes ffmpeg report its progress on
+        a dedicated pipe in machine-readable form, which is much cheaper to
+        follow than its stderr stats line; stats_period sets the interval
+        between updates. See FFMpeg.convert() for details.
+
+        If the source was already probed, its info (a MediaInfo, or the
+        dict parsed from ffprobe's JSON output) can be passed as info to
+        skip probing it again.
+
+        infile can also be a streamed source, e.g. a file-like object or a
+        socket (see FFMpeg.convert()). A stream can't be probed, so its
+        info must then be given, and it can only be read once, so two-pass
+        encoding and chunks are not supported.
+
+        outfile can be an output sink too, e.g. a writable file object or a
+        callable receiving the blocks of output (see FFMpeg.convert()), to
+        stream the output instead of writing it to disk. The format must
+        then be one written sequentially, e.g. mkv, mpg (MPEG-TS) or mp4
+        with the fragmented option. Chunks are not supported with a sink.
+
+        To use more cores than a single encoder scales to, the video can be
+        encoded in chunks by ffmpeg processes running in parallel: chunks
+        sets their number, and chunk_workers how many of them run at once
+        (the number of CPUs by default). The source is split into time
+        ranges starting at keyframes, so each chunk is seeked to cheaply.
+        The chunks are encoded to Matroska files next to outfile, while
+        another process encodes the audio and subtitles of the whole range,
+        and all are then joined into outfile without encoding them again.
+        A chunk that fails is encoded again, up to chunk_retries times.
+        Two-pass encoding and the map option are not supported with chunks;
+        a source without video, or a video stream that is copied, is
+        converted in one go.
+
+        With smart_copy, the audio and video streams of the source that
+        already match the requested codec and its options (see the
+        can_copy() method of the codecs) are copied instead of encoded
+        again, and the names of the copied streams ('audio', 'video') are
+        listed in the job's copied attribute. The video isn't copied when
+        only a part of the source is converted, as the copy could only
+        start at a keyframe.
 
         >>> conv = Converter().convert('test1.ogg', '/tmp/output.mkv', {
         ...    'format': 'mkv',
@@ -184,27 +316,194 @@ class Converter(object):
         >>> for timecode in conv:
         ...   pass # can be used to inform the user about the progress
         """
+        return FFMpegJob(self.ffmpeg, self._convert, infile, outfile, options, twopass, timeout, nice, title,
+                         progress, stats_period, stall_timeout, deadline, info, chunks, chunk_retries, smart_copy,
+                         chunk_workers)
 
+    def _convert(self, job, infile, outfile, options, twopass, timeout, nice, title,
+                 progress, stats_period, stall_timeout, deadline, info, chunks=None, chunk_retries=1,
+                 smart_copy=False, chunk_workers=None):
         if not isinstance(options, dict):
             raise ConverterError('Invalid options')
 
-        if not os.path.exists(infile) and not self.ffmpeg.is_url(infile):
+        if chunks and chunks > 1:
+            if twopass:
+                raise ConverterError('Two-pass encoding is not supported with chunks')
+            if 'map' in options:
+                raise ConverterError('The map option is not supported with chunks')
+            if chunk_workers is not None and chunk_workers < 1:
+                raise ConverterError('chunk_workers must be at least 1')
+
+        if self.ffmpeg.is_stream(infile):
+            if info is None:
+                raise ConverterError('The info of a streamed source must be given')
+            if twopass:
+                raise ConverterError('Two-pass encoding is not supported with a streamed source')
+            if chunks and chunks > 1:
+                raise ConverterError('Chunks are not supported with a streamed source')
+        elif not os.path.exists(infile) and not self.ffmpeg.is_url(infile):
             raise ConverterError("Source file doesn't exist: " + infile)
 
-        info = self.ffmpeg.probe(infile, title=title)
+        if chunks and chunks > 1 and self.ffmpeg.is_sink(outfile):
+            raise ConverterError('Chunks are not supported with an output sink')
+
+        info = self.ffmpeg._source_info(infile, info, title=title)
         if info is None:
             raise ConverterError("Can't get information about source file")
 
+        options, duration = self._source_options(info, options)
+        if smart_copy:
+            options, job.copied = self._smart_copy(info, options)
+            if 'video' in job.copied:
+                twopass = False
+
+        if (chunks and chunks > 1 and info.video is not None and
+                options.get('video', {}).get('codec') not in (None, 'copy')):
+            for percent in self._convert_chunks(job, infile, outfile, options, info, duration, chunks, chunk_retries,
+                                                timeout, nice, progress, stats_period, stall_timeout,
+                                                deadline, chunk_workers):
+                yield percent
+            return
+
+        workspace, passlogfile = self._pass_workspace(twopass)
+        try:
+            for optlist, target, base, share in self._passes(options, twopass, outfile, passlogfile):
+                for timecode in self.ffmpeg.convert(infile, target, optlist,
+                                                    timeout=timeout, nice=nice,
+                                                    progress=progress, stats_period=stats_period,
+                                                    stall_timeout=stall_timeout, deadline=deadline,
+                                                    job=job):
+                    yield int(base + (share * timecode) / duration)
+        finally:
+            if workspace:
+                shutil.rmtree(workspace, ignore_errors=True)
+
+    def _convert_chunks(self, job, infile, outfile, options, info, duration, chunks, retries, timeout, nice,
+                        progress, stats_period, stall_timeout, deadline, workers=None):
+        """
+        Encode the video of infile in chunks, on at most workers threads
+        (the number of CPUs by default), and the rest of the streams in
+        one go, then join them into outfile.
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        tasks = [(self.parse_options(opts), chunk_duration)
+                 for opts, chunk_duration in self._chunk_options(infile, options, info, duration, chunks)]
+
+        tmpdir = tempfile.mkdtemp(prefix='.chunks-', dir=os.path.dirname(os.path.abspath(outfile)))
+        try:
+            outfiles = [os.path.join(tmpdir, '%04d.mkv' % i) for i in range(len(tasks))]
+
+            def factory(i):
+                return lambda: self.ffmpeg.convert(infile, outfiles[i], list(tasks[i][0]), timeout=timeout,
+                                                   nice=nice, progress=progress, stats_period=stats_period,
+                                                   stall_timeout=stall_timeout, deadline=deadline)
+
+            done = [0.0] * len(tasks)
+            last = 0
+            for event, i, item in run_jobs([factory(i) for i in range(len(tasks))], workers,
+                                           retries, parent=job):
+                chunk_duration = tasks[i][1]
+                if chunk_duration is None:
+                    continue
+                if event == 'retry':
+                    done[i] = 0.0
+                elif event == 'progress':
+                    done[i] = min(item, chunk_duration)
+                percent = int((99.0 * sum(done)) / duration)
+                if percent > last:
+                    last = percent
+                    yield percent
+
+            for _ in self._join_chunks(job, outfiles, outfile, options, info, timeout, nice, stall_timeout,
+                                       deadline):
+                pass
+            yield 100
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _chunk_options(self, infile, options, info, duration, chunks):
+        """
+        Split the conversion of infile into chunks. Returns the options
+        encoding the video of each chunk, with the chunk duration, then
+        the options encoding the rest of the streams in one go, with a
+        None duration, if the output has audio (see _chunk_audio()). The
+        parts are Matroska files, to be joined by _join_chunks().
+        """
+        start = timecode_to_seconds(options['start']) if 'start' in options else 0
+        ranges = split_ranges(self.ffmpeg.keyframes(infile), start, start + duration, chunks)
+
+        video_options = dict((k, v) for k, v in options.items()
+                             if k not in ('audio', 'subtitle', 'start', 'duration', 'end'))
+        video_options['format'] = 'mkv'
+        parts = [(dict(video_options, start=chunk_start, duration=chunk_duration), chunk_duration)
+                 for chunk_start, chunk_duration in ranges]
+        if self._chunk_audio(options, info):
+            rest_options = dict((k, v) for k, v in options.items() if k != 'video')
+            rest_options['format'] = 'mkv'
+            parts.append((rest_options, None))
+        return parts
+
+    def _join_chunks(self, job, parts, outfile, options, info, timeout, nice, stall_timeout, deadline):
+        """
+        Join the parts encoded with the options of _chunk_options() into
+        outfile.
+        """
+        parts = list(parts)
+        output_options = self.formats[options['format']]().parse_options(options)
+        inputs = []
+        if self._chunk_audio(options, info):
+            inputs.append(parts.pop())
+            output_options = ['-map', '0', '-map', '1'] + output_options
+        return self.ffmpeg.concat(parts, outfile, output_options, inputs, timeout=timeout, nice=nice,
+                                  stall_timeout=stall_timeout, deadline=deadline, job=job)
+
+    @staticmethod
+    def _chunk_audio(options, info):
+        """
+        Whether a chunked conversion has an audio part: the output has
+        audio and the source has an audio stream.
+        """
+        return 'audio' in options and info.audio is not None
+
+    def _smart_copy(self, info, options):
+        """
+        Switch the audio and video codecs to copy where the source stream
+        already matches the options. Returns the options and the list of
+        the copied streams.
+        """
+        options = options.copy()
+        copied = []
+        trimmed = 'start' in options or 'duration' in options or 'end' in options
+        for kind, stream, codecs in (('video', info.video, self.video_codecs),
+                                     ('audio', info.audio, self.audio_codecs)):
+            opt = options.get(kind)
+            if stream is None or not isinstance(opt, dict) or opt.get('codec') not in codecs:
+                continue
+            if kind == 'video' and trimmed:
+                continue
+            if codecs[opt['codec']]().can_copy(opt, stream):
+                options[kind] = {'codec': 'copy'}
+                copied.append(kind)
+        return options, copied
+
+    def _source_options(self, info, options):
+        """
+        Complete the conversion options with the source properties found
+        by probe() and work out the duration of the converted content.
+        """
         if 'video' not in info and 'audio' not in info:
             raise ConverterError('Source file has no audio or video streams')
 
         if 'video' in info and 'video' in options:
-            options = options.copy()
-            v = options['video'] = options['video'].copy()
-            v['src_width'] = info['video']['width']
-            v['src_height'] = info['video']['height']
+            source = {'src_width': info['video']['width'], 'src_height': info['video']['height']}
             if 'tags' in info['video'] and 'rotate' in info['video']['tags']:
-                v['src_rotate'] = info['video']['tags']['rotate']
+                source['src_rotate'] = info['video']['tags']['rotate']
+            if isinstance(options, Preset):
+                options = options.bind(**source)
+            else:
+                options = options.copy()
+                options['video'] = dict(options['video'], **source)
 
         if info['format']['duration'] < 0.01:
             raise ConverterError('Zero-length media')
@@ -221,23 +520,221 @@ class Converter(object):
         else:
             duration = info['format']['duration']
 
+        return options, duration
+
+    def _passes(self, options, twopass, outfile, passlogfile=None):
+        """
+        Return the ffmpeg option lists to run, each with the file it
+        writes, the progress percentage it starts at and the share of the
+        total it covers. The first of two passes only writes its
+        statistics, to passlogfile.
+        """
         if twopass:
-            optlist1 = self.parse_options(options, 1)
-            for timecode in self.ffmpeg.convert(infile, outfile, optlist1,
-                                                timeout=timeout, nice=nice):
-                yield int((50.0 * timecode) / duration)
-
-            optlist2 = self.parse_options(options, 2)
-            for timecode in self.ffmpeg.convert(infile, outfile, optlist2,
-                                                timeout=timeout, nice=nice):
-                yield int(50.0 + (50.0 * timecode) / duration)
+            return [(self.parse_options(options, 1, passlogfile), os.devnull, 0.0, 50.0),
+                    (self.parse_options(options, 2, passlogfile), outfile, 50.0, 50.0)]
+        return [(self.parse_options(options, twopass), outfile, 0.0, 100.0)]
+
+    @staticmethod
+    def _pass_workspace(twopass):
+        """
+        Create the private directory holding the statistics of a two-pass
+        encoding, so concurrent jobs don't overwrite each other's. Returns
+        the directory and the passlogfile prefix, or (None, None).
+        """
+        if not twopass:
+            return None, None
+        workspace = tempfile.mkdtemp(prefix='ffmpeg2pass-')
+        return workspace, os.path.join(workspace, 'ffmpeg2pass')
+
+    def write_frames(self, outfile, options, width, height, pix_fmt='rgb24', fps=25, timeout=None, nice=None):
+        """
+        Encode raw frames generated in Python to outfile, according to the
+        conversion options (see convert()), which need video options. The
+        frames are width x height, in pix_fmt (see
+        FFMpeg.RAW_PIX_FMTS), at fps frames per second.
+
+        Returns a FrameWriter (see converter.ffmpeg) to write the frames,
+        NumPy arrays or byte buffers, with.
+
+        >>> with Converter().write_frames('/tmp/output.mp4', {
+        ...    'format': 'mp4',
+        ...    'video': {'codec': 'h264', 'max_width': 640}
+        ... }, 1280, 720) as writer:
+        ...    for frame in frames:
+        ...        writer.write(frame)
+        """
+        if not isinstance(options, dict):
+            raise ConverterError('Invalid options')
+        if 'video' not in options:
+            raise ConverterError('Video options are needed to write frames')
+
+        source = {'src_width': width, 'src_height': height}
+        if isinstance(options, Preset):
+            options = options.bind(**source)
         else:
-            optlist = self.parse_options(options, twopass)
-            for timecode in self.ffmpeg.convert(infile, outfile, optlist,
-                                                timeout=timeout, nice=nice):
-                yield int((100.0 * timecode) / duration)
+            options = dict(options, video=dict(options['video'], **source))
 
-    def analyze(self, infile, audio_level=True, interlacing=True, crop=False, start=None, duration=None, end=None, timeout=10, nice=None, title=None):
+        return self.ffmpeg.write_frames(outfile, self.parse_options(options), width, height, pix_fmt, fps,
+                                        timeout=timeout, nice=nice)
+
+    def write_audio(self, outfile, options, samplerate, channels, dtype='int16', timeout=None, nice=None):
+        """
+        Encode audio samples generated in Python to outfile, according to
+        the conversion options (see convert()), which need audio options.
+        The samples are of dtype (see FFMpeg.RAW_SAMPLE_FMTS), interleaved
+        for the channels, at samplerate.
+
+        Returns a FrameWriter (see converter.ffmpeg) to write blocks of
+        samples, NumPy arrays or byte buffers, with.
+
+        >>> with Converter().write_audio('/tmp/output.ogg', {
+        ...    'format': 'ogg',
+        ...    'audio': {'codec': 'vorbis', 'samplerate': 44100}
+        ... }, 16000, 1, 'float32') as writer:
+        ...    for block in blocks:
+        ...        writer.write(block)
+        """
+        if not isinstance(options, dict):
+            raise ConverterError('Invalid options')
+        if 'audio' not in options:
+            raise ConverterError('Audio options are needed to write audio')
+
+        return self.ffmpeg.write_audio(outfile, self.parse_options(options), samplerate, channels, dtype,
+                                       timeout=timeout, nice=nice)
+
+    def convert_multi(self, infile, outputs, timeout=10, nice=None, title=None, progress=False,
+                      stats_period=None, stall_timeout=None, deadline=None, info=None):
+        """
+        Convert media file (infile) to several outputs at once, e.g. the
+        renditions of an adaptive bitrate ladder. outputs is a list of
+        (outfile, options) pairs, the options being those of convert().
+
+        A single ffmpeg process reads and decodes the source once. The
+        decoded video is split between the outputs, each one scaling and
+        encoding it with its own options; the filters all the outputs start
+        with (e.g. deinterlacing) are applied before the split, so they run
+        once too. Two-pass encoding and the map option are not supported.
+
+        Returns a job (see converter.ffmpeg.FFMpegJob) yielding the progress
+        as a dict of the percentage done of each outfile. If ffmpeg fails,
+        the FFMpegConvertError raised has an output_errors dict holding
+        the error lines ffmpeg printed about each outfile.
+
+        >>> conv = Converter().convert_multi('test1.ogg', [
+        ...    ('/tmp/360p.mp4', {'format': 'mp4', 'audio': {'codec': 'aac'},
+        ...                       'video': {'codec': 'h264', 'max_width': 640, 'max_height': 360}}),
+        ...    ('/tmp/720p.mp4', {'format': 'mp4', 'audio': {'codec': 'aac'},
+        ...                       'video': {'codec': 'h264', 'max_width': 1280, 'max_height': 720}}),
+        ... ])
+        >>> for percents in conv:
+        ...   pass
+        """
+        return FFMpegJob(self.ffmpeg, self._convert_multi, infile, outputs, timeout, nice, title, progress,
+                         stats_period, stall_timeout, deadline, info)
+
+    def _convert_multi(self, job, infile, outputs, timeout, nice, title, progress, stats_period,
+                       stall_timeout, deadline, info):
+        if not outputs:
+            raise ConverterError('No outputs specified')
+        for _, options in outputs:
+            if not isinstance(options, dict):
+                raise ConverterError('Invalid options')
+            if 'map' in options:
+                raise ConverterError('The map option is not supported with several outputs')
+
+        if not os.path.exists(infile) and not self.ffmpeg.is_url(infile):
+            raise ConverterError("Source file doesn't exist: " + infile)
+
+        info = self.ffmpeg._source_info(infile, info, title=title)
+        if info is None:
+            raise ConverterError("Can't get information about source file")
+
+        outfiles = []
+        optlists = []
+        durations = []
+        for outfile, options in outputs:
+            options, duration = self._source_options(info, options)
+            outfiles.append(outfile)
+            optlists.append(self.parse_options(options))
+            durations.append(duration)
+
+        filter_complex, optlists = self._multi_output_graph(info, optlists)
+        try:
+            for timecode in self.ffmpeg.convert_multi(infile, list(zip(outfiles, optlists)), filter_complex,
+                                                      timeout=timeout, nice=nice, progress=progress,
+                                                      stats_period=stats_period, stall_timeout=stall_timeout,
+                                                      deadline=deadline, job=job):
+                yield dict((outfile, min(100, int((100.0 * timecode) / duration)))
+                           for outfile, duration in zip(outfiles, durations))
+        except FFMpegConvertError as e:
+            e.output_errors = self._output_errors(e.output, outfiles)
+            raise
+
+    @staticmethod
+    def _multi_output_graph(info, optlists):
+        """
+        Return the filter graph splitting the decoded video between the
+        outputs, and the option lists of the outputs with their -vf filters
+        replaced by the mapping of their streams.
+        """
+        video = info.video
+        chains = {}
+        mapped = []
+        for i, optlist in enumerate(optlists):
+            optlist = list(optlist)
+            maps = []
+            if video is not None and '-vn' not in optlist:
+                filters = []
+                if '-vf' in optlist:
+                    idx = optlist.index('-vf')
+                    filters = optlist[idx + 1].split(',')
+                    del optlist[idx:idx + 2]
+                if optlist[optlist.index('-vcodec') + 1] == 'copy':
+                    maps.extend(['-map', '0:%d' % video.index])
+                else:
+                    chains[i] = filters
+                    maps.extend(['-map', '[v%d]' % i])
+            if info.audio is not None and '-an' not in optlist:
+                maps.extend(['-map', '0:%d' % info.audio.index])
+            if '-sn' not in optlist:
+                maps.extend(['-map', '0:s?'])
+            mapped.append(maps + optlist)
+
+        if not chains:
+            return None, mapped
+
+        # Filters shared by all the outputs are run once, before the split.
+        common = []
+        for filters in zip(*chains.values()):
+            if len(set(filters)) > 1:
+                break
+            common.append(filters[0])
+
+        source = '[0:%d]' % video.index
+        if len(chains) == 1:
+            i, filters = chains.popitem()
+            return '%s%s[v%d]' % (source, ','.join(filters) or 'null', i), mapped
+
+        graph = [source + ''.join(f + ',' for f in common) +
+                 'split=%d%s' % (len(chains), ''.join('[s%d]' % i for i in sorted(chains)))]
+        for i in sorted(chains):
+            graph.append('[s%d]%s[v%d]' % (i, ','.join(chains[i][len(common):]) or 'null', i))
+        return ';'.join(graph), mapped
+
+    @staticmethod
+    def _output_errors(output, outfiles):
+        """
+        Pick the lines of ffmpeg's output about each of the outputs.
+        """
+        errors = dict((outfile, []) for outfile in outfiles)
+        for line in (output or '').splitlines():
+            for i, outfile in enumerate(outfiles):
+                if outfile in line or '[out#%d/' % i in line or 'output file #%d' % i in line:
+                    errors[outfile].append(line.strip())
+        return errors
+
+    def analyze(self, infile, audio_level=True, interlacing=True, crop=False, start=None, duration=None, end=None, timeout=10, nice=None, title=None,
+                stall_timeout=None, deadline=None, capture=None, info=None):
         """
         Analyze the video frames to find if the video need to be deinterlaced.
         Or/and analyze the audio to find if the audio need to be normalize
@@ -250,11 +747,26 @@ class Converter(object):
         deinterlaced, defaults to True.
         :param timeout: How long should the operation be blocked in case ffmpeg
         gets stuck and doesn't report back, defaults to 10 sec.
+        :param stall_timeout: Stop if the analysis makes no progress for this
+        many seconds, defaults to None (no limit).
+        :param deadline: Maximum wall-clock duration of the analysis in
+        seconds, defaults to None (no limit).
+        :param capture: OutputCapture receiving ffmpeg's output, defaults to
+        one keeping only the last FFMpeg.STDERR_TAIL_SIZE bytes.
+        :param info: Probe info of the source if it's already known (a
+        MediaInfo or ffprobe dict), defaults to probing it.
+        :return: A job (see converter.ffmpeg.FFMpegJob) yielding the progress
+        in percents, then the analysis results.
         """
+        return FFMpegJob(self.ffmpeg, self._analyze, infile, audio_level, interlacing, crop, start, duration, end,
+                         timeout, nice, title, stall_timeout, deadline, capture, info)
+
+    def _analyze(self, job, infile, audio_level, interlacing, crop, start, duration, end, timeout, nice, title,
+                 stall_timeout, deadline, capture, info):
         if not os.path.exists(infile) and not self.ffmpeg.is_url(infile):
             raise ConverterError("Source file doesn't exist: " + infile)
 
-        info = self.ffmpeg.probe(infile, title=title)
+        info = self.ffmpeg._source_info(infile, info, title=title)
         if info is None:
             raise ConverterError("Can't get information about source file")
 
@@ -271,7 +783,9 @@ class Converter(object):
         if info['format']['duration'] < 0.01:
             raise ConverterError('Zero-length media')
         for timecode in self.ffmpeg.analyze(infile, audio_level, interlacing,
-                                            crop, start, duration, end, timeout, nice):
+                                            crop, start, duration, end, timeout, nice,
+                                            stall_timeout=stall_timeout, deadline=deadline,
+                                            capture=capture, job=job, info=info):
             if isinstance(timecode, float):
                 yield int((100.0 * timecode) / info['format']['duration'])
             else:
@@ -287,12 +801,19 @@ class Converter(object):
         """
         return self.ffmpeg.probe(*args, **kwargs)
 
-    def validate(self, source, duration=None, title=None):
+    def probe_many(self, *args, **kwargs):
+        """
+        Examine many media files concurrently. See the documentation of
+        converter.FFMpeg.probe_many() for details.
+        """
+        return self.ffmpeg.probe_many(*args, **kwargs)
+
+    def validate(self, source, duration=None, title=None, info=None):
         if not os.path.exists(source) and not self.ffmpeg.is_url(source):
             yield "Source file doesn't exist: " + source
             raise StopIteration
 
-        info = self.ffmpeg.probe(source, title=title)
+        info = self.ffmpeg._source_info(source, info, title=title)
         if info is None:
             yield 'no info'
             raise StopIteration
@@ -308,11 +829,18 @@ class Converter(object):
         else:
             duration = info['format']['duration']
 
+        # Decoding errors can be anywhere in the output, which is only
+        # partially kept, so look for them as the lines come in.
+        errors = []
+        capture = OutputCapture(self.ffmpeg.STDERR_TAIL_SIZE)
+        capture.add_line_handler(lambda line: 'rror while decoding' in line and errors.append(line))
+
         processed = self.ffmpeg.convert(source, '/dev/null', opts,
-                                        timeout=100, nice=15, get_output=True, title=title)
+                                        timeout=100, nice=15, get_output=True, title=title,
+                                        capture=capture)
         for timecode in processed:
             if isinstance(timecode, basestring):
-                if 'rror while decoding' in timecode:
+                if errors:
                     yield 'error'
                     raise StopIteration
             elif duration:
@@ -342,12 +870,121 @@ class Converter(object):
         return self.ffmpeg.thumbnails_by_interval(*args, **kwargs)
 
 
-def is_faststart(source):
+class Preset(dict):
     """
-    Check if the given file is 'faststart' or not.
+    Conversion options, as passed to Converter.convert(), validated once
+    to convert many files with. Create presets with Converter.preset()
+    or Preset.load().
+
+    A preset is a read-only dict of its options, and can be used wherever
+    options are. The ffmpeg option list only depends on the source size
+    (and the pass), so it's built once for each size and reused; the
+    start, duration and end options are added to it.
+
+    >>> c = Converter()
+    >>> preset = c.preset({'format': 'mp4', 'video': {'codec': 'h264', 'max_width': 1280}})
+    >>> preset.save('/etc/presets/720p.json')
+    >>> preset = Preset.load('/etc/presets/720p.json', c)
+    >>> conv = c.convert('test1.ogg', '/tmp/output.mp4', preset)
     """
-    with open(source) as source:
-        head = source.read(64)
-    if 'moov' in head:
+    SOURCE_KEYS = ('src_width', 'src_height', 'src_rotate')
+    # Source size the presets are validated with.
+    VALIDATION_SIZE = (1920, 1080)
+    MAX_COMPILED = 256
+
+    def __init__(self, converter, options, _compiled=None):
+        if not isinstance(options, dict):
+            raise ConverterError('Invalid options')
+        if _compiled is None:
+            options = copy.deepcopy(options)
+        super(Preset, self).__init__(options)
+        self.converter = converter
+        if _compiled is None:
+            _compiled = {}
+            self._validate()
+        self._compiled = _compiled
+
+    def _validate(self):
+        opt = dict(self)
+        video = opt.get('video')
+        if isinstance(video, dict) and 'src_width' not in video:
+            width, height = self.VALIDATION_SIZE
+            opt['video'] = dict(video, src_width=width, src_height=height)
+        self.converter.parse_options(opt)
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('Presets are read-only')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __deepcopy__(self, memo):
+        return Preset(self.converter, copy.deepcopy(dict(self), memo), self._compiled)
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+    def __repr__(self):
+        return 'Preset(%s)' % super(Preset, self).__repr__()
+
+    def bind(self, **source):
+        """
+        Return the preset for a source, with the src_width, src_height and
+        src_rotate video options given as keyword arguments. It shares
+        the compiled option lists of this preset.
+        """
+        options = dict(self)
+        if isinstance(options.get('video'), dict):
+            options['video'] = dict(options['video'], **source)
+        return Preset(self.converter, options, self._compiled)
+
+    def optlist(self, twopass=None, passlogfile=None):
+        """
+        Return the ffmpeg option list of the preset, like
+        Converter.parse_options().
+        """
+        video = self.get('video')
+        if isinstance(video, dict):
+            key = (tuple(video.get(k) for k in self.SOURCE_KEYS), twopass)
+        else:
+            key = (None, twopass)
+
+        optlist = self._compiled.get(key)
+        if optlist is None:
+            optlist = self.converter._stream_options(self, twopass)
+            if len(self._compiled) >= self.MAX_COMPILED:
+                self._compiled.clear()
+            self._compiled[key] = optlist
+
+        return optlist + self.converter._time_options(self) + self.converter._pass_options(twopass, passlogfile)
+
+    def save(self, path):
+        """
+        Save the preset to path, as YAML if its extension is .yaml or .yml
+        (this needs PyYAML), or as JSON.
+        """
+        with open(path, 'w') as f:
+            if self._is_yaml(path):
+                yaml.safe_dump(dict(self), f, default_flow_style=False)
+            else:
+                json.dump(dict(self), f, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path, converter=None):
+        """
+        Load and validate a preset saved by save(), or written by hand.
+        converter defaults to a new Converter.
+        """
+        with open(path) as f:
+            if cls._is_yaml(path):
+                options = yaml.safe_load(f)
+            else:
+                options = json.load(f)
+        return cls(converter or Converter(), options)
+
+    @staticmethod
+    def _is_yaml(path):
+        if not path.endswith(('.yaml', '.yml')):
+            return False
+        if yaml is None:
+            raise ConverterError('YAML presets need PyYAML')
         return True
-    return False
@@ -0,0 +1,671 @@
+#!/usr/bin/env python
+"""
+asyncio counterparts of FFMpeg and Converter.
+
+The classes here drive ffmpeg and ffprobe children through the event loop
+(no thread per job), so a single loop can supervise many conversions and
+probes at once.
+
+The API is written with plain futures and callbacks, and the package runs
+on Python 2, where the event loop comes from trollius. probe() returns a
+future, and the conversions are asynchronous iterators: each __anext__()
+call returns a future of the next progress value, which raises
+StopAsyncIteration (the one of this module on Python 2) at the end:
+
+    >>> from trollius import From, Return, coroutine
+    >>> from converter.aio import AsyncConverter, StopAsyncIteration
+    >>> @coroutine
+    ... def encode(conv, options):
+    ...     info = yield From(conv.probe('test1.ogg'))
+    ...     job = conv.convert('test1.ogg', '/tmp/out.ogg', options, info=info)
+    ...     while True:
+    ...         try:
+    ...             percent = yield From(job.__anext__())
+    ...         except StopAsyncIteration:
+    ...             break
+    ...     raise Return(info)
+    >>> loop.run_until_complete(encode(AsyncConverter(), options))
+"""
+
+import collections
+import logging
+import os
+import shutil
+import time
+from subprocess import PIPE
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+from converter import Converter, ConverterError
+from converter.ffmpeg import (FFMpeg, FFMpegError, FFMpegTimeoutError, OutputCapture, ProgressParser,
+                              STATS_TIME_RE, parse_stats, timecode_to_seconds)
+
+logger = logging.getLogger(__name__)
+
+try:
+    StopAsyncIteration = StopAsyncIteration
+except NameError:
+    class StopAsyncIteration(Exception):
+        """
+        Raised by the futures of __anext__() at the end of an asynchronous
+        iteration. StopIteration can't be used for that: in a generator
+        based coroutine it would end the coroutine awaiting the future.
+        """
+
+
+def _get_loop():
+    if asyncio is None:
+        raise FFMpegError('The asyncio API needs asyncio (or trollius on Python 2)')
+    get_running_loop = getattr(asyncio, 'get_running_loop', None)
+    if get_running_loop is not None:
+        return get_running_loop()
+    return asyncio.get_event_loop()
+
+
+def _create_future(loop):
+    if hasattr(loop, 'create_future'):
+        return loop.create_future()
+    return asyncio.Future(loop=loop)
+
+
+def _ensure_future(coro, loop):
+    ensure_future = getattr(asyncio, 'ensure_future', None) or getattr(asyncio, 'async')
+    return ensure_future(coro, loop=loop)
+
+
+def _chain(source, result, on_result, on_error=None):
+    """
+    Call on_result(value) once the source future completes. Errors are
+    passed to on_error (or set on the result future), and cancelling the
+    result future cancels the source future.
+    """
+    def source_done(fut):
+        if result.done():
+            return
+        if fut.cancelled():
+            result.cancel()
+            return
+        exc = fut.exception()
+        try:
+            if exc is None:
+                on_result(fut.result())
+            elif on_error is not None:
+                on_error(exc)
+            else:
+                result.set_exception(exc)
+        except Exception as e:
+            if not result.done():
+                result.set_exception(e)
+
+    def result_done(fut):
+        if fut.cancelled() and not source.done():
+            source.cancel()
+
+    source.add_done_callback(source_done)
+    result.add_done_callback(result_done)
+
+
+class _AsyncProcess(object):
+    """
+    Subprocess protocol used by the asyncio API. Hands the pipe data to a
+    callback and resolves `finished` with the exit code once the process
+    has exited and its output pipes are drained.
+    """
+
+    def __init__(self, loop, on_data=None):
+        self.loop = loop
+        self.on_data = on_data
+        self.transport = None
+        self.finished = _create_future(loop)
+        self._open_pipes = set([1, 2])
+        self._exited = False
+        self._shutdown = None
+        self._handles = []
+
+    def spawn(self, cmds):
+        logger.debug('Spawning ffmpeg with command: ' + ' '.join(cmds))
+        task = _ensure_future(self.loop.subprocess_exec(
+            lambda: self, *cmds, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=True), self.loop)
+        task.add_done_callback(self._spawned)
+
+    def _spawned(self, task):
+        if task.cancelled() or task.exception() is not None:
+            if not self.finished.done():
+                self.finished.set_exception(FFMpegError('Error while calling ffmpeg binary'))
+
+    @property
+    def pid(self):
+        return self.transport.get_pid() if self.transport else None
+
+    def shutdown(self, graceful=True):
+        """
+        Stop the process like FFMpeg._shutdown() does: 'q' on stdin, then
+        SIGTERM, then SIGKILL, without blocking the event loop.
+        """
+        if self.transport is None:
+            # not started yet, stop it as soon as it is
+            self._shutdown = graceful
+            return
+        if self._exited or self._handles:
+            return
+
+        delay = 0
+        stdin = self.transport.get_pipe_transport(0)
+        if graceful and stdin is not None:
+            try:
+                stdin.write(b'q')
+            except (OSError, RuntimeError):
+                pass
+            else:
+                delay = FFMpeg.QUIT_GRACE_PERIOD
+        self._handles = [
+            self.loop.call_later(delay, self._signal, 'terminate'),
+            self.loop.call_later(delay + FFMpeg.TERMINATE_GRACE_PERIOD, self._signal, 'kill'),
+        ]
+
+    def _signal(self, name):
+        if not self._exited:
+            try:
+                getattr(self.transport, name)()
+            except OSError:
+                pass
+
+    # asyncio.SubprocessProtocol interface
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self._shutdown is not None:
+            self.shutdown(self._shutdown)
+
+    def pipe_data_received(self, fd, data):
+        if self.on_data is not None:
+            self.on_data(fd, data)
+
+    def pipe_connection_lost(self, fd, exc):
+        self._open_pipes.discard(fd)
+        self._check_finished()
+
+    def process_exited(self):
+        self._exited = True
+        self._check_finished()
+
+    def connection_lost(self, exc):
+        pass
+
+    def _check_finished(self):
+        if not self._exited or self._open_pipes or self.finished.done():
+            return
+        for handle in self._handles:
+            handle.cancel()
+        returncode = self.transport.get_returncode()
+        self.transport.close()
+        self.finished.set_result(returncode)
+
+
+class AsyncFFMpegJob(object):
+    """
+    Asynchronous iterator over the progress of one ffmpeg run, returned by
+    AsyncFFMpeg.convert(). ffmpeg is started on the first __anext__()
+    call; the items and errors are the same as those of FFMpeg.convert(),
+    and the iteration ends with StopAsyncIteration.
+
+    Cancelling the task waiting on the iterator stops the ffmpeg process.
+    To abandon a job without cancelling, await its aclose() method.
+    """
+
+    def __init__(self, ffmpeg, infile, cmds, timeout=10, get_output=False, progress=False,
+                 stall_timeout=None, deadline=None, capture=None):
+        self.ffmpeg = ffmpeg
+        self.infile = infile
+        self.cmds = cmds
+        self.timeout = timeout
+        self.get_output = get_output
+        self.stall_timeout = stall_timeout
+        self.deadline = deadline
+        self.returncode = None
+
+        self._loop = None
+        self._process = None
+        self._parser = ProgressParser() if progress else None
+        self._stats_buf = ''
+        self._stderr = capture if capture is not None else OutputCapture(ffmpeg.STDERR_TAIL_SIZE)
+        self._items = collections.deque()
+        self._waiter = None
+        self._done = False
+        self._error = None
+        self._closers = []
+        self._yielded = False
+        self._timed_out = None
+        self._watchdog = None
+
+    @property
+    def pid(self):
+        return self._process.pid if self._process else None
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        loop = _get_loop()
+        fut = _create_future(loop)
+        if self._loop is None:
+            self._start(loop)
+
+        if self._items:
+            fut.set_result(self._items.popleft())
+        elif self._done:
+            error, self._error = self._error, None
+            fut.set_exception(error or StopAsyncIteration())
+        else:
+            self._waiter = fut
+            fut.add_done_callback(self._waiter_done)
+        return fut
+
+    def aclose(self):
+        """
+        Stop ffmpeg (if running) and return a future that completes once
+        the process is gone.
+        """
+        loop = _get_loop()
+        fut = _create_future(loop)
+        if self._done or self._loop is None:
+            self._done = True
+            fut.set_result(None)
+        else:
+            self._closers.append(fut)
+            self._process.shutdown(graceful=False)
+        return fut
+
+    def _waiter_done(self, fut):
+        if self._waiter is fut:
+            self._waiter = None
+        if fut.cancelled() and not self._done:
+            self._process.shutdown(graceful=False)
+
+    def _start(self, loop):
+        self._loop = loop
+        self._started = self._last_activity = self._last_advance = time.time()
+        self._last_timecode = -1.0
+        self._process = _AsyncProcess(loop, self._data_received)
+        self._process.finished.add_done_callback(self._finished)
+        self._process.spawn(self.cmds)
+        self._watch()
+
+    def _push(self, item):
+        if self._waiter is not None and not self._waiter.done():
+            waiter, self._waiter = self._waiter, None
+            waiter.set_result(item)
+        else:
+            self._items.append(item)
+
+    def _push_timecode(self, timecode):
+        if timecode > self._last_timecode:
+            self._last_timecode = timecode
+            self._last_advance = time.time()
+        self._yielded = True
+        self._push(timecode)
+
+    def _data_received(self, fd, data):
+        self._last_activity = time.time()
+        if fd == 1:
+            if self._parser is not None:
+                for record in self._parser.feed(data):
+                    self._push_timecode(record)
+            return
+
+        self._stderr.write(data)
+        if self._parser is None:
+            timecodes, self._stats_buf = parse_stats(self._stats_buf, data)
+            for timecode in timecodes:
+                self._push_timecode(timecode)
+
+    def _watch(self):
+        self._watchdog = None
+        if self._done or self._timed_out:
+            return
+
+        now = time.time()
+        if self.timeout and now - self._last_activity >= self.timeout:
+            self._timed_out = 'No output from ffmpeg for %s seconds' % self.timeout
+        elif self.stall_timeout and now - self._last_advance >= self.stall_timeout:
+            self._timed_out = 'Progress stalled for %s seconds' % self.stall_timeout
+        elif self.deadline and now - self._started >= self.deadline:
+            self._timed_out = 'Deadline of %s seconds exceeded' % self.deadline
+        if self._timed_out:
+            self._process.shutdown()
+            return
+
+        wait = []
+        if self.timeout:
+            wait.append(self._last_activity + self.timeout - now)
+        if self.stall_timeout:
+            wait.append(self._last_advance + self.stall_timeout - now)
+        if self.deadline:
+            wait.append(self._started + self.deadline - now)
+        if wait:
+            self._watchdog = self._loop.call_later(max(min(wait), 0.01), self._watch)
+
+    def _finished(self, fut):
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+
+        error = None
+        if fut.cancelled():
+            error = FFMpegError('Error while calling ffmpeg binary')
+        elif fut.exception() is not None:
+            error = fut.exception()
+        else:
+            self.returncode = fut.result()
+            error = self._check()
+
+        self._done = True
+        self._error = error
+        if self._waiter is not None and not self._waiter.done() and not self._items:
+            waiter, self._waiter = self._waiter, None
+            self._error = None
+            waiter.set_exception(error or StopAsyncIteration())
+        for closer in self._closers:
+            if not closer.done():
+                closer.set_result(None)
+
+    def _check(self):
+        self._stderr.close()
+        total_output = self._stderr.getvalue()
+        pid = self.pid
+        if self._timed_out:
+            return FFMpegTimeoutError(self._timed_out, ' '.join(self.cmds), total_output, pid=pid)
+        if self._closers:
+            return None
+
+        if not self._yielded:
+            # There may have been a single time, check it
+            tmp = STATS_TIME_RE.search(total_output)
+            if tmp:
+                self._push_timecode(timecode_to_seconds(tmp.group(1)))
+
+        try:
+            if self.ffmpeg._check_output(self.infile, self.cmds, total_output,
+                                         self._yielded, pid) and self.get_output:
+                self._push(total_output)
+            self.ffmpeg._check_returncode(self.cmds, total_output, self.returncode, pid)
+        except Exception as e:
+            return e
+        return None
+
+
+def _not_async(error):
+    def method(self, *args, **kwargs):
+        raise error('Not available in the asyncio API')
+    return method
+
+
+def _async_only(error, allowed):
+    """
+    Class decorator disabling the public methods and properties the class
+    inherits from its synchronous base, except the allowed ones: the
+    others run ffmpeg or ffprobe and would block the event loop. Using
+    them raises error.
+    """
+    def decorate(cls):
+        for name, value in vars(cls.__bases__[0]).items():
+            if name.startswith('_') or name in vars(cls) or name in allowed:
+                continue
+            if isinstance(value, property):
+                setattr(cls, name, property(_not_async(error)))
+            elif callable(value) or isinstance(value, (staticmethod, classmethod)):
+                setattr(cls, name, _not_async(error))
+        return cls
+    return decorate
+
+
+@_async_only(FFMpegError, ('is_url', 'is_stream', 'is_sink'))
+class AsyncFFMpeg(FFMpeg):
+    """
+    FFMpeg wrapper using asyncio subprocesses instead of blocking calls.
+    probe() and convert() are asynchronous; the other methods running
+    ffmpeg or ffprobe raise FFMpegError.
+
+    >>> f = AsyncFFMpeg()
+    """
+
+    def probe(self, fname, posters_as_video=False, title=None, profile=None, select_streams=None):
+        """
+        Awaitable version of FFMpeg.probe(). Returns a future resolving to
+        the same info (or None). Cancelling it kills ffprobe.
+        """
+        loop = _get_loop()
+        result = _create_future(loop)
+        if not os.path.exists(fname) and not self.is_url(fname):
+            result.set_result(None)
+            return result
+
+        profile = profile or self.probe_profile
+        key = self._probe_cache_key(fname, posters_as_video, title, profile, select_streams)
+        if key is not None:
+            try:
+                result.set_result(self.probe_cache[key])
+                return result
+            except KeyError:
+                pass
+
+        processes = []
+
+        def run(profile):
+            if self.PROBE_PROFILES[profile] is None:
+                info = self._read_header(fname, posters_as_video, title, select_streams)
+                deeper = self._deeper_probe_profile(profile, info)
+                if not deeper:
+                    if key is not None:
+                        self.probe_cache[key] = info
+                    result.set_result(info)
+                    return
+                profile = deeper
+
+            stdout = []
+
+            def on_data(fd, data):
+                if fd == 1:
+                    stdout.append(data)
+
+            def on_finished(_):
+                info = self._parse_probe(b''.join(stdout), fname, posters_as_video, title)
+                deeper = self._deeper_probe_profile(profile, info)
+                if deeper:
+                    run(deeper)
+                    return
+                if key is not None:
+                    self.probe_cache[key] = info
+                result.set_result(info)
+
+            process = _AsyncProcess(loop, on_data)
+            processes.append(process)
+            _chain(process.finished, result, on_finished)
+            process.spawn(self._probe_cmds(fname, profile, select_streams))
+
+        def on_cancel(fut):
+            if fut.cancelled() and processes:
+                processes[-1].shutdown(graceful=False)
+
+        result.add_done_callback(on_cancel)
+        run(profile)
+        return result
+
+    def convert(self, infile, outfile, opts, timeout=10, nice=None, get_output=False, title=None,
+                progress=False, stats_period=None, stall_timeout=None, deadline=None, capture=None):
+        """
+        Asynchronous version of FFMpeg.convert(). Returns an AsyncFFMpegJob
+        to be driven by awaiting its __anext__() (see the module
+        documentation).
+        """
+        if self.is_stream(infile):
+            raise FFMpegError('Streamed sources are not supported by the asyncio API')
+        if self.is_sink(outfile):
+            raise FFMpegError('Output sinks are not supported by the asyncio API')
+        if not os.path.exists(infile) and not self.is_url(infile):
+            raise FFMpegError("Input file doesn't exist: " + infile)
+
+        cmds = self._convert_cmds(infile, outfile, opts, get_output, progress, stats_period)
+        if 'pipe:' in cmds:
+            raise FFMpegError('DVD sources piped through tccat are not supported by the asyncio API')
+        cmds = self._nice_cmds(cmds, nice)
+        return AsyncFFMpegJob(self, infile, cmds, timeout=timeout, get_output=get_output,
+                              progress=progress, stall_timeout=stall_timeout, deadline=deadline,
+                              capture=capture)
+
+
+class _AsyncConversion(object):
+    """
+    Asynchronous iterator returned by AsyncConverter.convert(), yielding
+    the conversion progress in percents like Converter.convert().
+    """
+
+    def __init__(self, converter, infile, outfile, options, twopass, title, kwargs, info=None,
+                 smart_copy=False):
+        self.converter = converter
+        self.infile = infile
+        self.outfile = outfile
+        self.options = options
+        self.twopass = twopass
+        self.title = title
+        self.kwargs = kwargs
+        self.info = info
+        self.smart_copy = smart_copy
+        self.copied = []
+        self.job = None
+
+        self._probe = None
+        self._passes = None
+        self._workspace = None
+        self._duration = None
+        self._base = self._share = 0.0
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        result = _create_future(_get_loop())
+        try:
+            self._next(result)
+        except Exception as e:
+            result.set_exception(e)
+        return result
+
+    def aclose(self):
+        if self.job is not None:
+            closed = self.job.aclose()
+            closed.add_done_callback(lambda _: self._cleanup())
+            return closed
+        self._cleanup()
+        self._passes = []
+        result = _create_future(_get_loop())
+        result.set_result(None)
+        return result
+
+    def _next(self, result):
+        if self._passes is None:
+            if self._probe is None:
+                self._probe = self.converter._probe_source(self.infile, self.options, self.title,
+                                                           self.info)
+            _chain(self._probe, result, lambda info: self._setup(info, result))
+            return
+
+        if self.job is None:
+            if not self._passes:
+                self._cleanup()
+                result.set_exception(StopAsyncIteration())
+                return
+            optlist, target, self._base, self._share = self._passes.pop(0)
+            self.job = self.converter.ffmpeg.convert(self.infile, target, optlist, **self.kwargs)
+
+        def on_error(exc):
+            if isinstance(exc, StopAsyncIteration):
+                self.job = None
+                self._next(result)
+            else:
+                self._cleanup()
+                result.set_exception(exc)
+
+        _chain(self.job.__anext__(), result,
+               lambda timecode: result.set_result(
+                   int(self._base + (self._share * timecode) / self._duration)),
+               on_error)
+
+    def _setup(self, info, result):
+        if info is None:
+            raise ConverterError("Can't get information about source file")
+        options, self._duration = self.converter._source_options(info, self.options)
+        twopass = self.twopass
+        if self.smart_copy:
+            options, self.copied = self.converter._smart_copy(info, options)
+            if 'video' in self.copied:
+                twopass = False
+        self._workspace, passlogfile = self.converter._pass_workspace(twopass)
+        self._passes = self.converter._passes(options, twopass, self.outfile, passlogfile)
+        self._next(result)
+
+    def _cleanup(self):
+        if self._workspace:
+            shutil.rmtree(self._workspace, ignore_errors=True)
+            self._workspace = None
+
+
+@_async_only(ConverterError, ('parse_options', 'preset', 'probe'))
+class AsyncConverter(Converter):
+    """
+    Converter using AsyncFFMpeg: probe() returns a future and convert()
+    an asynchronous iterator. The other methods running ffmpeg or ffprobe
+    raise ConverterError.
+
+    >>> c = AsyncConverter()
+    """
+
+    def __init__(self, ffmpeg_path=None, ffprobe_path=None, probe_cache=None, probe_profile='full',
+                 check_capabilities=False):
+        super(AsyncConverter, self).__init__(ffmpeg_path=ffmpeg_path, ffprobe_path=ffprobe_path,
+                                             probe_profile=probe_profile,
+                                             check_capabilities=check_capabilities)
+        self.ffmpeg = AsyncFFMpeg(ffmpeg_path=self.ffmpeg.ffmpeg_path,
+                                  ffprobe_path=self.ffmpeg.ffprobe_path,
+                                  probe_cache=probe_cache,
+                                  probe_profile=probe_profile)
+
+    def _probe_source(self, infile, options, title, info=None):
+        if not isinstance(options, dict):
+            raise ConverterError('Invalid options')
+
+        if self.ffmpeg.is_stream(infile):
+            raise ConverterError('Streamed sources are not supported by the asyncio API')
+        if not os.path.exists(infile) and not self.ffmpeg.is_url(infile):
+            raise ConverterError("Source file doesn't exist: " + infile)
+
+        if info is None:
+            return self.ffmpeg.probe(infile, title=title)
+        result = _create_future(_get_loop())
+        result.set_result(self.ffmpeg._source_info(infile, info, title=title))
+        return result
+
+    def convert(self, infile, outfile, options, twopass=False, timeout=10, nice=None, title=None,
+                progress=False, stats_period=None, stall_timeout=None, deadline=None, info=None,
+                smart_copy=False):
+        """
+        Asynchronous version of Converter.convert(); await the __anext__()
+        of the returned object until it raises StopAsyncIteration to drive
+        the conversion (see the module documentation). With smart_copy,
+        its copied attribute lists the copied streams once it has started.
+
+        >>> conv = AsyncConverter().convert('test1.ogg', '/tmp/output.mkv', {
+        ...    'format': 'mkv',
+        ...    'audio': { 'codec': 'aac' },
+        ...    'video': { 'codec': 'h264' }
+        ... })
+        >>> percent = yield From(conv.__anext__())
+        """
+        kwargs = dict(timeout=timeout, nice=nice, progress=progress, stats_period=stats_period,
+                      stall_timeout=stall_timeout, deadline=deadline)
+        return _AsyncConversion(self, infile, outfile, options, twopass, title, kwargs, info, smart_copy)
@@ -9,15 +9,30 @@ class BaseCodec(object):
     encoder_options = {}
     codec_name = None
     ffmpeg_codec_name = None
+    # Name of the codec in probe() results, if not codec_name.
+    stream_codec_name = None
 
     def parse_options(self, opt):
         if 'codec' not in opt or opt['codec'] != self.codec_name:
             raise ValueError('invalid codec name')
         return None
 
+    def can_copy(self, opt, stream):
+        """
+        Return True if the source stream (a MediaStreamInfo) already
+        matches the options opt, so it can be copied instead of encoded.
+        """
+        return False
+
+    def _stream_matches(self, stream):
+        return stream.codec == (self.stream_codec_name or self.codec_name)
+
     def _codec_specific_parse_options(self, safe):
         return safe
 
+    def _codec_specific_can_copy(self, safe, stream):
+        return True
+
     def _codec_specific_produce_ffmpeg_list(self, safe):
         return []
 
@@ -108,6 +123,24 @@ class AudioCodec(BaseCodec):
         optlist.extend(self._codec_specific_produce_ffmpeg_list(safe))
         return optlist
 
+    def can_copy(self, opt, stream):
+        """
+        The stream can be copied if it has the requested number of
+        channels and sample rate, and at most the requested bitrate.
+        """
+        if not self._stream_matches(stream):
+            return False
+        safe = self.safe_options(opt)
+        if safe.get('filters') or 'volume' in opt:
+            return False
+        if 'channels' in safe and stream.audio_channels != safe['channels']:
+            return False
+        if 'samplerate' in safe and stream.audio_samplerate != safe['samplerate']:
+            return False
+        if 'bitrate' in safe and (stream.bitrate is None or stream.bitrate > safe['bitrate'] * 1000):
+            return False
+        return self._codec_specific_can_copy(safe, stream)
+
 
 class SubtitleCodec(BaseCodec):
     """
@@ -443,6 +476,35 @@ class VideoCodec(BaseCodec):
         optlist.extend(self._codec_specific_produce_ffmpeg_list(safe))
         return optlist
 
+    def can_copy(self, opt, stream):
+        """
+        The stream can be copied if it needs no filtering and has at most
+        the requested size, frame rate and bitrate, and the requested
+        pixel format. With the sizing policies that scale the video up,
+        the size has to be the requested one.
+        """
+        if not self._stream_matches(stream):
+            return False
+        safe = self.safe_options(opt)
+        if safe.get('crop') or safe.get('filters'):
+            return False
+        if safe.get('autorotate') and safe.get('src_rotate') in (90, 180, 270):
+            return False
+        if stream.get('pix_fmt', 'yuv420p') != safe.get('pix_fmt', 'yuv420p'):
+            return False
+
+        exact = safe.get('sizing_policy', 'Keep') not in ('Keep', 'ShrinkToFit', 'ShrinkToFill')
+        for key, size in (('max_width', stream.video_width), ('max_height', stream.video_height)):
+            if key in safe:
+                if size is None or size > safe[key] or (exact and size != safe[key]):
+                    return False
+
+        if 'fps' in safe and (stream.video_fps is None or stream.video_fps > safe['fps'] + 0.01):
+            return False
+        if 'bitrate' in safe and (stream.bitrate is None or stream.bitrate > safe['bitrate'] * 1000000):
+            return False
+        return self._codec_specific_can_copy(safe, stream)
+
 
 class AudioNullCodec(BaseCodec):
     """
@@ -545,6 +607,7 @@ class FdkAacCodec(AudioCodec):
     """
     codec_name = 'libfdk_aac'
     ffmpeg_codec_name = 'libfdk_aac'
+    stream_codec_name = 'aac'
 
 
 class Ac3Codec(AudioCodec):
@@ -593,6 +656,7 @@ class WavCodec(AudioCodec):
     """
     codec_name = 'wav'
     ffmpeg_codec_name = 'pcm_s16le'
+    stream_codec_name = 'pcm_s16le'
 
 
 # Video Codecs
@@ -680,6 +744,19 @@ class H264Codec(VideoCodec):
 
         return optlist
 
+    def _codec_specific_can_copy(self, safe, stream):
+        if 'profile' in safe:
+            profile = (stream.get('profile') or '').replace('constrained ', '')
+            if profile != safe['profile'].lower():
+                return False
+        if 'level' in safe:
+            try:
+                if stream.get('level') is None or stream.get('level') > float(safe['level']):
+                    return False
+            except ValueError:
+                return False
+        return True
+
 
 class DivxCodec(VideoCodec):
     """
@@ -687,6 +764,7 @@ class DivxCodec(VideoCodec):
     """
     codec_name = 'divx'
     ffmpeg_codec_name = 'mpeg4'
+    stream_codec_name = 'mpeg4'
 
 
 class Vp8Codec(VideoCodec):
@@ -711,6 +789,7 @@ class FlvCodec(VideoCodec):
     """
     codec_name = 'flv'
     ffmpeg_codec_name = 'flv'
+    stream_codec_name = 'flv1'
 
 
 class Ffv1Codec(VideoCodec):
@@ -792,6 +871,7 @@ class Mpeg1Codec(MpegCodec):
     """
     codec_name = 'mpeg1'
     ffmpeg_codec_name = 'mpeg1video'
+    stream_codec_name = 'mpeg1video'
 
 
 class Mpeg2Codec(MpegCodec):
@@ -800,6 +880,7 @@ class Mpeg2Codec(MpegCodec):
     """
     codec_name = 'mpeg2'
     ffmpeg_codec_name = 'mpeg2video'
+    stream_codec_name = 'mpeg2video'
 
 
 # Subtitle Codecs
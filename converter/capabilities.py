@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""
+Discovery of what an ffmpeg binary supports.
+
+    >>> caps = FFMpeg().capabilities
+    >>> caps.version
+    '6.0'
+    >>> 'libx264' in caps.encoders, 'mp4' in caps.muxers, 'scale' in caps.filters
+    (True, True, True)
+
+ffmpeg is run once per binary (-version, -encoders, -muxers and -filters)
+and the results are cached in memory and, unless CACHE_DIR is None, in a
+JSON file per binary, so the discovery survives process restarts. The
+cached results are keyed by the binary's path, size and modification
+time, so upgrading ffmpeg invalidates them.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from subprocess import Popen, PIPE
+
+logger = logging.getLogger(__name__)
+
+# Where the discovered capabilities are stored, None to only keep them in
+# memory.
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                         'python-video-converter')
+
+VERSION_RE = re.compile(r'^\S+ version (\S+)')
+SEPARATOR_RE = re.compile(r'^(\s*)(-+)\s*$')
+CODEC_RE = re.compile(r'\(codec (\S+)\)\s*$')
+FILTER_RE = re.compile(r'^ [T.][S.][C.]? (\S+)\s+\S+->\S+')
+
+_cache = {}
+_lock = threading.Lock()
+
+
+class Capabilities(object):
+    """
+    What an ffmpeg binary supports: its version and configure options, and
+    the names of its encoders (including the names of the codecs they
+    encode, which ffmpeg also accepts), muxers and filters.
+    """
+
+    def __init__(self, version=None, configuration=None, encoders=(), muxers=(), filters=()):
+        self.version = version
+        self.configuration = configuration
+        self.encoders = frozenset(encoders)
+        self.muxers = frozenset(muxers)
+        self.filters = frozenset(filters)
+
+    def as_dict(self):
+        return {'version': self.version, 'configuration': self.configuration,
+                'encoders': sorted(self.encoders), 'muxers': sorted(self.muxers),
+                'filters': sorted(self.filters)}
+
+    def __repr__(self):
+        return 'Capabilities(version=%s, encoders=%d, muxers=%d, filters=%d)' % (
+            self.version, len(self.encoders), len(self.muxers), len(self.filters))
+
+
+def discover(ffmpeg_path):
+    """
+    Return the Capabilities of the ffmpeg binary at ffmpeg_path, from the
+    cache if possible. Returns None if they can't be discovered.
+    """
+    key = _key(ffmpeg_path)
+    if key is None:
+        return None
+
+    with _lock:
+        caps = _cache.get(key)
+    if caps is not None:
+        return caps
+
+    caps = _load(key)
+    if caps is None:
+        caps = _run(ffmpeg_path)
+        if caps is None:
+            return None
+        _store(key, caps)
+
+    with _lock:
+        _cache[key] = caps
+    return caps
+
+
+def clear_cache():
+    """
+    Forget the capabilities discovered by this process.
+    """
+    with _lock:
+        _cache.clear()
+
+
+def _key(ffmpeg_path):
+    try:
+        path = os.path.realpath(ffmpeg_path)
+        st = os.stat(path)
+    except OSError:
+        return None
+    mtime_ns = getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 1000000000)
+    return path, st.st_size, mtime_ns
+
+
+def _cache_file(key):
+    return os.path.join(CACHE_DIR, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.json')
+
+
+def _load(key):
+    if not CACHE_DIR:
+        return None
+    try:
+        with open(_cache_file(key)) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if data.get('key') != list(key):
+        return None
+    return Capabilities(**data['capabilities'])
+
+
+def _store(key, caps):
+    if not CACHE_DIR:
+        return
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'key': list(key), 'capabilities': caps.as_dict()}, f)
+        os.rename(tmp, _cache_file(key))
+    except (IOError, OSError) as e:
+        logger.warning("Can't store ffmpeg capabilities in %s: %s", CACHE_DIR, e)
+
+
+def _run(ffmpeg_path):
+    """
+    Run the ffmpeg queries in parallel and parse their output.
+    """
+    queries = ('-version', '-encoders', '-muxers', '-filters')
+    try:
+        processes = [Popen([ffmpeg_path, '-hide_banner', query], stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                           close_fds=True) for query in queries]
+    except OSError as e:
+        logger.warning("Can't run %s: %s", ffmpeg_path, e)
+        return None
+
+    output = {}
+    for query, p in zip(queries, processes):
+        stdout, _ = p.communicate()
+        if p.returncode:
+            logger.warning('%s %s failed with exit status %d', ffmpeg_path, query, p.returncode)
+            return None
+        output[query] = stdout.decode('utf-8', 'replace')
+
+    caps = parse(output['-version'], output['-encoders'], output['-muxers'], output['-filters'])
+    if caps is None:
+        logger.warning("Can't parse the encoders and muxers listed by %s", ffmpeg_path)
+    return caps
+
+
+def _table(lines):
+    """
+    Return the (flags, rest of the line) of the entries of an ffmpeg
+    listing (-encoders, -muxers), which come after the legend of the flag
+    columns and a line of dashes under them. The number of flag columns
+    changes between ffmpeg versions.
+    """
+    entries = []
+    columns = None
+    for line in lines:
+        if columns is None:
+            match = SEPARATOR_RE.match(line)
+            if match:
+                columns = slice(len(match.group(1)), match.end(2))
+            continue
+        if line.strip():
+            entries.append((line[columns], line[columns.stop:]))
+    return entries
+
+
+def parse(version_output, encoders_output, muxers_output, filters_output):
+    """
+    Parse the output of ffmpeg -version, -encoders, -muxers and -filters
+    into Capabilities. Returns None if no encoders or muxers are found,
+    as the output format is then unknown.
+    """
+    version = configuration = None
+    for line in version_output.splitlines():
+        match = VERSION_RE.match(line)
+        if match and version is None:
+            version = match.group(1)
+        elif line.startswith('configuration:'):
+            configuration = line.split(':', 1)[1].strip()
+
+    encoders = set()
+    for _, rest in _table(encoders_output.splitlines()):
+        words = rest.split()
+        if words:
+            encoders.add(words[0])
+            match = CODEC_RE.search(rest)
+            if match:
+                encoders.add(match.group(1))
+
+    muxers = set()
+    for flags, rest in _table(muxers_output.splitlines()):
+        words = rest.split()
+        if 'E' in flags and words:
+            muxers.update(words[0].split(','))
+
+    filters = set()
+    for line in filters_output.splitlines():
+        match = FILTER_RE.match(line)
+        if match:
+            filters.add(match.group(1))
+
+    if not encoders or not muxers:
+        return None
+    return Capabilities(version, configuration, encoders, muxers, filters)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+Helpers to encode a title in chunks: split it into time ranges starting
+at keyframes, and run the jobs encoding the chunks on a pool of threads.
+
+Converter.convert(..., chunks=N) uses them to encode the chunks of a
+single title in parallel and join them with the concat demuxer.
+"""
+
+import logging
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+if sys.version_info[0] >= 3:
+    def _reraise(exc_info):
+        raise exc_info[1].with_traceback(exc_info[2])
+else:
+    exec('def _reraise(exc_info):\n    raise exc_info[0], exc_info[1], exc_info[2]\n')
+
+
+def split_ranges(keyframes, start, end, count):
+    """
+    Split the time range start-end into at most count ranges of about the
+    same length, each starting at a keyframe (keyframes is the sorted list
+    of their timestamps). Returns a list of (start, duration) tuples.
+
+    >>> split_ranges([0.0, 2.0, 4.0, 6.0, 8.0], 0, 10.0, 3)
+    [(0, 4.0), (4.0, 2.0), (6.0, 4.0)]
+    """
+    if end <= start:
+        return []
+
+    bounds = [start]
+    for i in range(1, count):
+        target = start + float(end - start) * i / count
+        candidates = [k for k in keyframes if bounds[-1] < k < end]
+        if not candidates:
+            break
+        bound = min(candidates, key=lambda k: abs(k - target))
+        if bound not in bounds:
+            bounds.append(bound)
+    bounds.append(end)
+
+    return [(bounds[i], bounds[i + 1] - bounds[i]) for i in range(len(bounds) - 1)]
+
+
+def run_jobs(factories, workers, retries=0, parent=None):
+    """
+    Run the jobs made by factories (callables returning an FFMpegJob) on
+    at most workers threads, and yield ('progress', index, item) for the
+    items they yield, ('retry', index, error) when a failed job is made
+    again and restarted (at most retries times), and ('done', index, None)
+    when one finishes.
+
+    If a job still fails after its retries, the other jobs are stopped and
+    its error is raised, with the traceback of the thread running it. The running jobs are also stopped when the
+    generator is closed. If parent is given, the running jobs are in its
+    subjobs, so stopping it stops them.
+    """
+    events = queue.Queue()
+    pending = queue.Queue()
+    for index in range(len(factories)):
+        pending.put(index)
+    stopping = threading.Event()
+    running = {}
+    lock = threading.Lock()
+
+    def run(index):
+        for attempt in range(retries + 1):
+            job = factories[index]()
+            with lock:
+                if stopping.is_set():
+                    return
+                running[index] = job
+            if parent is not None:
+                parent.subjobs.append(job)
+            try:
+                for item in job:
+                    events.put(('progress', index, item))
+            except Exception:
+                exc_info = sys.exc_info()
+                error = exc_info[1]
+                if stopping.is_set() or attempt == retries:
+                    # with the traceback of the job, to raise it as is
+                    events.put(('error', index, exc_info))
+                    return
+                logger.warning('retrying job %d after error: %s', index, error)
+                events.put(('retry', index, error))
+            else:
+                events.put(('done', index, None))
+                return
+            finally:
+                with lock:
+                    running.pop(index, None)
+                if parent is not None:
+                    parent.subjobs.remove(job)
+
+    def worker():
+        while not stopping.is_set():
+            try:
+                index = pending.get_nowait()
+            except queue.Empty:
+                return
+            run(index)
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(factories)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        remaining = len(factories)
+        while remaining:
+            event = events.get()
+            if event[0] == 'error':
+                _reraise(event[2])
+            if event[0] == 'done':
+                remaining -= 1
+            yield event
+    finally:
+        stopping.set()
+        # A job may not have started ffmpeg yet when it is terminated, so
+        # keep terminating the running jobs until all the threads are done.
+        while any(thread.is_alive() for thread in threads):
+            with lock:
+                jobs = list(running.values())
+            for job in jobs:
+                job.terminate()
+            for thread in threads:
+                thread.join(0.1)
@@ -0,0 +1,732 @@
+#!/usr/bin/env python
+"""
+Reading of the MP4/MOV and Matroska/WebM headers without spawning ffprobe.
+
+    >>> raw = read_header('test.mp4')
+    >>> info = MediaInfo(raw)
+
+read_header() returns the same fields ffprobe prints with -show_format
+-show_streams (those used by MediaInfo: durations, dimensions, frame rate,
+codecs, audio channels and sample rate), or None if the file isn't one it
+can describe completely: other formats, fragmented MP4 files, cover art,
+data tracks, unknown codecs and such are left to ffprobe. The file is
+mapped in memory, and only the headers are read.
+
+is_faststart() and make_faststart() check and fix the position of the
+moov box of MP4 files for progressive playback, without ffmpeg:
+
+    >>> if not is_faststart('input.mp4'):
+    ...     make_faststart('input.mp4', 'web.mp4')
+"""
+
+import array
+import bisect
+import errno
+import fractions
+import math
+import mmap
+import os
+import struct
+import sys
+
+__all__ = ['read_header', 'is_faststart', 'make_faststart', 'ContainerError']
+
+# ffprobe's codec names of the MP4 sample entries and Matroska codec IDs.
+MP4_CODECS = {
+    b'avc1': 'h264', b'avc3': 'h264', b'hvc1': 'hevc', b'hev1': 'hevc',
+    b'vp08': 'vp8', b'vp09': 'vp9', b'av01': 'av1', b'mp4v': 'mpeg4',
+    b'jpeg': 'mjpeg', b'apch': 'prores', b'apcn': 'prores', b'apcs': 'prores',
+    b'apco': 'prores', b'ap4h': 'prores',
+    b'mp4a': 'aac', b'ac-3': 'ac3', b'ec-3': 'eac3', b'Opus': 'opus',
+    b'fLaC': 'flac', b'alac': 'alac', b'.mp3': 'mp3',
+    b'tx3g': 'mov_text',
+}
+
+MKV_CODECS = {
+    'V_MPEG4/ISO/AVC': 'h264', 'V_MPEGH/ISO/HEVC': 'hevc', 'V_VP8': 'vp8',
+    'V_VP9': 'vp9', 'V_AV1': 'av1', 'V_THEORA': 'theora', 'V_MPEG2': 'mpeg2video',
+    'V_MJPEG': 'mjpeg', 'V_PRORES': 'prores',
+    'A_AAC': 'aac', 'A_VORBIS': 'vorbis', 'A_OPUS': 'opus', 'A_AC3': 'ac3',
+    'A_EAC3': 'eac3', 'A_DTS': 'dts', 'A_FLAC': 'flac', 'A_MPEG/L3': 'mp3',
+    'A_MPEG/L2': 'mp2', 'A_PCM/INT/LIT': 'pcm_s16le',
+    'S_TEXT/UTF8': 'subrip', 'S_TEXT/ASS': 'ass', 'S_TEXT/SSA': 'ass',
+    'S_TEXT/WEBVTT': 'webvtt', 'S_VOBSUB': 'dvd_subtitle', 'S_HDMV/PGS': 'hdmv_pgs_subtitle',
+}
+
+MP4_HANDLERS = {b'vide': 'video', b'soun': 'audio', b'sbtl': 'subtitle',
+                b'text': 'subtitle', b'subt': 'subtitle'}
+
+MKV_TRACK_TYPES = {1: 'video', 2: 'audio', 0x11: 'subtitle'}
+
+MP4_TOP_LEVEL = (b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot')
+
+
+class ContainerError(Exception):
+    pass
+
+
+class Unsupported(ContainerError):
+    """
+    The file can't be described without ffprobe.
+    """
+    pass
+
+
+def read_header(fname):
+    """
+    Read the headers of the MP4/MOV or Matroska file fname. Returns the
+    info in the shape of ffprobe's JSON output, or None if the file isn't
+    supported (see the module documentation).
+    """
+    try:
+        with open(fname, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < 16:
+                return None
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError, mmap.error):
+        return None
+
+    try:
+        if buf[4:8] in MP4_TOP_LEVEL:
+            info = _read_mp4(buf, size)
+        elif buf[0:4] == b'\x1a\x45\xdf\xa3':
+            info = _read_matroska(buf, size)
+        else:
+            return None
+    except (Unsupported, struct.error, IndexError, ValueError, OverflowError, ZeroDivisionError):
+        return None
+    finally:
+        buf.close()
+
+    info['format']['filename'] = fname
+    info['format']['size'] = str(size)
+    duration = float(info['format']['duration'])
+    if duration > 0:
+        info['format']['bit_rate'] = str(int(size * 8 / duration))
+    return info
+
+
+def _rate(num, den):
+    """
+    Frame rate as ffprobe prints it, e.g. '25/1' or '30000/1001'.
+    """
+    if not num or not den:
+        return '0/0'
+    rate = fractions.Fraction(num, den)
+    if rate.denominator > 1001:
+        rate = rate.limit_denominator(1001)
+    return '%d/%d' % (rate.numerator, rate.denominator)
+
+
+def _stream(index, codec_type, codec_name):
+    return {'index': index, 'codec_type': codec_type, 'codec_name': codec_name,
+            'disposition': {'attached_pic': 0}, 'tags': {}}
+
+
+# MP4 / QuickTime
+
+
+def _boxes(buf, start, end):
+    """
+    Yield the (type, body start, end) of the boxes between start and end.
+    """
+    pos = start
+    while pos + 8 <= end:
+        size, typ = struct.unpack_from('>I4s', buf, pos)
+        body = pos + 8
+        if size == 1:
+            size = struct.unpack_from('>Q', buf, body)[0]
+            body += 8
+        elif size == 0:
+            size = end - pos
+        if size < body - pos or pos + size > end:
+            raise Unsupported('truncated box')
+        yield typ, body, pos + size
+        pos += size
+
+
+def _child(buf, start, end, *path):
+    """
+    Return the (body start, end) of the box at path, or None.
+    """
+    for typ, body, box_end in _boxes(buf, start, end):
+        if typ == path[0]:
+            if len(path) == 1:
+                return body, box_end
+            return _child(buf, body, box_end, *path[1:])
+    return None
+
+
+def _full_box(buf, body):
+    """
+    Return the version of a full box and the start of its fields.
+    """
+    return struct.unpack_from('>B', buf, body)[0], body + 4
+
+
+def _read_mp4(buf, size):
+    moov = _child(buf, 0, size, b'moov')
+    if moov is None:
+        raise Unsupported('no moov box')
+    start, end = moov
+    if _child(buf, start, end, b'mvex') is not None:
+        raise Unsupported('fragmented file')
+    meta = _child(buf, start, end, b'udta', b'meta')
+    if meta is not None and _covr(buf, *meta):
+        raise Unsupported('cover art')
+
+    mvhd = _child(buf, start, end, b'mvhd')
+    if mvhd is None:
+        raise Unsupported('no mvhd box')
+    version, pos = _full_box(buf, mvhd[0])
+    if version == 1:
+        timescale, duration = struct.unpack_from('>IQ', buf, pos + 16)
+    else:
+        timescale, duration = struct.unpack_from('>II', buf, pos + 8)
+    if not duration:
+        raise Unsupported('no duration')
+
+    streams = []
+    for typ, body, box_end in _boxes(buf, start, end):
+        if typ == b'trak':
+            streams.append(_read_trak(buf, body, box_end, len(streams), timescale))
+    if not streams:
+        raise Unsupported('no tracks')
+
+    fmt = {'format_name': 'mov,mp4,m4a,3gp,3g2,mj2', 'format_long_name': 'QuickTime / MOV',
+           'nb_streams': len(streams), 'duration': '%.6f' % (float(duration) / timescale),
+           'tags': {}}
+    return {'format': fmt, 'streams': streams}
+
+
+def _covr(buf, start, end):
+    # meta is a full box in MP4 files, but not in QuickTime ones.
+    for body in (start + 4, start):
+        try:
+            if _child(buf, body, end, b'ilst', b'covr') is not None:
+                return True
+        except (Unsupported, struct.error):
+            pass
+    return False
+
+
+def _read_trak(buf, start, end, index, movie_timescale):
+    tkhd = _child(buf, start, end, b'tkhd')
+    mdhd = _child(buf, start, end, b'mdia', b'mdhd')
+    hdlr = _child(buf, start, end, b'mdia', b'hdlr')
+    stbl = _child(buf, start, end, b'mdia', b'minf', b'stbl')
+    if None in (tkhd, mdhd, hdlr, stbl):
+        raise Unsupported('incomplete track')
+
+    handler = buf[hdlr[0] + 8:hdlr[0] + 12]
+    if handler not in MP4_HANDLERS:
+        raise Unsupported('unsupported track type')
+
+    version, pos = _full_box(buf, mdhd[0])
+    if version == 1:
+        timescale, duration = struct.unpack_from('>IQ', buf, pos + 16)
+        pos += 28
+    else:
+        timescale, duration = struct.unpack_from('>II', buf, pos + 8)
+        pos += 16
+    lang = struct.unpack_from('>H', buf, pos)[0]
+
+    stsd = _child(buf, stbl[0], stbl[1], b'stsd')
+    if stsd is None or struct.unpack_from('>I', buf, stsd[0] + 4)[0] < 1:
+        raise Unsupported('no sample description')
+    entry = stsd[0] + 8
+    fourcc = buf[entry + 4:entry + 8]
+    if fourcc not in MP4_CODECS:
+        raise Unsupported('unsupported codec')
+
+    stream = _stream(index, MP4_HANDLERS[handler], MP4_CODECS[fourcc])
+    stream['codec_tag_string'] = fourcc.decode('latin-1')
+    stream['time_base'] = '1/%d' % timescale
+    edits = _edit_duration(buf, start, end)
+    if edits:
+        stream['duration_ts'] = int(round(float(edits) * timescale / movie_timescale))
+    else:
+        stream['duration_ts'] = duration
+    stream['duration'] = '%.6f' % (float(stream['duration_ts']) / timescale)
+    # QuickTime files can use Macintosh language codes, below 0x400.
+    if 0x400 <= lang < 0x7fff:
+        stream['tags']['language'] = ''.join(chr(((lang >> shift) & 0x1f) + 0x60) for shift in (10, 5, 0))
+
+    nb_frames, sample_bytes = _samples(buf, stbl)
+    if nb_frames:
+        stream['nb_frames'] = str(nb_frames)
+    if duration and sample_bytes:
+        stream['bit_rate'] = str(int(sample_bytes * 8 * timescale / duration))
+
+    body = entry + 16  # after the sample entry header and data reference index
+    if stream['codec_type'] == 'video':
+        width, height = struct.unpack_from('>HH', buf, body + 16)
+        stream['width'] = width
+        stream['height'] = height
+        stream['avg_frame_rate'] = stream['r_frame_rate'] = _rate(nb_frames * timescale, duration)
+        rotate = _rotation(buf, tkhd[0])
+        if rotate:
+            stream['tags']['rotate'] = str(rotate)
+    elif stream['codec_type'] == 'audio':
+        sound_version = struct.unpack_from('>H', buf, body)[0]
+        if sound_version > 1:
+            raise Unsupported('QuickTime sound description version 2')
+        channels, _, _, _, rate = struct.unpack_from('>HHHHI', buf, body + 8)
+        if not channels or not rate >> 16:
+            raise Unsupported('no audio parameters')
+        stream['channels'] = channels
+        stream['sample_rate'] = str(rate >> 16)
+    return stream
+
+
+def _edit_duration(buf, start, end):
+    """
+    Return the duration of the track's edit list in the movie timescale,
+    or None if it has none.
+    """
+    elst = _child(buf, start, end, b'edts', b'elst')
+    if elst is None:
+        return None
+    version, pos = _full_box(buf, elst[0])
+    count = struct.unpack_from('>I', buf, pos)[0]
+    entry, fmt = (20, '>Qq') if version == 1 else (12, '>Ii')
+    total = 0
+    for i in range(count):
+        segment_duration, media_time = struct.unpack_from(fmt, buf, pos + 4 + i * entry)
+        if media_time != -1:
+            total += segment_duration
+    return total or None
+
+
+def _samples(buf, stbl):
+    """
+    Return the number of samples of a track and their total size.
+    """
+    stsz = _child(buf, stbl[0], stbl[1], b'stsz')
+    if stsz is None:
+        return 0, 0
+    sample_size, count = struct.unpack_from('>II', buf, stsz[0] + 4)
+    if sample_size:
+        return count, sample_size * count
+
+    start = stsz[0] + 12
+    if start + count * 4 > stsz[1]:
+        raise Unsupported('truncated sample table')
+    sizes = array.array('I')
+    if sizes.itemsize != 4:
+        sizes = array.array('L')
+    if hasattr(sizes, 'frombytes'):
+        sizes.frombytes(buf[start:start + count * 4])
+    else:
+        sizes.fromstring(buf[start:start + count * 4])
+    if sys.byteorder == 'little':
+        sizes.byteswap()
+    return count, sum(sizes)
+
+
+def _rotation(buf, tkhd):
+    """
+    Return the clockwise rotation in degrees of the track's display matrix.
+    """
+    version, pos = _full_box(buf, tkhd)
+    pos += 32 if version == 1 else 20  # times, track id and duration
+    a, b = struct.unpack_from('>ii', buf, pos + 16)  # after layer, volume, ...
+    return int(round(math.degrees(math.atan2(b, a)))) % 360
+
+
+def _top_level_boxes(buf, size):
+    """
+    Return the (type, start, end) of the top-level boxes of an MP4 file,
+    or None if it isn't one. A truncated last box ends the list.
+    """
+    if size < 8 or buf[4:8] not in MP4_TOP_LEVEL:
+        return None
+    boxes = []
+    start = 0
+    try:
+        for typ, _, end in _boxes(buf, 0, size):
+            boxes.append((typ, start, end))
+            start = end
+    except Unsupported:
+        pass
+    return boxes
+
+
+def is_faststart(source):
+    """
+    Check if the given MP4/MOV file is 'faststart', that is if its moov
+    box (the index of the samples) comes before the media data, so it can
+    be played while downloading. Returns False for other files.
+    """
+    with open(source, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < 8:
+            return False
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for typ, _, _ in _top_level_boxes(buf, size) or ():
+            if typ == b'moov':
+                return True
+            if typ == b'mdat':
+                return False
+        return False
+    finally:
+        buf.close()
+
+
+def make_faststart(src, dst):
+    """
+    Write a copy of the MP4/MOV file src to dst with its moov box moved
+    before the media data, adjusting the chunk offsets (stco/co64 boxes).
+    The media data is copied as is, in the kernel when possible, so this
+    costs a sequential copy of the file instead of a remux. A file that
+    is already faststart is just copied. Raises ContainerError if src
+    isn't an MP4 file it can rewrite.
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise ContainerError("Can't rewrite a file in place")
+
+    with open(src, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < 8:
+            raise ContainerError('Not an MP4 file: ' + src)
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        boxes = _top_level_boxes(buf, size)
+        types = [typ for typ, _, _ in boxes or ()]
+        if b'moov' not in types or b'mdat' not in types:
+            raise ContainerError('Not an MP4 file: ' + src)
+        if boxes[-1][2] != size:
+            raise ContainerError('Truncated MP4 file: ' + src)
+        if b'moof' in types[:types.index(b'moov')]:
+            raise ContainerError('Fragmented MP4 files are not supported')
+
+        moov = boxes[types.index(b'moov')]
+        if types.index(b'moov') < types.index(b'mdat'):
+            layout = boxes
+        else:
+            # Keep the boxes preceding the media data (ftyp, ...) first.
+            head = [box for box in boxes[:types.index(b'mdat')] if box is not moov]
+            layout = head + [moov] + [box for box in boxes[len(head):] if box is not moov]
+
+        pos = 0
+        moves = []  # (old start, old end, new start) of the boxes
+        for box in layout:
+            moves.append((box[1], box[2], pos))
+            pos += box[2] - box[1]
+        moves.sort()
+
+        moov_data = bytearray(buf[moov[1]:moov[2]])
+        _patch_chunk_offsets(moov_data, moves)
+
+        _write_layout(buf, src, dst, layout, moov, moov_data)
+    finally:
+        buf.close()
+
+
+def _patch_chunk_offsets(moov, moves):
+    """
+    Rewrite the chunk offsets of the tracks in moov (a bytearray holding
+    the whole box) for the boxes moved as described by moves.
+    """
+    starts = [start for start, _, _ in moves]
+    deltas = set(new - start for start, _, new in moves)
+
+    def move(offset):
+        start, end, new = moves[bisect.bisect_right(starts, offset) - 1]
+        return offset + new - start
+
+    _, body, _ = next(_boxes(moov, 0, len(moov)))
+    if _child(moov, body, len(moov), b'cmov') is not None:
+        raise ContainerError('Compressed moov boxes are not supported')
+
+    for typ, tbody, tend in _boxes(moov, body, len(moov)):
+        if typ != b'trak':
+            continue
+        stbl = _child(moov, tbody, tend, b'mdia', b'minf', b'stbl')
+        if stbl is None:
+            continue
+        for ctyp, cbody, cend in _boxes(moov, stbl[0], stbl[1]):
+            if ctyp not in (b'stco', b'co64'):
+                continue
+            count = struct.unpack_from('>I', moov, cbody + 4)[0]
+            start = cbody + 8
+            itemsize = 4 if ctyp == b'stco' else 8
+            if start + count * itemsize > cend:
+                raise ContainerError('Truncated chunk offset table')
+
+            fmt = '>%d%s' % (count, 'I' if ctyp == b'stco' else 'Q')
+            offsets = struct.unpack_from(fmt, moov, start)
+            if len(deltas) == 1:
+                delta = next(iter(deltas))
+                offsets = [offset + delta for offset in offsets]
+            else:
+                offsets = [move(offset) for offset in offsets]
+            if ctyp == b'stco' and offsets and max(offsets) > 0xffffffff:
+                raise ContainerError('Chunk offsets overflow the stco box')
+            struct.pack_into(fmt, moov, start, *offsets)
+
+
+def _write_layout(buf, src, dst, layout, moov, moov_data):
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        with open(src, 'rb') as f:
+            for box in layout:
+                if box is moov:
+                    _write_all(fd, moov_data)
+                elif box[2] - box[1] <= 1024 * 1024:
+                    _write_all(fd, buf[box[1]:box[2]])
+                else:
+                    _copy_range(f.fileno(), fd, box[1], box[2] - box[1])
+    except BaseException:
+        os.close(fd)
+        os.unlink(dst)
+        raise
+    os.close(fd)
+
+
+def _write_all(fd, data):
+    data = memoryview(data)
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _copy_range(src_fd, dst_fd, offset, length):
+    """
+    Copy length bytes at offset of src_fd to the current position of
+    dst_fd, with copy_file_range() or sendfile() when available.
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    while length > 0:
+        count = min(length, 1 << 30)
+        try:
+            if copy_file_range is not None:
+                copied = copy_file_range(src_fd, dst_fd, count, offset)
+            elif sendfile is not None:
+                copied = sendfile(dst_fd, src_fd, offset, count)
+            else:
+                copied = _write_chunk(src_fd, dst_fd, offset, count)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+            # Not supported between these files, copy through user space.
+            copy_file_range = sendfile = None
+            continue
+        if not copied:
+            raise ContainerError('Source file truncated while copying')
+        offset += copied
+        length -= copied
+
+
+def _write_chunk(src_fd, dst_fd, offset, count):
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    data = os.read(src_fd, min(count, 1024 * 1024))
+    _write_all(dst_fd, data)
+    return len(data)
+
+
+# Matroska / WebM
+
+EBML = 0x1A45DFA3
+DOC_TYPE = 0x4282
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+DURATION = 0x4489
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_TYPE = 0x83
+CODEC_ID = 0x86
+DEFAULT_DURATION = 0x23E383
+LANGUAGE = 0x22B59C
+NAME = 0x536E
+VIDEO = 0xE0
+PIXEL_WIDTH = 0xB0
+PIXEL_HEIGHT = 0xBA
+AUDIO = 0xE1
+SAMPLING_FREQUENCY = 0xB5
+CHANNELS = 0x9F
+ATTACHMENTS = 0x1941A469
+CLUSTER = 0x1F43B675
+
+
+def _vint(buf, pos, keep_marker):
+    """
+    Read an EBML variable size integer. Returns its value (None for
+    unknown sizes) and the position after it.
+    """
+    first = struct.unpack_from('>B', buf, pos)[0]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise Unsupported('invalid EBML integer')
+    value = first if keep_marker else first & (0xff >> length)
+    for i in range(1, length):
+        value = (value << 8) | struct.unpack_from('>B', buf, pos + i)[0]
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        value = None
+    return value, pos + length
+
+
+def _elements(buf, start, end):
+    """
+    Yield the (id, data start, data end) of the EBML elements between
+    start and end.
+    """
+    pos = start
+    while pos < end:
+        eid, pos = _vint(buf, pos, True)
+        size, pos = _vint(buf, pos, False)
+        if size is None:
+            if eid not in (SEGMENT, CLUSTER):
+                raise Unsupported('element of unknown size')
+            size = end - pos
+        if pos + size > end:
+            if eid == CLUSTER:
+                return
+            raise Unsupported('truncated element')
+        yield eid, pos, pos + size
+        pos += size
+
+
+def _uint(buf, start, end):
+    value = 0
+    for i in range(start, end):
+        value = (value << 8) | struct.unpack_from('>B', buf, i)[0]
+    return value
+
+
+def _float(buf, start, end):
+    if end - start == 4:
+        return struct.unpack_from('>f', buf, start)[0]
+    if end - start == 8:
+        return struct.unpack_from('>d', buf, start)[0]
+    raise Unsupported('invalid float')
+
+
+def _string(buf, start, end):
+    return buf[start:end].rstrip(b'\0').decode('utf-8', 'replace')
+
+
+def _read_matroska(buf, size):
+    elements = _elements(buf, 0, size)
+    eid, start, end = next(elements)
+    doc_type = None
+    for child, cstart, cend in _elements(buf, start, end):
+        if child == DOC_TYPE:
+            doc_type = _string(buf, cstart, cend)
+    if doc_type not in ('matroska', 'webm'):
+        raise Unsupported('not a Matroska file')
+
+    for eid, start, end in elements:
+        if eid == SEGMENT:
+            break
+    else:
+        raise Unsupported('no segment')
+
+    # Info and Tracks are usually before the first cluster, otherwise the
+    # seek head tells where they are.
+    found = {}
+    seeks = {}
+    for eid, cstart, cend in _elements(buf, start, end):
+        if eid in (INFO, TRACKS):
+            found[eid] = (cstart, cend)
+        elif eid == ATTACHMENTS:
+            raise Unsupported('attachments')
+        elif eid == SEEK_HEAD:
+            seeks.update(_seek_head(buf, cstart, cend))
+        elif eid == CLUSTER:
+            break
+    if ATTACHMENTS in seeks:
+        raise Unsupported('attachments')
+    for eid in (INFO, TRACKS):
+        if eid not in found and eid in seeks:
+            for child, cstart, cend in _elements(buf, start + seeks[eid], end):
+                found[eid] = (cstart, cend)
+                break
+    if INFO not in found or TRACKS not in found:
+        raise Unsupported('no info or tracks')
+
+    scale = 1000000
+    duration = None
+    for eid, cstart, cend in _elements(buf, *found[INFO]):
+        if eid == TIMECODE_SCALE:
+            scale = _uint(buf, cstart, cend)
+        elif eid == DURATION:
+            duration = _float(buf, cstart, cend)
+    if not duration:
+        raise Unsupported('no duration')
+
+    streams = []
+    for eid, cstart, cend in _elements(buf, *found[TRACKS]):
+        if eid == TRACK_ENTRY:
+            streams.append(_read_track_entry(buf, cstart, cend, len(streams)))
+    if not streams:
+        raise Unsupported('no tracks')
+
+    fmt = {'format_name': 'matroska,webm', 'format_long_name': 'Matroska / WebM',
+           'nb_streams': len(streams), 'duration': '%.6f' % (duration * scale / 1e9),
+           'tags': {}}
+    return {'format': fmt, 'streams': streams}
+
+
+def _seek_head(buf, start, end):
+    seeks = {}
+    for eid, sstart, send in _elements(buf, start, end):
+        if eid != SEEK:
+            continue
+        target = position = None
+        for child, cstart, cend in _elements(buf, sstart, send):
+            if child == SEEK_ID:
+                target = _uint(buf, cstart, cend)
+            elif child == SEEK_POSITION:
+                position = _uint(buf, cstart, cend)
+        if target is not None and position is not None:
+            seeks[target] = position
+    return seeks
+
+
+def _read_track_entry(buf, start, end, index):
+    fields = {LANGUAGE: 'eng'}
+    for eid, cstart, cend in _elements(buf, start, end):
+        if eid in (TRACK_TYPE, DEFAULT_DURATION):
+            fields[eid] = _uint(buf, cstart, cend)
+        elif eid in (CODEC_ID, LANGUAGE, NAME):
+            fields[eid] = _string(buf, cstart, cend)
+        elif eid in (VIDEO, AUDIO):
+            for child, ccstart, ccend in _elements(buf, cstart, cend):
+                if child in (PIXEL_WIDTH, PIXEL_HEIGHT, CHANNELS):
+                    fields[child] = _uint(buf, ccstart, ccend)
+                elif child == SAMPLING_FREQUENCY:
+                    fields[child] = _float(buf, ccstart, ccend)
+
+    codec_type = MKV_TRACK_TYPES.get(fields.get(TRACK_TYPE))
+    codec_name = MKV_CODECS.get(fields.get(CODEC_ID))
+    if codec_type is None or codec_name is None:
+        raise Unsupported('unsupported track')
+
+    stream = _stream(index, codec_type, codec_name)
+    stream['time_base'] = '1/1000'
+    if fields[LANGUAGE] != 'und':
+        stream['tags']['language'] = fields[LANGUAGE]
+    if NAME in fields:
+        stream['tags']['title'] = fields[NAME]
+    if codec_type == 'video':
+        if PIXEL_WIDTH not in fields or PIXEL_HEIGHT not in fields:
+            raise Unsupported('no video dimensions')
+        stream['width'] = fields[PIXEL_WIDTH]
+        stream['height'] = fields[PIXEL_HEIGHT]
+        if DEFAULT_DURATION in fields:
+            stream['avg_frame_rate'] = stream['r_frame_rate'] = _rate(1000000000, fields[DEFAULT_DURATION])
+    elif codec_type == 'audio':
+        stream['channels'] = fields.get(CHANNELS, 1)
+        stream['sample_rate'] = str(int(fields.get(SAMPLING_FREQUENCY, 8000.0)))
+    return stream
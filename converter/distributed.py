@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+"""
+Encode a title in chunks on several hosts sharing a filesystem.
+
+The Coordinator splits the conversion into chunks like
+Converter.convert(..., chunks=N) does, and writes a job for each chunk
+into a queue directory. Workers running on any host that can reach the
+queue directory, and the source file at the same path, claim the jobs,
+encode the chunks and commit them back into the queue. The coordinator
+then joins them into the output file:
+
+    >>> # on each worker host
+    >>> Worker('/mnt/shared/queue').run()
+
+    >>> # on the coordinator
+    >>> job = Coordinator('/mnt/shared/queue').convert('/mnt/shared/title.mov', '/tmp/output.mp4',
+    ...                                                options, chunks=32)
+    >>> for percent in job:
+    ...     pass
+
+The queue only relies on exclusive file creation and atomic renames.
+Each title is a directory of the queue:
+
+    jobs/NNNN.json    the source, options and duration of chunk NNNN
+    leases/NNNN.G     generation G of the lease of the worker encoding the
+                      chunk, with its progress
+    done/NNNN.mkv     the encoded chunks
+    failed/NNNN.json  the error of the chunks that failed too many times
+    tmp/              the chunks being encoded
+
+A worker refreshes its lease every few seconds while it encodes a chunk.
+A lease that wasn't refreshed for lease_timeout seconds is taken over by
+another worker, so the chunks of a worker that died are encoded again;
+at worst a chunk is encoded twice. Taking a lease over creates its next
+generation, exclusively, so only one worker wins it, and the newest
+generation is the lease: the worker holding an older one stops refreshing
+it. The generations are never removed, so none is created twice. The
+clocks of the hosts need to be in sync for the leases to expire at the
+right time.
+"""
+
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+from converter import Converter, ConverterError, FFMpegJob
+
+logger = logging.getLogger(__name__)
+
+
+def _write_json(path, data):
+    """
+    Write data to path atomically, so readers never see a partial file.
+    """
+    tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
+
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _listdir(path):
+    try:
+        return sorted(name for name in os.listdir(path) if not name.startswith('.'))
+    except OSError:
+        return []
+
+
+class Coordinator(object):
+    """
+    Splits conversions into chunk jobs written into the queue directory
+    queue_dir, waits for workers to encode them and joins the result. The
+    converter, which defaults to a new Converter, probes the source and
+    validates the options.
+    """
+
+    def __init__(self, queue_dir, converter=None, poll_interval=1):
+        self.queue_dir = queue_dir
+        self.converter = converter or Converter()
+        self.poll_interval = poll_interval
+        if not os.path.isdir(queue_dir):
+            os.makedirs(queue_dir)
+
+    def convert(self, infile, outfile, options, chunks, chunk_retries=1, timeout=10, nice=None,
+                stall_timeout=None, deadline=None, info=None):
+        """
+        Convert infile to outfile like Converter.convert(), with the video
+        encoded in chunks by the workers. A chunk that fails is encoded
+        again, by any worker, up to chunk_retries times; after that the
+        conversion fails with ConverterError. A source without video, or
+        a video stream that is copied, is converted locally in one go.
+
+        Returns a job (see converter.ffmpeg.FFMpegJob) yielding the
+        percentage done, which is updated as the workers report their
+        progress. timeout, nice, stall_timeout and deadline apply to the
+        ffmpeg processes run by the coordinator; deadline also limits how
+        long it waits for the workers, after which the conversion fails
+        with ConverterError. The chunk jobs are removed from the queue when
+        the job finishes or is closed.
+        """
+        return FFMpegJob(self.converter.ffmpeg, self._convert, infile, outfile, options, chunks, chunk_retries,
+                         timeout, nice, stall_timeout, deadline, info)
+
+    def _convert(self, job, infile, outfile, options, chunks, chunk_retries, timeout, nice, stall_timeout,
+                 deadline, info):
+        converter = self.converter
+        if not isinstance(options, dict):
+            raise ConverterError('Invalid options')
+        if 'map' in options:
+            raise ConverterError('The map option is not supported with chunks')
+
+        if not os.path.exists(infile):
+            raise ConverterError("Source file doesn't exist: " + infile)
+
+        info = converter.ffmpeg._source_info(infile, info)
+        if info is None:
+            raise ConverterError("Can't get information about source file")
+
+        if info.video is None or options.get('video', {}).get('codec') in (None, 'copy'):
+            for percent in converter._convert(job, infile, outfile, options, False, timeout, nice, None, False,
+                                              None, stall_timeout, deadline, info):
+                yield percent
+            return
+
+        options, duration = converter._source_options(info, options)
+        parts = converter._chunk_options(infile, options, info, duration, chunks)
+        for opts, _ in parts:
+            converter.parse_options(opts)
+
+        title_dir = self._submit(os.path.abspath(infile), parts, chunk_retries)
+        try:
+            last = 0
+            for percent in self._wait(title_dir, parts, duration, deadline):
+                if percent > last:
+                    last = percent
+                    yield percent
+
+            outfiles = [os.path.join(title_dir, 'done', '%04d.mkv' % i) for i in range(len(parts))]
+            for _ in converter._join_chunks(job, outfiles, outfile, options, info, timeout, nice,
+                                            stall_timeout, deadline):
+                pass
+            yield 100
+        finally:
+            shutil.rmtree(title_dir, ignore_errors=True)
+
+    def _submit(self, infile, parts, retries):
+        """
+        Write the chunk jobs of a title into the queue. The title directory
+        is filled in under a hidden name and then renamed, so the workers
+        never see it incomplete.
+        """
+        title = '%d-%s' % (time.time() * 1000, uuid.uuid4().hex[:8])
+        tmp_dir = os.path.join(self.queue_dir, '.' + title)
+        for name in ('jobs', 'leases', 'done', 'failed', 'tmp'):
+            os.makedirs(os.path.join(tmp_dir, name))
+        for i, (opts, chunk_duration) in enumerate(parts):
+            _write_json(os.path.join(tmp_dir, 'jobs', '%04d.json' % i),
+                        {'infile': infile, 'options': opts, 'duration': chunk_duration,
+                         'retries': retries, 'attempts': 0})
+
+        title_dir = os.path.join(self.queue_dir, title)
+        os.rename(tmp_dir, title_dir)
+        return title_dir
+
+    def _wait(self, title_dir, parts, duration, deadline):
+        """
+        Yield the percentage of the video encoded by the workers until
+        all the chunks are done, or deadline seconds have passed.
+        """
+        started = time.time()
+        while True:
+            for name in _listdir(os.path.join(title_dir, 'failed')):
+                error = _read_json(os.path.join(title_dir, 'failed', name))
+                raise ConverterError('Chunk %s failed on %s: %s' % (name[:-5], error['worker'], error['error']))
+
+            done = set(_listdir(os.path.join(title_dir, 'done')))
+            if len(done) == len(parts):
+                return
+
+            encoded = 0.0
+            for i, (_, chunk_duration) in enumerate(parts):
+                if chunk_duration is None:
+                    continue
+                if '%04d.mkv' % i in done:
+                    encoded += chunk_duration
+                else:
+                    encoded += min(Worker._lease_progress(os.path.join(title_dir, 'leases', '%04d' % i)),
+                                   chunk_duration)
+            yield int((99.0 * encoded) / duration)
+
+            if deadline and time.time() - started >= deadline:
+                raise ConverterError('Deadline of %s seconds exceeded' % deadline)
+            time.sleep(self.poll_interval)
+
+
+class Worker(object):
+    """
+    Claims chunk jobs from the queue directory queue_dir and encodes them
+    with the converter (a new Converter by default). Any number of
+    workers, on any number of hosts, can share a queue.
+
+    lease_timeout is how long a lease lives without being refreshed; it
+    is refreshed four times as often. timeout, nice, stall_timeout and
+    deadline apply to the ffmpeg processes encoding the chunks (see
+    Converter.convert()).
+    """
+
+    def __init__(self, queue_dir, converter=None, lease_timeout=60, worker_id=None, timeout=10, nice=None,
+                 stall_timeout=None, deadline=None):
+        self.queue_dir = queue_dir
+        self.converter = converter or Converter()
+        self.lease_timeout = lease_timeout
+        self.worker_id = worker_id or '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+        self.timeout = timeout
+        self.nice = nice
+        self.stall_timeout = stall_timeout
+        self.deadline = deadline
+        self.job = None
+        self._stopping = threading.Event()
+
+    def run(self, poll_interval=1, idle_timeout=None):
+        """
+        Encode chunks until stop() is called or, if idle_timeout is set,
+        there was nothing to encode for that many seconds.
+        """
+        idle_since = time.time()
+        while not self._stopping.is_set():
+            if self.run_once():
+                idle_since = time.time()
+                continue
+            if idle_timeout is not None and time.time() - idle_since >= idle_timeout:
+                return
+            self._stopping.wait(poll_interval)
+
+    def run_once(self):
+        """
+        Claim and encode one chunk. Returns False if there was nothing to
+        encode.
+        """
+        claim = self._claim()
+        if claim is None:
+            return False
+        self._encode(*claim)
+        return True
+
+    def stop(self):
+        """
+        Stop the worker, abandoning the chunk being encoded, if any, to
+        another worker.
+        """
+        self._stopping.set()
+        job = self.job
+        if job is not None:
+            job.terminate()
+
+    def _claim(self):
+        """
+        Take the lease of the first chunk that isn't done or leased, oldest
+        titles first. Returns the title directory, chunk name and lease
+        generation, or None.
+        """
+        for title in _listdir(self.queue_dir):
+            title_dir = os.path.join(self.queue_dir, title)
+            for name in _listdir(os.path.join(title_dir, 'jobs')):
+                chunk = name[:-5]
+                if self._finished(title_dir, chunk):
+                    continue
+                lease = self._acquire(os.path.join(title_dir, 'leases', chunk))
+                if lease is None:
+                    continue
+                # The chunk may have been committed by the previous holder
+                # of an expired lease.
+                if self._finished(title_dir, chunk):
+                    self._release(lease)
+                    continue
+                return title_dir, chunk, lease
+        return None
+
+    @staticmethod
+    def _finished(title_dir, chunk):
+        return (os.path.exists(os.path.join(title_dir, 'done', chunk + '.mkv')) or
+                os.path.exists(os.path.join(title_dir, 'failed', chunk + '.json')))
+
+    def _acquire(self, lease):
+        """
+        Take lease, if it isn't held or has expired, by creating its next
+        generation. Returns the path of the generation, or None.
+        """
+        generations = self._generations(lease)
+        generation = 0
+        if generations:
+            generation, path = generations[-1]
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                return None
+            if time.time() - mtime < self.lease_timeout:
+                return None
+            if mtime:
+                logger.warning('taking over expired lease %s', path)
+            generation += 1
+
+        path = '%s.%d' % (lease, generation)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except OSError:
+            # another worker took this generation first
+            return None
+        os.write(fd, ('%s 0\n' % self.worker_id).encode('utf-8'))
+        os.close(fd)
+        return path
+
+    def _heartbeat(self, path, timecode):
+        """
+        Refresh the lease generation at path with the progress of the
+        chunk. Returns False if the lease was taken over: a newer
+        generation exists, and this one doesn't count any more.
+        """
+        lease, _, generation = path.rpartition('.')
+        if self._generations(lease)[-1:] != [(int(generation), path)]:
+            return False
+        with open(path, 'r+') as f:
+            f.write('%s %.3f\n' % (self.worker_id, timecode))
+            f.truncate()
+        return True
+
+    @staticmethod
+    def _release(path):
+        """
+        Give the lease generation at path up by making it expired.
+        """
+        try:
+            os.utime(path, (0, 0))
+        except OSError:
+            pass
+
+    @staticmethod
+    def _generations(lease):
+        """
+        Return the generations of lease as sorted (generation, path) pairs.
+        """
+        directory, name = os.path.split(lease)
+        generations = []
+        for entry in _listdir(directory):
+            base, _, generation = entry.rpartition('.')
+            if base == name and generation.isdigit():
+                generations.append((int(generation), os.path.join(directory, entry)))
+        return sorted(generations)
+
+    @staticmethod
+    def _lease_progress(lease):
+        """
+        Return the timecode reached by the worker holding lease, or 0.
+        """
+        generations = Worker._generations(lease)
+        if not generations:
+            return 0.0
+        try:
+            with open(generations[-1][1]) as f:
+                return float(f.read().split()[-1])
+        except (IOError, OSError, ValueError, IndexError):
+            return 0.0
+
+    def _encode(self, title_dir, chunk, lease):
+        job_path = os.path.join(title_dir, 'jobs', chunk + '.json')
+        tmp = os.path.join(title_dir, 'tmp', '%s-%s.mkv' % (chunk, uuid.uuid4().hex[:8]))
+        progress = [0.0]
+        beating = threading.Event()
+
+        def beat():
+            while not beating.wait(self.lease_timeout / 4.0):
+                try:
+                    if not self._heartbeat(lease, progress[0]):
+                        logger.warning('lost lease %s to another worker', lease)
+                        return
+                except (IOError, OSError):
+                    pass
+
+        heartbeat = threading.Thread(target=beat)
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            data = _read_json(job_path)
+            optlist = self.converter.parse_options(data['options'])
+            self.job = self.converter.ffmpeg.convert(data['infile'], tmp, optlist, timeout=self.timeout,
+                                                     nice=self.nice, stall_timeout=self.stall_timeout,
+                                                     deadline=self.deadline)
+            for timecode in self.job:
+                progress[0] = timecode
+            os.rename(tmp, os.path.join(title_dir, 'done', chunk + '.mkv'))
+            logger.info('encoded chunk %s of %s', chunk, title_dir)
+        except Exception as e:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            if self._stopping.is_set() or not os.path.isdir(title_dir):
+                return
+            logger.exception('error encoding chunk %s of %s', chunk, title_dir)
+            self._failed(title_dir, chunk, job_path, e)
+        finally:
+            self.job = None
+            beating.set()
+            heartbeat.join()
+            self._release(lease)
+
+    def _failed(self, title_dir, chunk, job_path, error):
+        """
+        Count a failed attempt at encoding the chunk, and mark it failed
+        once it has no retries left.
+        """
+        try:
+            data = _read_json(job_path)
+            data['attempts'] += 1
+            if data['attempts'] > data['retries']:
+                _write_json(os.path.join(title_dir, 'failed', chunk + '.json'),
+                            {'worker': self.worker_id, 'error': str(error)})
+            else:
+                _write_json(job_path, data)
+        except (IOError, OSError, ValueError):
+            pass
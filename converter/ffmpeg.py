@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 
+import collections
+import errno
+import io
+import multiprocessing
 import os.path
 import os
 import re
-import signal
+import select
+import sys
+import tempfile
+import threading
 from urllib3.util import parse_url
 from subprocess import Popen, PIPE
 import logging
@@ -11,10 +18,48 @@ import locale
 import json
 import time
 
+from converter import capabilities
+from converter.containers import read_header
+from converter.formats import RawvideoFormat
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 logger = logging.getLogger(__name__)
 
 console_encoding = locale.getdefaultlocale()[1] or 'UTF-8'
 
+STATS_TIME_RE = re.compile(r'time=([0-9.:]+)')
+CROP_RE = re.compile(r'crop=(\d{1,4}):(\d{1,4}):(\d{1,3}):(\d{1,3})')
+
+
+_which_cache = {}
+
+
+def _which(name):
+    """
+    Find the executable name in $PATH, remembering where it was found.
+    """
+    path = os.environ.get('PATH', os.defpath)
+    key = (name, path)
+    fpath = _which_cache.get(key)
+    if fpath is not None and os.path.exists(fpath):
+        return fpath
+
+    for d in path.split(':'):
+        fpath = os.path.join(d, name)
+        if os.path.exists(fpath) and os.access(fpath, os.X_OK):
+            _which_cache[key] = fpath
+            return fpath
+    return None
+
 
 class FFMpegError(Exception):
     pass
@@ -59,6 +104,1045 @@ class FFMpegConvertError(Exception):
         return self.__repr__()
 
 
+class FFMpegTimeoutError(FFMpegConvertError):
+    """
+    Raised when the watchdog stops an ffmpeg process that stopped
+    reporting back, stopped making progress or ran past its deadline.
+    """
+    pass
+
+
+class FFMpegProgress(float):
+    """
+    Progress update parsed from the key=value blocks ffmpeg writes with
+    the -progress option.
+
+    The float value is the output timecode in seconds, so a progress
+    record can be used wherever a plain timecode is expected. The other
+    fields are None when ffmpeg reports them as N/A:
+      * frame (int) - number of frames written so far
+      * fps (float) - current encoding speed in frames per second
+      * bitrate (float) - current output bitrate in kbit/s
+      * speed (float) - encoding speed relative to realtime
+      * total_size (int) - bytes written to the output so far
+      * status (string) - 'continue', or 'end' for the last update
+    """
+    __slots__ = ('frame', 'fps', 'bitrate', 'speed', 'total_size', 'status')
+
+    def __new__(cls, out_time=0.0, frame=None, fps=None, bitrate=None,
+                speed=None, total_size=None, status=None):
+        self = super(FFMpegProgress, cls).__new__(cls, out_time)
+        self.frame = frame
+        self.fps = fps
+        self.bitrate = bitrate
+        self.speed = speed
+        self.total_size = total_size
+        self.status = status
+        return self
+
+    @property
+    def out_time(self):
+        return float(self)
+
+    def __repr__(self):
+        return ('FFMpegProgress(out_time=%.2f, frame=%s, fps=%s, bitrate=%s, '
+                'speed=%s, total_size=%s, status=%s)' %
+                (self, self.frame, self.fps, self.bitrate, self.speed,
+                 self.total_size, self.status))
+
+
+class ProgressParser(object):
+    """
+    Incremental parser for ffmpeg -progress output. Feed it raw chunks as
+    they are read from the progress pipe; every complete block is returned
+    as a FFMpegProgress record.
+    """
+
+    def __init__(self):
+        self._tail = b''
+        self._block = {}
+
+    def feed(self, data):
+        lines = (self._tail + data).split(b'\n')
+        self._tail = lines.pop()
+
+        records = []
+        for line in lines:
+            key, sep, value = line.decode('ascii', 'ignore').partition('=')
+            if not sep:
+                continue
+            key = key.strip()
+            value = value.strip()
+            if key == 'progress':
+                records.append(self._record(self._block, value))
+                self._block = {}
+            else:
+                self._block[key] = value
+        return records
+
+    @staticmethod
+    def _record(block, status):
+        def number(key, typ, suffix=''):
+            value = block.get(key, '')
+            if suffix and value.endswith(suffix):
+                value = value[:-len(suffix)]
+            try:
+                return typ(value)
+            except ValueError:
+                return None
+
+        # out_time_ms is in microseconds as well (a long-standing ffmpeg quirk)
+        out_time = number('out_time_us', int)
+        if out_time is None:
+            out_time = number('out_time_ms', int)
+        if out_time is not None:
+            out_time /= 1000000.0
+        else:
+            try:
+                out_time = timecode_to_seconds(block.get('out_time', ''))
+            except ValueError:
+                out_time = 0.0
+
+        return FFMpegProgress(
+            max(out_time, 0.0),
+            frame=number('frame', int),
+            fps=number('fps', float),
+            bitrate=number('bitrate', float, 'kbits/s'),
+            speed=number('speed', float, 'x'),
+            total_size=number('total_size', int),
+            status=status,
+        )
+
+
+try:
+    _intern = intern
+except NameError:
+    from sys import intern as _intern
+
+
+def _json_object(pairs):
+    """
+    JSON object hook sharing the key strings of all the probe results.
+    """
+    obj = {}
+    for key, value in pairs:
+        try:
+            key = _intern(str(key))
+        except UnicodeError:
+            pass
+        obj[key] = value
+    return obj
+
+
+def _clean_value(value):
+    """
+    Convert an ffprobe value the way probe() results always did for
+    dict-style access: numeric strings become numbers, fractions are
+    divided, other strings are stripped.
+    """
+    if isinstance(value, dict):
+        return dict((key, _clean_value(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_clean_value(item) for item in value]
+    if not isinstance(value, basestring):
+        return value
+    try:
+        if '/' in value:
+            n, d = value.split('/', 1)
+            return float(n) / float(d)
+        elif '.' in value:
+            return float(value)
+        return int(value)
+    except ZeroDivisionError:
+        return 0
+    except ValueError:
+        return value.strip()
+
+
+def _number(value, typ=float):
+    """
+    Convert an ffprobe value to typ, None if it's missing or invalid.
+    """
+    value = _clean_value(value)
+    if isinstance(value, (int, long, float)):
+        return typ(value)
+    return None
+
+
+class _field(object):
+    """
+    Typed field of a probe record, computed from the raw ffprobe data on
+    first access and then kept in the record's slot.
+    """
+
+    def __init__(self, compute):
+        self.compute = compute
+        self.slot = '_' + compute.__name__
+        self.__doc__ = compute.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            value = self.compute(obj)
+            setattr(obj, self.slot, value)
+            return value
+
+
+class _ProbeRecord(object):
+    """
+    Base of the probe result classes: wraps the raw ffprobe data and
+    gives dict-style access to it, as probe() used to return plain dicts.
+    Keys derived from the raw data in those dicts (like 'codec', 'fps' or
+    'bitrate', in their original units) are computed by _derived().
+
+    The values are cleaned up on first access and then kept, so they can
+    be modified in place like the dicts' (info['video']['tags']['x'] = 1),
+    and keys can be set. The changes don't touch the raw data: they are
+    not compared or pickled.
+    """
+    __slots__ = ('_raw', '_values')
+    _derived_keys = ()
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._values = {}
+
+    def _derived(self, key):
+        raise KeyError(key)
+
+    def _item(self, key):
+        if key in self._derived_keys:
+            try:
+                return self._derived(key)
+            except KeyError:
+                pass
+        return _clean_value(self._raw[key])
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            value = self._values[key] = self._item(key)
+            return value
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def keys(self):
+        keys = list(self._raw)
+        keys.extend(key for key in self._derived_keys if key not in self._raw and key in self)
+        keys.extend(key for key in self._values if key not in keys)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._raw == other._raw
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return type(self), (self._raw,)
+
+
+class MediaFormatInfo(_ProbeRecord):
+    """
+    Describes the media container format. The attributes are:
+      * format - format (short) name (eg. "ogg")
+      * fullname - format full (descriptive) name
+      * bitrate - total bitrate (bps)
+      * duration - media duration in seconds
+      * filesize - file size
+      * metadata - dict of the container tags
+    """
+    __slots__ = ('_format', '_fullname', '_bitrate', '_duration', '_filesize', '_metadata')
+    _derived_keys = ('bitrate',)
+
+    @_field
+    def format(self):
+        return self._raw.get('format_name')
+
+    @_field
+    def fullname(self):
+        return self._raw.get('format_long_name')
+
+    @_field
+    def bitrate(self):
+        return _number(self._raw.get('bit_rate'), int)
+
+    @_field
+    def duration(self):
+        return _number(self._raw.get('duration'))
+
+    @_field
+    def filesize(self):
+        return _number(self._raw.get('size'), int)
+
+    @_field
+    def metadata(self):
+        return self._raw.get('tags', {})
+
+    def _derived(self, key):
+        if self.bitrate is None:
+            raise KeyError(key)
+        return round(self.bitrate / 1000.0 / 1000, 1)
+
+    def __repr__(self):
+        if self.duration is None:
+            return 'MediaFormatInfo(format=%s)' % self.format
+        return 'MediaFormatInfo(format=%s, duration=%.2f)' % (self.format, self.duration)
+
+
+class MediaStreamInfo(_ProbeRecord):
+    """
+    Describes one stream inside a media file. The general attributes are:
+      * index - stream index inside the container (0-based)
+      * type - stream type, either 'audio', 'video' or 'subtitle'
+      * codec - codec (short) name (e.g "vorbis", "theora")
+      * codec_desc - codec full (descriptive) name
+      * duration - stream duration in seconds
+      * bitrate - stream bitrate in bps
+      * attached_pic - 1 if the stream is a poster image
+      * metadata - dict of the stream tags
+
+    Video-specific attributes are:
+      * video_width - width of video in pixels
+      * video_height - height of video in pixels
+      * video_fps - average frames per second
+      * profile - codec profile
+
+    Audio-specific attributes are:
+      * audio_channels - the number of channels in the stream
+      * audio_samplerate - sample rate (Hz)
+    """
+    __slots__ = ('_index', '_type', '_codec', '_codec_desc', '_duration', '_bitrate', '_attached_pic',
+                 '_metadata', '_video_width', '_video_height', '_video_fps', '_profile',
+                 '_audio_channels', '_audio_samplerate')
+    _derived_keys = ('codec', 'samplerate', 'bitrate', 'fps', 'profile', 'level')
+
+    @_field
+    def index(self):
+        return self._raw.get('index')
+
+    @_field
+    def type(self):
+        return self._raw.get('codec_type')
+
+    @_field
+    def codec(self):
+        codec = self._raw.get('codec_name')
+        if codec is None:
+            return None
+        if 'aac' in codec:
+            return 'aac'
+        return codec.lower()
+
+    @_field
+    def codec_desc(self):
+        return self._raw.get('codec_long_name')
+
+    @_field
+    def duration(self):
+        return _number(self._raw.get('duration'))
+
+    @_field
+    def bitrate(self):
+        return _number(self._raw.get('bit_rate'), int)
+
+    @_field
+    def attached_pic(self):
+        return self._raw.get('disposition', {}).get('attached_pic', 0)
+
+    @_field
+    def metadata(self):
+        return self._raw.get('tags', {})
+
+    @_field
+    def video_width(self):
+        return _number(self._raw.get('width'), int)
+
+    @_field
+    def video_height(self):
+        return _number(self._raw.get('height'), int)
+
+    @_field
+    def video_fps(self):
+        return (_number(self._raw.get('avg_frame_rate'))
+                or _number(self._raw.get('r_frame_rate')) or None)
+
+    @_field
+    def profile(self):
+        return self._raw.get('profile')
+
+    @_field
+    def audio_channels(self):
+        return _number(self._raw.get('channels'), int)
+
+    @_field
+    def audio_samplerate(self):
+        return _number(self._raw.get('sample_rate'), int)
+
+    def _derived(self, key):
+        raw = self._raw
+        if key == 'codec' and self.codec is not None:
+            return self.codec
+        if self.type == 'audio':
+            if key == 'samplerate' and self.audio_samplerate is not None:
+                return self.audio_samplerate
+            if key == 'bitrate' and self.bitrate is not None:
+                return round(self.bitrate / 1000.0)
+        elif self.type == 'video':
+            if key == 'bitrate' and self.bitrate is not None:
+                return round(self.bitrate / 1000.0 / 1000, 1)
+            if key == 'fps' and 'avg_frame_rate' in raw:
+                return round(_clean_value(raw['avg_frame_rate']), 2)
+            if key == 'profile' and 'profile' in raw:
+                return _clean_value(raw['profile']).lower()
+            if key == 'level' and 'level' in raw:
+                return round(_clean_value(raw['level']) / 10.0, 1)
+        raise KeyError(key)
+
+    def __repr__(self):
+        if self.type == 'audio':
+            d = 'type=%s, codec=%s, channels=%s, rate=%s' % (
+                self.type, self.codec, self.audio_channels, self.audio_samplerate)
+        elif self.type == 'video':
+            d = 'type=%s, codec=%s, width=%s, height=%s, fps=%s' % (
+                self.type, self.codec, self.video_width, self.video_height, self.video_fps)
+        else:
+            d = 'type=%s, codec=%s' % (self.type, self.codec)
+        if self.bitrate is not None:
+            d += ', bitrate=%d' % self.bitrate
+        if self.metadata:
+            d += ', ' + ', '.join('%s=%s' % item for item in self.metadata.items())
+        return 'MediaStreamInfo(%s)' % d
+
+
+class MediaInfo(_ProbeRecord):
+    """
+    Information about the media file, as returned by FFMpeg.probe():
+      * format - a MediaFormatInfo
+      * streams - the list of MediaStreamInfo
+      * video, audio - the first video (not counting poster images unless
+        probed with posters_as_video) and audio streams, or None
+      * posters - the poster image streams
+
+    The fields are read from the raw ffprobe output when first used. For
+    compatibility, the info can also be used as the dict probe() used to
+    return, e.g. info['video']['width'] or info['format']['duration'].
+    """
+    __slots__ = ('posters_as_video', '_format', '_streams')
+
+    def __init__(self, raw, posters_as_video=False):
+        super(MediaInfo, self).__init__(raw)
+        self.posters_as_video = posters_as_video
+
+    @_field
+    def format(self):
+        return MediaFormatInfo(self._raw.get('format', {}))
+
+    @_field
+    def streams(self):
+        return [MediaStreamInfo(stream) for stream in self._raw.get('streams', [])]
+
+    @property
+    def video(self):
+        for stream in self.streams:
+            if stream.type == 'video' and (self.posters_as_video or not stream.attached_pic):
+                return stream
+        return None
+
+    @property
+    def audio(self):
+        return self.stream('audio')
+
+    @property
+    def posters(self):
+        return [stream for stream in self.streams if stream.attached_pic]
+
+    def stream(self, typ):
+        """
+        Return the first stream of the given type, or None.
+        """
+        if typ == 'video':
+            return self.video
+        for stream in self.streams:
+            if stream.type == typ:
+                return stream
+        return None
+
+    def _item(self, key):
+        if key == 'format':
+            return self.format
+        if key in ('streams', 'posters'):
+            return getattr(self, key)
+        if key == 'container' and 'format_name' in self.format._raw:
+            return self.format.format.lower().split(',')
+        if key == 'extension' and 'filename' in self.format._raw:
+            return os.path.splitext(self.format._raw['filename'])[1][1:].lower()
+
+        streams = [stream for stream in self.streams if stream.type + 's' == key]
+        if streams:
+            return streams
+        stream = self.stream(key)
+        if stream is not None:
+            return stream
+        raise KeyError(key)
+
+    def keys(self):
+        keys = ['format', 'streams', 'posters', 'container', 'extension']
+        for stream in self.streams:
+            keys.extend([stream.type, stream.type + 's'])
+        keys.extend(self._values)
+        return [key for i, key in enumerate(keys) if key not in keys[:i] and key in self]
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and self._raw == other._raw
+                and self.posters_as_video == other.posters_as_video)
+
+    def __reduce__(self):
+        return MediaInfo, (self._raw, self.posters_as_video)
+
+    def __repr__(self):
+        return 'MediaInfo(format=%r, streams=%r)' % (self.format, self.streams)
+
+
+class OutputCapture(object):
+    """
+    Bounded capture of ffmpeg's stderr output.
+
+    Only the last tail_size bytes are kept in memory, which is enough for
+    error messages and the summaries printed at the end of a run. Complete
+    lines are passed to the line handlers as they arrive, so per-frame
+    output (cropdetect, ebur128, ...) can be parsed incrementally, and the
+    whole output can optionally be spilled to a file at spill_path.
+    """
+
+    def __init__(self, tail_size=256 * 1024, line_handler=None, spill_path=None):
+        self.tail_size = tail_size
+        self.spill_path = spill_path
+        self.line_handlers = [line_handler] if line_handler else []
+        self.total_size = 0
+        self._chunks = collections.deque()
+        self._size = 0
+        self._partial = b''
+        self._spill = None
+
+    def add_line_handler(self, handler):
+        self.line_handlers.append(handler)
+
+    def write(self, data):
+        self.total_size += len(data)
+
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size - len(self._chunks[0]) >= self.tail_size:
+            self._size -= len(self._chunks.popleft())
+
+        if self.spill_path:
+            if self._spill is None:
+                self._spill = open(self.spill_path, 'ab')
+            self._spill.write(data)
+
+        if self.line_handlers:
+            lines = re.split(b'[\r\n]', self._partial + data)
+            self._partial = lines.pop()[-self.tail_size:]
+            for line in lines:
+                if line:
+                    self._handle_line(line)
+
+    def _handle_line(self, line):
+        line = line.decode(console_encoding, 'ignore')
+        for handler in self.line_handlers:
+            handler(line)
+
+    def getvalue(self):
+        """
+        Return the captured tail of the output, decoded.
+        """
+        data = b''.join(self._chunks)[-self.tail_size:]
+        return data.decode(console_encoding, 'ignore')
+
+    def close(self):
+        if self._partial:
+            self._handle_line(self._partial)
+            self._partial = b''
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+
+def _set_pipe_size(fd, size):
+    """
+    Enlarge the pipe fd to size bytes where the system allows it (Linux).
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return
+    try:
+        fcntl.fcntl(fd, 1031, size)  # F_SETPIPE_SZ
+    except (IOError, OSError):
+        # Above /proc/sys/fs/pipe-max-size; keep the default size.
+        pass
+
+
+def _is_socket(obj):
+    # Sockets have no common type on Python 2 (socket.socket wraps
+    # _socket.socket, which socketpair() and fromfd() return).
+    return hasattr(obj, 'recv') and hasattr(obj, 'fileno')
+
+
+class InputFeeder(object):
+    """
+    Feed a streamed source to ffmpeg's stdin, read by ffmpeg as pipe:0.
+
+    A file descriptor or a socket is given to ffmpeg as its stdin, so it
+    reads it directly. A file-like object (anything with a read() method)
+    or an iterable of bytes is copied to ffmpeg by a thread, through a
+    pipe enlarged to PIPE_SIZE where the system allows it. The thread
+    blocks while the pipe is full, so the source is only read as fast as
+    ffmpeg consumes it.
+
+    An error reading the source is kept in error, to be raised once ffmpeg
+    is done. The source isn't closed.
+    """
+    BLOCK_SIZE = 1024 * 1024
+    PIPE_SIZE = 1024 * 1024
+
+    def __init__(self, source):
+        self.source = source
+        self.error = None
+        self._write_fd = None
+        self._thread = None
+        if isinstance(source, (int, long)):
+            self.stdin = source
+        elif _is_socket(source):
+            self.stdin = source.fileno()
+        else:
+            self.stdin, self._write_fd = os.pipe()
+            _set_pipe_size(self._write_fd, self.PIPE_SIZE)
+
+    def start(self):
+        """
+        Start copying the source, once ffmpeg has been spawned with stdin.
+        """
+        if self._write_fd is None:
+            return
+        os.close(self.stdin)
+        self._thread = threading.Thread(target=self._copy)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self, timeout=None):
+        """
+        Wait for the copy to end, ffmpeg having exited. If the source
+        blocks, the thread is left to end on its own after timeout.
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+        elif self._write_fd is not None:
+            # ffmpeg couldn't be spawned.
+            os.close(self.stdin)
+            os.close(self._write_fd)
+            self._write_fd = None
+
+    def _blocks(self):
+        read = getattr(self.source, 'read', None)
+        if read is None:
+            for block in self.source:
+                yield block
+            return
+        while True:
+            block = read(self.BLOCK_SIZE)
+            if not block:
+                return
+            yield block
+
+    def _copy(self):
+        try:
+            for block in self._blocks():
+                view = memoryview(block)
+                while len(view):
+                    view = view[os.write(self._write_fd, view):]
+        except EnvironmentError as e:
+            # EPIPE: ffmpeg stopped reading, e.g. after -t or when stopped.
+            if e.errno != errno.EPIPE:
+                self.error = e
+        except Exception as e:
+            self.error = e
+        finally:
+            os.close(self._write_fd)
+
+
+class FrameWriter(object):
+    """
+    Writer returned by FFMpeg.write_frames() and write_audio(), sending
+    raw video frames or audio samples to an ffmpeg process encoding them.
+
+    write() writes a frame, or several stacked in one array, to ffmpeg's
+    stdin: NumPy arrays, or buffers such as bytes, bytearray or memoryview
+    holding the raw pixels or samples (an audio frame being a sample of
+    each channel). The data is written straight from the array,
+    without copying it (except for arrays that aren't contiguous in
+    memory), and write() returns once it is in the pipe, so the array can
+    be reused for the next frame. It blocks while ffmpeg is busy.
+
+    close() ends the input and waits for ffmpeg to finish the output,
+    raising FFMpegConvertError if it failed, as does write() if ffmpeg
+    exited before reading the frames. The writer can be used as a context
+    manager, closing it at the end of the block, or stopping ffmpeg if
+    the block raised an exception.
+
+    The ffmpeg job is in job, and the last timecode encoded in timecode.
+
+    >>> with FFMpeg().write_frames('/tmp/output.mkv', ['-vcodec', 'libx264', '-f', 'matroska'],
+    ...                            320, 240, 'rgb24', 25) as writer:
+    ...     for frame in frames:
+    ...         writer.write(frame)
+    """
+
+    def __init__(self, ffmpeg, cmds, frame_size, timeout, nice, sink):
+        self.frame_size = frame_size
+        self.timecode = None
+        self._error = None
+        self._pipe = _FramePipe()
+        self.job = FFMpegJob(ffmpeg, ffmpeg._run_ffmpeg, 'pipe:0', cmds, timeout=timeout, nice=nice,
+                             source=self._pipe, sink=sink)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.job.stop(graceful=False)
+            self._pipe.close_input()
+            self._thread.join()
+
+    def _run(self):
+        try:
+            for timecode in self.job:
+                self.timecode = timecode
+        except Exception as e:
+            self._error = e
+
+    def write(self, frames):
+        """
+        Write one or more frames, a multiple of frame_size bytes.
+        """
+        view = _byte_view(frames)
+        if not len(view) or len(view) % self.frame_size:
+            raise FFMpegError('Frame data of %d bytes, not a multiple of the frame size (%d)' %
+                              (len(view), self.frame_size))
+        fd = self._pipe.write_fd
+        if fd is None:
+            raise FFMpegError('The frame writer is closed')
+        try:
+            while len(view):
+                view = view[os.write(fd, view):]
+        except EnvironmentError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # ffmpeg exited, raise its error
+            self.close()
+            raise FFMpegError('ffmpeg stopped reading the frames')
+
+    def close(self):
+        """
+        End the input and wait for ffmpeg to finish encoding.
+        """
+        self._pipe.close_input()
+        self._thread.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+class _FramePipe(InputFeeder):
+    """
+    Pipe to ffmpeg's stdin written by a FrameWriter instead of a thread.
+    """
+
+    def __init__(self):
+        InputFeeder.__init__(self, None)
+        self._started = False
+
+    @property
+    def write_fd(self):
+        return self._write_fd
+
+    def start(self):
+        self._started = True
+        os.close(self.stdin)
+
+    def close(self, timeout=None):
+        if not self._started:
+            # ffmpeg couldn't be spawned, make the writes fail.
+            self._started = True
+            os.close(self.stdin)
+
+    def close_input(self):
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+
+
+def _byte_view(data):
+    """
+    Return a flat memoryview of the bytes of data, a NumPy array or a
+    buffer.
+    """
+    if numpy is not None and isinstance(data, numpy.ndarray):
+        data = numpy.ascontiguousarray(data).reshape(-1).view(numpy.uint8)
+    view = memoryview(data)
+    if view.ndim != 1 or view.itemsize != 1:
+        try:
+            view = view.cast('B')
+        except AttributeError:
+            raise FFMpegError('Frames must be NumPy arrays or byte buffers')
+    return view
+
+
+class OutputSink(object):
+    """
+    Deliver ffmpeg's output, written to pipe:1, to a consumer instead of
+    a file.
+
+    A file descriptor is given to ffmpeg as its stdout, so it writes to it
+    directly. For a writable file object (anything with a write() method)
+    or a callable, ffmpeg's stdout is read along with its stderr into a
+    reused buffer of READ_SIZE bytes, and each block read is passed to
+    write() or to the callable as a memoryview, only valid during the
+    call: a consumer keeping the data must copy it, with tobytes().
+    """
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, sink):
+        self.sink = sink
+        self._view = None
+        self._file = None
+        if isinstance(sink, (int, long)):
+            self.stdout = sink
+            self._write = None
+        else:
+            self.stdout = PIPE
+            self._write = getattr(sink, 'write', sink)
+
+    def read(self, fd):
+        """
+        Pass the data ready on fd to the consumer. Returns False at the end
+        of the output.
+        """
+        if self._file is None:
+            self._file = io.FileIO(fd, 'r', closefd=False)
+            self._view = memoryview(bytearray(self.READ_SIZE))
+        n = self._file.readinto(self._view)
+        if not n:
+            self._file.close()
+            return False
+        self._write(self._view[:n])
+        return True
+
+
+def _rusage_sum(total, rusage):
+    """
+    Add the resource usage of a process to total (None at first). The
+    fields are added up, except ru_maxrss, which is a maximum.
+    """
+    if total is None:
+        return rusage
+    fields = [a + b for a, b in zip(total, rusage)]
+    fields[2] = max(total.ru_maxrss, rusage.ru_maxrss)
+    return type(rusage)(fields)
+
+
+def _exit_status(status):
+    """
+    Popen returncode of a process from its os.wait() status.
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class FFMpegJob(object):
+    """
+    Handle of one ffmpeg job, returned by FFMpeg.convert(), analyze() and
+    thumbnails_slow() and by the Converter methods built on them.
+
+    The job is iterated like the generators these methods used to return:
+    iterating it drives ffmpeg and yields the progress. The handle also
+    holds the processes started by the job, so it can be stopped from
+    another thread, and their exit status and resource usage once they
+    have finished. A job can run several ffmpeg processes one after the
+    other, e.g. the two passes of a conversion, and other jobs run in
+    parallel on its behalf (subjobs), e.g. the chunks of a conversion.
+    returncode is the exit status of the last process, and rusage the
+    resource usage of all of them added up (None on platforms without
+    os.wait4()).
+
+    Conversions run with smart_copy list the streams they copied instead
+    of encoding them in copied (see Converter.convert()).
+
+    >>> job = FFMpeg().convert('test.ogg', '/tmp/output.mp3', ['-vn'])
+    >>> for timecode in job:
+    ...    pass
+    >>> job.returncode, job.elapsed, job.rusage.ru_utime
+    """
+
+    def __init__(self, ffmpeg, target, *args, **kwargs):
+        self.ffmpeg = ffmpeg
+        self.processes = []
+        self.subjobs = []
+        self.copied = []
+        self.started = None
+        self.finished = None
+        self.returncode = None
+        self.rusage = None
+        self._iterator = target(self, *args, **kwargs)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._iterator)
+
+    __next__ = next
+
+    def close(self):
+        """
+        Abandon the job, killing ffmpeg if it's still running.
+        """
+        self._iterator.close()
+
+    @property
+    def process(self):
+        """
+        The ffmpeg process currently (or last) run by the job.
+        """
+        return self.processes[-1] if self.processes else None
+
+    @property
+    def pid(self):
+        return self.processes[-1].pid if self.processes else None
+
+    @property
+    def running(self):
+        return self in self.ffmpeg.jobs
+
+    @property
+    def elapsed(self):
+        """
+        Wall-clock running time of the job in seconds.
+        """
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def stop(self, graceful=True):
+        """
+        Stop the job and wait for its processes to exit. ffmpeg is asked
+        to quit first, so the output file is properly finished, and is
+        terminated or killed if it doesn't exit in time. If graceful is
+        False, ffmpeg is terminated right away.
+        """
+        for p in list(self.processes):
+            self.ffmpeg._shutdown(p, graceful)
+        for job in list(self.subjobs):
+            job.stop(graceful)
+
+    def terminate(self):
+        """
+        Send SIGTERM to the job's processes without waiting for them.
+        """
+        self._signal('terminate')
+
+    def kill(self):
+        """
+        Send SIGKILL to the job's processes without waiting for them.
+        """
+        self._signal('kill')
+
+    def _signal(self, method):
+        for p in list(self.processes):
+            if p.returncode is None:
+                try:
+                    getattr(p, method)()
+                except OSError:
+                    pass
+        for job in list(self.subjobs):
+            job._signal(method)
+
+    def _spawn(self, cmds, stdin=PIPE, stdout=PIPE):
+        p = self.ffmpeg._spawn(cmds, stdin, stdout)
+        self.processes.append(p)
+        if self.started is None:
+            self.started = time.time()
+        if not self.running:
+            self.finished = None
+            self.ffmpeg._register(self)
+        self.ffmpeg.current_process = p
+        return p
+
+    def _reap(self, p):
+        """
+        Wait for the process p, record its exit status and add its resource
+        usage to the job's. The usage isn't known if p was already reaped,
+        e.g. by the poll() of a concurrent stop().
+        """
+        if p.returncode is None and hasattr(os, 'wait4'):
+            try:
+                _, status, rusage = os.wait4(p.pid, 0)
+            except OSError as e:
+                # Already reaped by a concurrent poll(), or interrupted:
+                # p.wait() gets the exit status.
+                if e.errno not in (errno.ECHILD, errno.EINTR):
+                    raise
+            else:
+                p.returncode = _exit_status(status)
+                self.rusage = _rusage_sum(self.rusage, rusage)
+        p.wait()
+        self.returncode = p.returncode
+        return p.returncode
+
+    def _finish(self):
+        for p in self.processes:
+            if p.poll() is None:
+                self.ffmpeg._shutdown(p, graceful=False)
+        if self.running:
+            self.finished = time.time()
+            self.ffmpeg._unregister(self)
+
+
 class FFMpeg(object):
     """
     FFMPeg wrapper object, takes care of calling the ffmpeg binaries,
@@ -70,22 +1154,67 @@ class FFMpeg(object):
     AUDIO_PEAK_MAX = -1  # dBTP
     AUDIO_LOUDNESS_TARGET = -16  # LUFS
     DVD_CONCAT_FILE = '/tmp/dvd_concat.txt'
-
-    def __init__(self, ffmpeg_path=None, ffprobe_path=None, dvd2concat_path=None):
+    READ_BUFFER_SIZE = 64 * 1024
+    STDERR_TAIL_SIZE = 256 * 1024
+    QUIT_GRACE_PERIOD = 5  # seconds to wait after sending 'q'
+    TERMINATE_GRACE_PERIOD = 5  # seconds to wait after SIGTERM
+    # Packed pixel formats read_frames() can return: NumPy dtype, bytes
+    # per sample and samples per pixel.
+    RAW_PIX_FMTS = {
+        'gray': ('u1', 1, 1),
+        'gray16le': ('<u2', 2, 1),
+        'grayf32le': ('<f4', 4, 1),
+        'rgb24': ('u1', 1, 3),
+        'bgr24': ('u1', 1, 3),
+        'rgba': ('u1', 1, 4),
+        'bgra': ('u1', 1, 4),
+        'argb': ('u1', 1, 4),
+        'abgr': ('u1', 1, 4),
+        'rgb48le': ('<u2', 2, 3),
+        'rgba64le': ('<u2', 2, 4),
+    }
+    # Sample types of read_audio() and write_audio(): NumPy dtype, bytes
+    # per sample and raw PCM format.
+    RAW_SAMPLE_FMTS = {
+        'int16': ('<i2', 2, 's16le'),
+        'int32': ('<i4', 4, 's32le'),
+        'float32': ('<f4', 4, 'f32le'),
+    }
+    # ffprobe options of the probe profiles, from the cheapest to the
+    # deepest one. When a profile misses fields needed by the Converter,
+    # the probe is retried with the next one. 'native' reads the headers
+    # of MP4/MOV and Matroska files without running ffprobe (see
+    # converter.containers).
+    PROBE_PROFILES = collections.OrderedDict([
+        ('native', None),
+        ('fast', ['-probesize', '1000000', '-analyzeduration', '2000000',
+                  '-show_entries',
+                  'format=filename,format_name,format_long_name,duration,size,bit_rate:format_tags'
+                  ':stream=index,codec_type,codec_name,codec_long_name,profile,level,width,height,'
+                  'avg_frame_rate,r_frame_rate,duration,bit_rate,channels,sample_rate'
+                  ':stream_tags:stream_disposition=attached_pic']),
+        ('full', ['-show_format', '-show_streams']),
+    ])
+
+    def __init__(self, ffmpeg_path=None, ffprobe_path=None, dvd2concat_path=None, probe_cache=None,
+                 probe_profile='full'):
         """
         Initialize a new FFMpeg wrapper object. Optional parameters specify
-        the paths to ffmpeg and ffprobe utilities.
+        the paths to ffmpeg and ffprobe utilities, a ProbeCache (see
+        converter.probecache) to reuse the results of probe(), and the
+        default probe profile (see probe()).
+
+        One object can run any number of jobs at the same time, from any
+        thread; see FFMpegJob.
         """
 
         self.current_process = None
-
-        def which(name):
-            path = os.environ.get('PATH', os.defpath)
-            for d in path.split(':'):
-                fpath = os.path.join(d, name)
-                if os.path.exists(fpath) and os.access(fpath, os.X_OK):
-                    return fpath
-            return None
+        self.probe_cache = probe_cache
+        if probe_profile not in self.PROBE_PROFILES:
+            raise FFMpegError('Unknown probe profile: ' + str(probe_profile))
+        self.probe_profile = probe_profile
+        self._jobs = []
+        self._jobs_lock = threading.Lock()
 
         if ffmpeg_path is None:
             ffmpeg_path = 'ffmpeg'
@@ -97,11 +1226,11 @@ class FFMpeg(object):
             dvd2concat_path = 'dvd2concat'
 
         if '/' not in ffmpeg_path:
-            ffmpeg_path = which(ffmpeg_path) or ffmpeg_path
+            ffmpeg_path = _which(ffmpeg_path) or ffmpeg_path
         if '/' not in ffprobe_path:
-            ffprobe_path = which(ffprobe_path) or ffprobe_path
+            ffprobe_path = _which(ffprobe_path) or ffprobe_path
         if '/' not in dvd2concat_path:
-            dvd2concat_path = which(dvd2concat_path) or dvd2concat_path
+            dvd2concat_path = _which(dvd2concat_path) or dvd2concat_path
 
         self.ffmpeg_path = ffmpeg_path
         self.ffprobe_path = ffprobe_path
@@ -113,19 +1242,109 @@ class FFMpeg(object):
         if not os.path.exists(self.ffprobe_path):
             raise FFMpegError("ffprobe binary not found: " + self.ffprobe_path)
 
+    @property
+    def capabilities(self):
+        """
+        The encoders, muxers and filters supported by the ffmpeg binary
+        (see converter.capabilities). They are discovered once per binary
+        and cached.
+        """
+        caps = capabilities.discover(self.ffmpeg_path)
+        if caps is None:
+            raise FFMpegError("Can't get the capabilities of " + self.ffmpeg_path)
+        return caps
+
     @staticmethod
-    def _spawn(cmds, stdin=PIPE):
+    def _spawn(cmds, stdin=PIPE, stdout=PIPE):
         logger.debug('Spawning ffmpeg with command: ' + ' '.join(cmds))
-        return Popen(cmds, shell=False, stdin=stdin, stdout=PIPE, stderr=PIPE,
+        return Popen(cmds, shell=False, stdin=stdin, stdout=stdout, stderr=PIPE,
                      close_fds=True)
 
+    @classmethod
+    def _shutdown(cls, p, graceful=True):
+        """
+        Stop a running process, escalating from a graceful 'q' on ffmpeg's
+        stdin to SIGTERM and finally SIGKILL.
+        """
+        def wait(grace):
+            until = time.time() + grace
+            while p.poll() is None:
+                if time.time() >= until:
+                    return False
+                time.sleep(0.05)
+            return True
+
+        if p.poll() is not None:
+            return
+
+        if graceful and p.stdin and not p.stdin.closed:
+            try:
+                p.stdin.write(b'q')
+                p.stdin.flush()
+            except (IOError, OSError, ValueError):
+                pass
+            else:
+                if wait(cls.QUIT_GRACE_PERIOD):
+                    return
+
+        try:
+            p.terminate()
+        except OSError:
+            return
+        if wait(cls.TERMINATE_GRACE_PERIOD):
+            return
+
+        try:
+            p.kill()
+        except OSError:
+            pass
+        p.wait()
+
+    @property
+    def jobs(self):
+        """
+        The jobs started by this object that are still running.
+        """
+        with self._jobs_lock:
+            return list(self._jobs)
+
+    def _register(self, job):
+        with self._jobs_lock:
+            self._jobs.append(job)
+
+    def _unregister(self, job):
+        with self._jobs_lock:
+            if job in self._jobs:
+                self._jobs.remove(job)
+
+    def _job(self, job, target, *args, **kwargs):
+        """
+        Run target as part of job if given, or as a new FFMpegJob.
+        """
+        if job is not None:
+            return target(job, *args, **kwargs)
+        return FFMpegJob(self, target, *args, **kwargs)
+
     def stop(self):
+        """
+        Terminate the ffmpeg process started last (current_process). Use
+        stop_all() to terminate every running job, or FFMpegJob.stop() to
+        stop a single job.
+        """
         if self.current_process:
             try:
                 self.current_process.terminate()
             except (OSError, AttributeError):
                 raise FFMpegError("Can't stop FFmpeg")
 
+    def stop_all(self):
+        """
+        Terminate all the running jobs. Iterating them then raises
+        FFMpegConvertError.
+        """
+        for job in self.jobs:
+            job.terminate()
+
     def _check_vob_name(self, source):
         match = re.search('/VIDEO_TS/(VTS_\d\d_)\d(.VOB)$', source, re.IGNORECASE)
         if match is None:
@@ -165,6 +1384,27 @@ class FFMpeg(object):
 
         return self.DVD_CONCAT_FILE
 
+    @staticmethod
+    def is_sink(outfile):
+        """
+        Return True if outfile is an output sink (see OutputSink) rather
+        than a file name or URL.
+        """
+        if isinstance(outfile, basestring):
+            return False
+        return isinstance(outfile, (int, long)) or hasattr(outfile, 'write') or callable(outfile)
+
+    @staticmethod
+    def is_stream(infile):
+        """
+        Return True if infile is a streamed source (see InputFeeder)
+        rather than a file name or URL.
+        """
+        if isinstance(infile, basestring):
+            return False
+        return (isinstance(infile, (int, long)) or _is_socket(infile) or hasattr(infile, 'read') or
+                hasattr(infile, '__iter__'))
+
     def is_url(self, url):
         #: Accept objects that have string representations.
         try:
@@ -189,26 +1429,37 @@ class FFMpeg(object):
 
         return True
 
-    def probe(self, fname, posters_as_video=False, title=None):
+    def probe(self, fname, posters_as_video=False, title=None, profile=None, select_streams=None):
         """
         Examine the media file and determine its format and media streams.
         Returns the MediaInfo object, or None if the specified file is
         not a valid media file.
 
+        The profile (see PROBE_PROFILES) sets how deep ffprobe looks into
+        the file; it defaults to the one given to the constructor. The
+        'fast' profile reads at most 1MB and 2 seconds of the input and
+        only asks for the fields used by the Converter, which is much
+        cheaper on large or remote inputs. If fields the Converter needs
+        are missing, the file is probed again with the next (deeper)
+        profile. The 'native' profile doesn't run ffprobe for local MP4/MOV
+        and Matroska files, and falls back to it for other files.
+        select_streams is passed to ffprobe's -select_streams to only probe
+        the streams matching the specifier (e.g. 'v:0').
+
         >>> info = FFMpeg().probe('test1.ogg')
-        >>> info['container']
+        >>> info.format.format
         'ogg'
-        >>> info['duration']
+        >>> info.format.duration
         33.00
-        >>> info['video']['codec']
+        >>> info.video.codec
         'theora'
-        >>> info['video']['width']
+        >>> info.video.video_width
         720
-        >>> info['video']['height']
+        >>> info.video.video_height
         400
-        >>> info['audio']['codec']
+        >>> info.audio.codec
         'vorbis'
-        >>> info['audio']['channels']
+        >>> info.audio.audio_channels
         2
         :param posters_as_video: Take poster images (mainly for audio files) as
             A video stream, defaults to False
@@ -216,115 +1467,206 @@ class FFMpeg(object):
         if not os.path.exists(fname) and not self.is_url(fname):
             return None
 
-        p = self._spawn([self.ffprobe_path, '-v', 'quiet', '-print_format',
-                        'json', '-show_format', '-show_streams', fname])
-        stdout_data, _ = p.communicate()
-        stdout_data = stdout_data.decode(console_encoding, 'ignore')
-        info = json.loads(stdout_data)
-
-        info['posters'] = []
-        if 'streams' in info:
-            for stream in info['streams']:
-                try:
-                    attached_pic = stream['disposition']['attached_pic']
-                except KeyError:
-                    attached_pic = None
-                if stream['codec_type'] not in info:
-                    info[stream['codec_type'] + 's'] = []
-                    if (stream['codec_type'] != 'video'
-                            or (posters_as_video or not attached_pic)):
-                        info[stream['codec_type']] = stream
-                info[stream['codec_type'] + 's'].append(stream)
-                if attached_pic:
-                    info['posters'].append(stream)
-
-        def de_under(key, value, branch):
-            branch[key.replace('_', '')] = value
-
-        def lower(key, value, branch):
-            branch[key] = value.lower()
-
-        def container(key, value, branch):
-            info['container'] = value.lower().split(',')
-
-        def extension(key, value, branch):
-            info['extension'] = os.path.splitext(value)[1][1:].lower()
-
-        def codec(key, value, branch):
-            if 'aac' in value:
-                value = 'aac'
-            branch['codec'] = value.lower()
-
-        def bitrate_in_kbps(key, value, branch):
-            branch['bitrate'] = round(value / 1000.0)
-
-        def bitrate_in_mbps(key, value, branch):
-            branch['bitrate'] = round(value / 1000.0 / 1000, 1)
-
-        def fps(key, value, branch):
-            branch['fps'] = round(value, 2)
-
-        def level(key, value, branch):
-            branch[key] = round(value / 10.0, 1)
-
-        FIELD_MAPPING = {
-            'format': {
-                'format_name': container,
-                'filename': extension,
-                'bit_rate': bitrate_in_mbps,
-            },
-            'audios': {
-                'codec_name': codec,
-                'sample_rate': de_under,
-                'bit_rate': bitrate_in_kbps,
-            },
-            'videos': {
-                'codec_name': codec,
-                'avg_frame_rate': fps,
-                'bit_rate': bitrate_in_mbps,
-                'profile': lower,
-                'level': level,
-            }
-        }
+        profile = profile or self.probe_profile
+        key = self._probe_cache_key(fname, posters_as_video, title, profile, select_streams)
+        if key is not None:
+            try:
+                return self.probe_cache[key]
+            except KeyError:
+                pass
 
-        def clean_info(branch, parent=None):
-            if parent is None:
-                mapping = FIELD_MAPPING
+        while profile:
+            if self.PROBE_PROFILES[profile] is None:
+                info = self._read_header(fname, posters_as_video, title, select_streams)
             else:
-                mapping = FIELD_MAPPING.get(parent, {})
+                p = self._spawn(self._probe_cmds(fname, profile, select_streams))
+                stdout_data, _ = p.communicate()
+                info = self._parse_probe(stdout_data, fname, posters_as_video, title)
+            profile = self._deeper_probe_profile(profile, info)
 
-            for key, value in branch.items():
-                if key in ('streams', 'audio', 'video'):
-                    continue
+        if key is not None:
+            self.probe_cache[key] = info
+        return info
 
-                if isinstance(value, dict):
-                    clean_info(value, key)
-                    continue
+    def _probe_cache_key(self, fname, posters_as_video, title, profile=None, select_streams=None):
+        if self.probe_cache is None:
+            return None
+        return self.probe_cache.key(fname, posters_as_video, title, profile or self.probe_profile,
+                                    select_streams)
 
-                if isinstance(value, list):
-                    for item in value:
-                        clean_info(item, key)
-                    continue
+    def _deeper_probe_profile(self, profile, info):
+        """
+        Return the profile to probe again with if info misses fields used
+        by the Converter, None if it's complete (or can't be improved).
+        """
+        profiles = list(self.PROBE_PROFILES)
+        if profile not in profiles:
+            raise FFMpegError('Unknown probe profile: ' + str(profile))
+        idx = profiles.index(profile)
+        if info is None and self.PROBE_PROFILES[profile] is None:
+            return profiles[idx + 1]
+        if info is None or idx == len(profiles) - 1:
+            return None
+
+        incomplete = info.format.duration is None
+        for stream in info.streams:
+            if stream.codec is None:
+                incomplete = True
+            elif stream.type == 'video' and not stream.attached_pic:
+                incomplete = incomplete or not (stream.video_width and stream.video_height)
+            elif stream.type == 'audio':
+                incomplete = incomplete or not (stream.audio_channels and stream.audio_samplerate)
+
+        if incomplete:
+            return profiles[idx + 1]
+        return None
+
+    def probe_many(self, fnames, concurrency=None, posters_as_video=False, profile=None):
+        """
+        Examine many media files, running up to concurrency ffprobe
+        processes at the same time (the number of CPUs by default).
+
+        Returns a generator yielding (fname, info) tuples as the probes
+        complete, so not in the order of fnames. info is what probe()
+        would return for the file or, if probing it failed, the exception
+        raised; one failure doesn't stop the others. fnames can be any
+        iterable, e.g. a generator walking a directory tree, and is
+        consumed as the probes progress. profile is the probe profile, as
+        for probe().
+
+        >>> for fname, info in FFMpeg().probe_many(glob.glob('/media/*.mkv'), 16):
+        ...     if isinstance(info, Exception):
+        ...         log(fname, info)
+        """
+        if concurrency is None:
+            concurrency = multiprocessing.cpu_count()
+        profile = profile or self.probe_profile
+        fnames = iter(fnames)
+        retries = collections.deque()  # (fname, cache key, deeper profile)
+        running = {}  # stdout fd -> (fname, process, output chunks, cache key, profile)
+
+        try:
+            while True:
+                while (retries or fnames is not None) and len(running) < concurrency:
+                    if retries:
+                        fname, key, fprofile = retries.popleft()
+                    else:
+                        try:
+                            fname = next(fnames)
+                        except StopIteration:
+                            fnames = None
+                            break
+
+                        if not os.path.exists(fname) and not self.is_url(fname):
+                            yield fname, None
+                            continue
+
+                        fprofile = profile
+                        key = self._probe_cache_key(fname, posters_as_video, None, profile)
+                        if key is not None:
+                            try:
+                                info = self.probe_cache[key]
+                            except KeyError:
+                                pass
+                            else:
+                                yield fname, info
+                                continue
+
+                    if self.PROBE_PROFILES[fprofile] is None:
+                        info = self._read_header(fname, posters_as_video)
+                        deeper = self._deeper_probe_profile(fprofile, info)
+                        if not deeper:
+                            if key is not None:
+                                self.probe_cache[key] = info
+                            yield fname, info
+                            continue
+                        fprofile = deeper
 
-                if isinstance(value, basestring):
                     try:
-                        if '/' in value:
-                            n, d = value.split('/', 1)
-                            value = float(n) / float(d)
-                        elif '.' in value:
-                            value = float(value)
-                        else:
-                            value = int(value)
-                    except ZeroDivisionError:
-                        value = 0
-                    except ValueError:
-                        value = value.strip()
-                    branch[key] = value
+                        p = self._spawn(self._probe_cmds(fname, fprofile))
+                    except OSError:
+                        yield fname, FFMpegError('Error while calling ffprobe binary')
+                        continue
+                    p.stdin.close()
+                    running[p.stdout.fileno()] = (fname, p, [], key, fprofile)
+
+                if not running:
+                    break
 
-                if key in mapping:
-                    mapping[key](key, value, branch)
+                ready, _, _ = select.select(list(running), [], [])
+                for fd in ready:
+                    fname, p, chunks, key, fprofile = running[fd]
+                    data = os.read(fd, self.READ_BUFFER_SIZE)
+                    if data:
+                        chunks.append(data)
+                        continue
+
+                    del running[fd]
+                    p.stdout.close()
+                    p.stderr.close()
+                    p.wait()
+                    try:
+                        info = self._parse_probe(b''.join(chunks), fname, posters_as_video)
+                    except Exception as e:
+                        info = e
+                    else:
+                        deeper = self._deeper_probe_profile(fprofile, info)
+                        if deeper:
+                            retries.append((fname, key, deeper))
+                            continue
+                        if key is not None:
+                            self.probe_cache[key] = info
+                    yield fname, info
+        finally:
+            for _, p, _, _, _ in running.values():
+                if p.poll() is None:
+                    p.kill()
+                    p.wait()
 
-        clean_info(info)
+    def _read_header(self, fname, posters_as_video=False, title=None, select_streams=None):
+        """
+        Return the info of the 'native' probe profile, or None if fname
+        needs ffprobe.
+        """
+        if title or select_streams or self.is_url(fname):
+            return None
+        raw = read_header(fname)
+        if raw is None:
+            return None
+        return MediaInfo(raw, posters_as_video)
+
+    def _source_info(self, fname, info=None, posters_as_video=False, title=None):
+        """
+        Return the probe info of fname: info if given, as a MediaInfo, or
+        the result of probe(). info can be a MediaInfo or the dict parsed
+        from ffprobe's JSON output (-show_format -show_streams), e.g. as
+        stored by an ingest step, so the file doesn't need to be probed
+        again.
+        """
+        if info is None:
+            return self.probe(fname, posters_as_video=posters_as_video, title=title)
+        if isinstance(info, MediaInfo):
+            return info
+        if isinstance(info, dict) and 'format' in info:
+            return MediaInfo(info, posters_as_video)
+        raise FFMpegError('Invalid probe info: %r' % (info,))
+
+    def _probe_cmds(self, fname, profile=None, select_streams=None):
+        cmds = [self.ffprobe_path, '-v', 'quiet', '-print_format', 'json']
+        cmds.extend(self.PROBE_PROFILES[profile or self.probe_profile])
+        if select_streams:
+            cmds.extend(['-select_streams', select_streams])
+        cmds.append(fname)
+        return cmds
+
+    def _parse_probe(self, stdout_data, fname, posters_as_video=False, title=None):
+        """
+        Turn the JSON printed by ffprobe into the info returned by probe().
+        """
+        stdout_data = stdout_data.decode(console_encoding, 'ignore')
+        info = json.loads(stdout_data, object_pairs_hook=_json_object)
+        if 'format' not in info:
+            return None
 
         # For .VOB file get duration with lsdvd.
         # fname = self._check_vob_name(fname)
@@ -338,9 +1680,9 @@ class FFMpeg(object):
                     if 'duration' in data:
                         # Keep ffprobe duration if difference with lsdvd
                         # duration is less then 1%.
-                        probe_duration = data['duration']
+                        probe_duration = _number(data['duration'])
                         gap = 2
-                        if isinstance(probe_duration, (float, int)) and probe_duration > 0:
+                        if probe_duration > 0:
                             if probe_duration > duration:
                                 gap = probe_duration / duration
                             else:
@@ -384,35 +1726,87 @@ class FFMpeg(object):
                     if not 'duration' in info['format']:
                         info['format']['duration'] = duration
 
-        return info
+        return MediaInfo(info, posters_as_video)
 
-    def convert(self, infile, outfile, opts, timeout=10, nice=None, get_output=False, title=None):
+    def convert(self, infile, outfile, opts, timeout=10, nice=None, get_output=False, title=None,
+                progress=False, stats_period=None, stall_timeout=None, deadline=None, capture=None, job=None):
         """
         Convert the source media (infile) according to specified options
         (a list of ffmpeg switches as strings) and save it to outfile.
 
-        Convert returns a generator that needs to be iterated to drive the
-        conversion process. The generator will periodically yield timecode
+        Convert returns a job (see FFMpegJob) that needs to be iterated to
+        drive the conversion process. It will periodically yield timecode
         of currently processed part of the file (ie. at which second in the
-        content is the conversion process currently).
+        content is the conversion process currently). To run the conversion
+        as a step of an existing job instead, pass that job as job; the
+        progress generator is then returned.
 
         The optional timeout argument specifies how long should the operation
-        be blocked in case ffmpeg gets stuck and doesn't report back. See
-        the documentation in Converter.convert() for more details about this
-        option.
+        be blocked in case ffmpeg gets stuck and doesn't report back. The
+        stall_timeout and deadline arguments additionally limit how long
+        the reported timecode may stay the same and the total running time,
+        all in wall-clock seconds. See the documentation in
+        Converter.convert() for more details about these options.
+
+        If progress is True, ffmpeg reports its progress as key=value blocks
+        on a dedicated pipe (-progress) instead of having its stderr stats
+        line scraped, and the generator yields FFMpegProgress records (a
+        float timecode carrying frame, fps, bitrate, speed and total_size).
+        Stderr is then only kept for error diagnostics. stats_period sets
+        the interval between updates in seconds (needs ffmpeg 4.4+).
+
+        Only the tail of ffmpeg's stderr output is kept in memory (see
+        STDERR_TAIL_SIZE). Pass an OutputCapture as capture to change the
+        tail size, parse the output line by line or spill it to a file.
+
+        Instead of a file name or URL, infile can be a streamed source: a
+        file descriptor, a socket, a file-like object or an iterable of
+        bytes, fed to ffmpeg on its stdin (see InputFeeder). The input
+        format may then need to be given with -f in opts (as an input
+        option, before -i) if ffmpeg can't guess it from the data.
+
+        Likewise, outfile can be an output sink: a file descriptor, a
+        writable file object or a callable receiving the blocks of output
+        (see OutputSink), so the output doesn't need to land on disk. The
+        output format must then be given with -f, and be one that can be
+        written sequentially, e.g. matroska, mpegts, ogg or mp4 fragmented
+        with -movflags frag_keyframe+empty_moov. progress is not supported
+        with a sink, as ffmpeg's stdout carries the output.
 
         >>> conv = FFMpeg().convert('test.ogg', '/tmp/output.mp3',
         ...    ['-acodec libmp3lame', '-vn'])
         >>> for timecode in conv:
         ...    pass # can be used to inform the user about conversion progress
 
+        >>> conv = FFMpeg().convert(open('test.ogg', 'rb'), '/tmp/output.mp3',
+        ...    ['-acodec libmp3lame', '-vn'])
         """
-        if not os.path.exists(infile) and not self.is_url(infile):
+        source = None
+        if self.is_stream(infile):
+            source, infile = infile, 'pipe:0'
+        elif not os.path.exists(infile) and not self.is_url(infile):
             raise FFMpegError("Input file doesn't exist: " + infile)
 
+        sink = None
+        if self.is_sink(outfile):
+            if progress:
+                raise FFMpegError('Progress reports are not supported with an output sink')
+            sink, outfile = outfile, 'pipe:1'
+
         # infile = self._dvd2concat(infile)
 
+        cmds = self._convert_cmds(infile, outfile, opts, get_output, progress, stats_period)
+        return self._job(job, self._run_ffmpeg, infile, cmds, timeout=timeout, nice=nice,
+                         get_output=get_output, title=title, progress=progress,
+                         stall_timeout=stall_timeout, deadline=deadline, capture=capture,
+                         source=source, sink=sink)
+
+    def _convert_cmds(self, infile, outfile, opts, get_output=False, progress=False, stats_period=None):
         cmds = [self.ffmpeg_path, '-hide_banner']
+        if progress:
+            cmds.extend(['-nostats', '-progress', 'pipe:1'])
+            if stats_period:
+                cmds.extend(['-stats_period', str(stats_period)])
         if infile == self.DVD_CONCAT_FILE:
             cmds.extend(['-f', 'concat', '-safe', '0'])
         # Add duration and position flag before input when we can.
@@ -433,135 +1827,622 @@ class FFMpeg(object):
             cmds.extend(['-i', infile])
         cmds.extend(opts)
         cmds.extend(['-y', outfile])
+        return cmds
 
-        return self._run_ffmpeg(infile, cmds, timeout=timeout, nice=nice, get_output=get_output, title=title)
+    def convert_multi(self, infile, outputs, filter_complex=None, timeout=10, nice=None, progress=False,
+                      stats_period=None, stall_timeout=None, deadline=None, capture=None, job=None):
+        """
+        Convert the source media (infile) to several outputs with a single
+        ffmpeg process, so it's only read and decoded once. outputs is a
+        list of (outfile, opts) pairs, opts being the list of ffmpeg
+        switches of that output (applied as output options, including -t
+        and -ss). filter_complex is an optional filter graph shared by the
+        outputs, whose labelled outputs are selected with -map in opts.
+
+        Returns a job yielding the timecodes like convert(), which the other
+        arguments are the same as.
+
+        >>> conv = FFMpeg().convert_multi('test.ogg', [
+        ...    ('/tmp/small.ogg', ['-map', '[v0]', '-vcodec', 'libtheora', '-an']),
+        ...    ('/tmp/large.ogg', ['-map', '[v1]', '-vcodec', 'libtheora', '-an'])],
+        ...    filter_complex='[0:v]split=2[s0][s1];[s0]scale=320:-2[v0];[s1]scale=1280:-2[v1]')
+        """
+        if not os.path.exists(infile) and not self.is_url(infile):
+            raise FFMpegError("Input file doesn't exist: " + infile)
+        if not outputs:
+            raise FFMpegError('No outputs to convert to')
 
-    def _run_ffmpeg(self, infile, cmds, timeout=10, nice=None, get_output=False, title=None):
-        if nice is not None:
-            if 0 < nice < 20:
-                cmds = ['nice', '-n', str(nice)] + cmds
-            else:
-                raise FFMpegError("Invalid nice value: {0}".format(nice))
+        cmds = [self.ffmpeg_path, '-hide_banner']
+        if progress:
+            cmds.extend(['-nostats', '-progress', 'pipe:1'])
+            if stats_period:
+                cmds.extend(['-stats_period', str(stats_period)])
+        if infile == self.DVD_CONCAT_FILE:
+            cmds.extend(['-f', 'concat', '-safe', '0'])
+        cmds.extend(['-y', '-i', infile])
+        if filter_complex:
+            cmds.extend(['-filter_complex', filter_complex])
+        for outfile, opts in outputs:
+            cmds.extend(opts)
+            cmds.append(outfile)
+
+        return self._job(job, self._run_ffmpeg, infile, cmds, timeout=timeout, nice=nice,
+                         progress=progress, stall_timeout=stall_timeout, deadline=deadline,
+                         capture=capture)
+
+    def keyframes(self, fname):
+        """
+        Return the sorted timestamps (in seconds) of the keyframes of the
+        first video stream of fname. The packets are read without being
+        decoded, so it's much cheaper than a conversion.
 
-        if 'pipe:' in cmds:
-            if infile.upper().endswith('.VOB'):
-                infile = os.path.dirname(infile)
-            nice = cmds[0:3] if cmds[0] == 'nice' else []
-            piped_cmds = nice + ['tccat', '-i', infile, '-T', str(title) + ',-1']
-            preprocess = self._spawn(piped_cmds)
-        else:
-            preprocess = None
+        >>> FFMpeg().keyframes('test.ogg')
+        [0.0, 10.4, 20.8, 31.2]
+        """
+        if not os.path.exists(fname) and not self.is_url(fname):
+            raise FFMpegError("Input file doesn't exist: " + fname)
 
-        try:
-            if preprocess:
-                self.current_process = self._spawn(cmds, preprocess.stdout)
-                preprocess.stdout.close()
-            else:
-                self.current_process = self._spawn(cmds)
-            p = self.current_process
-        except OSError:
-            raise FFMpegError('Error while calling ffmpeg binary')
+        p = self._spawn([self.ffprobe_path, '-v', 'quiet', '-select_streams', 'v:0',
+                         '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', fname])
+        stdout_data, _ = p.communicate()
+        if p.returncode != 0:
+            raise FFMpegError("Can't read the keyframes of " + fname)
 
-        if timeout:
-            def on_sigvtalrm(*_):
+        keyframes = []
+        for line in stdout_data.decode(console_encoding, 'ignore').splitlines():
+            pts_time, _, flags = line.partition(',')
+            if 'K' in flags:
                 try:
-                    signal.signal(signal.SIGVTALRM, signal.SIG_DFL)
+                    keyframes.append(float(pts_time))
                 except ValueError:
                     pass
-                if p.poll() is None:
-                    p.kill()
-                raise Exception('timed out while waiting for ffmpeg called with this command: {0}'.format(' '.join(cmds)))
+        return sorted(keyframes)
 
+    def concat(self, infiles, outfile, opts, inputs=None, timeout=10, nice=None, progress=False,
+               stall_timeout=None, deadline=None, capture=None, job=None):
+        """
+        Join infiles, media files with the same streams and codecs (e.g.
+        the chunks of a conversion), into outfile with the concat demuxer.
+        The streams are copied, not encoded again. opts are output options,
+        e.g. the format; inputs are other media files added after the
+        joined one, e.g. its audio track, and mapped with -map in opts.
+
+        Returns a job yielding the timecodes like convert().
+
+        >>> job = FFMpeg().concat(['/tmp/part1.mkv', '/tmp/part2.mkv'], '/tmp/output.mkv',
+        ...                       ['-f', 'matroska'])
+        """
+        inputs = inputs or []
+        for infile in list(infiles) + inputs:
+            if not os.path.exists(infile):
+                raise FFMpegError("Input file doesn't exist: " + infile)
+
+        return self._job(job, self._concat, infiles, outfile, opts, inputs, timeout, nice, progress,
+                         stall_timeout, deadline, capture)
+
+    def _concat(self, job, infiles, outfile, opts, inputs, timeout, nice, progress, stall_timeout,
+                deadline, capture):
+        fd, listfile = tempfile.mkstemp(prefix='concat-', suffix='.txt',
+                                        dir=os.path.dirname(os.path.abspath(outfile)))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('ffconcat version 1.0\n')
+                for infile in infiles:
+                    f.write("file '%s'\n" % os.path.abspath(infile).replace("'", "'\\''"))
+
+            cmds = [self.ffmpeg_path, '-hide_banner']
+            if progress:
+                cmds.extend(['-nostats', '-progress', 'pipe:1'])
+            cmds.extend(['-f', 'concat', '-safe', '0', '-i', listfile])
+            for infile in inputs:
+                cmds.extend(['-i', infile])
+            cmds.extend(['-c', 'copy'])
+            cmds.extend(opts)
+            cmds.extend(['-y', outfile])
+
+            for timecode in self._run_ffmpeg(job, listfile, cmds, timeout=timeout, nice=nice,
+                                             progress=progress, stall_timeout=stall_timeout,
+                                             deadline=deadline, capture=capture):
+                yield timecode
+        finally:
+            os.unlink(listfile)
+
+    def read_frames(self, source, pix_fmt='rgb24', size=None, fps=None, start=None, duration=None,
+                    batch=None, buffers=2, timeout=10, nice=None, info=None):
+        """
+        Decode the first video stream of source and return a job yielding
+        its frames, as NumPy arrays of shape (height, width, channels), or
+        (height, width) for the gray formats. pix_fmt is one of the
+        packed formats of RAW_PIX_FMTS. size is the (width, height) the
+        frames are scaled to, the size of the video by default (taken from
+        info, see probe(), if given); fps changes the frame rate, and start
+        and duration select a part of the source like in convert().
+
+        With batch, frames are yielded by batches of that many, as arrays
+        with an extra first dimension; the last batch may be shorter.
+        Without NumPy, memoryviews of the frame (or batch) data are
+        yielded instead.
+
+        ffmpeg's output is read straight into a ring of buffers, preallocated
+        buffers many, and the arrays are views on them, so no memory is
+        allocated per frame: a frame is overwritten once buffers more
+        frames (or batches) have been read, and must be copied to be kept.
+
+        source can be a streamed source like for convert(), size must then
+        be given.
+
+        >>> for frame in FFMpeg().read_frames('test1.ogg', 'rgb24', size=(320, 240), fps=5):
+        ...    frame.mean()
+        """
+        if pix_fmt not in self.RAW_PIX_FMTS:
+            raise FFMpegError('Unsupported raw pixel format: ' + str(pix_fmt))
+        if buffers < 1:
+            raise FFMpegError('At least one buffer is needed')
+
+        source_stream = None
+        if self.is_stream(source):
+            if size is None:
+                raise FFMpegError('The frame size must be given for a streamed source')
+            source_stream, source = source, 'pipe:0'
+        elif not os.path.exists(source) and not self.is_url(source):
+            raise FFMpegError("Input file doesn't exist: " + source)
+
+        if size is None:
+            info = self._source_info(source, info)
+            if info is None or info.video is None:
+                raise FFMpegError('Video stream not found')
+            size = (info.video.video_width, info.video.video_height)
+            if str(info.video.metadata.get('rotate')) in ('90', '270'):
+                # ffmpeg rotates the frames when decoding
+                size = size[::-1]
+        width, height = size
+
+        cmds = [self.ffmpeg_path, '-hide_banner', '-nostats']
+        if start:
+            cmds.extend(['-ss', parse_time(start)])
+        if duration:
+            cmds.extend(['-t', parse_time(duration)])
+        cmds.extend(['-i', source, '-map', '0:v:0', '-an', '-sn'])
+        if fps:
+            cmds.extend(['-r', str(fps)])
+        cmds.extend(['-s', '{0}x{1}'.format(width, height), '-pix_fmt', pix_fmt])
+        cmds.extend(RawvideoFormat().parse_options({'format': 'rawvideo'}))
+        cmds.append('pipe:1')
+        cmds = self._nice_cmds(cmds, nice)
+
+        dtype, sample_size, channels = self.RAW_PIX_FMTS[pix_fmt]
+        shape = (height, width, channels) if channels > 1 else (height, width)
+        return FFMpegJob(self, self._read_arrays, cmds, shape, dtype, sample_size, batch, buffers,
+                         timeout, source_stream)
+
+    def read_audio(self, source, samplerate=None, channels=None, dtype='int16', block_frames=4096,
+                   start=None, duration=None, buffers=2, timeout=10, nice=None, info=None):
+        """
+        Decode the first audio stream of source and return a job yielding
+        its samples as NumPy arrays of shape (block_frames, channels),
+        block_frames samples of each channel, interleaved; the last block
+        may be shorter. dtype is one of the sample types of
+        RAW_SAMPLE_FMTS. The audio is resampled to samplerate and mixed to
+        channels if given; channels defaults to the channels of the source
+        (taken from info, see probe(), if given). start and duration
+        select a part of the source like in convert().
+
+        As with read_frames(), the blocks are read into a ring of buffers
+        preallocated buffers many, so the memory used doesn't depend on
+        the length of the source: a block is overwritten once buffers more
+        blocks have been read, and must be copied to be kept. Without
+        NumPy, memoryviews of the block data are yielded instead.
+
+        source can be a streamed source like for convert(), channels must
+        then be given.
+
+        >>> for block in FFMpeg().read_audio('test1.ogg', 16000, 1, 'float32', 1600):
+        ...    rms = (block ** 2).mean() ** 0.5
+        """
+        dtype = self._sample_type(dtype)
+        if buffers < 1:
+            raise FFMpegError('At least one buffer is needed')
+
+        source_stream = None
+        if self.is_stream(source):
+            if channels is None:
+                raise FFMpegError('The number of channels must be given for a streamed source')
+            source_stream, source = source, 'pipe:0'
+        elif not os.path.exists(source) and not self.is_url(source):
+            raise FFMpegError("Input file doesn't exist: " + source)
+
+        if channels is None:
+            info = self._source_info(source, info)
+            if info is None or info.audio is None:
+                raise FFMpegError('Audio stream not found')
+            channels = info.audio.audio_channels
+
+        sample_dtype, sample_size, fmt = self.RAW_SAMPLE_FMTS[dtype]
+        cmds = [self.ffmpeg_path, '-hide_banner', '-nostats']
+        if start:
+            cmds.extend(['-ss', parse_time(start)])
+        if duration:
+            cmds.extend(['-t', parse_time(duration)])
+        cmds.extend(['-i', source, '-map', '0:a:0', '-vn', '-sn', '-acodec', 'pcm_' + fmt,
+                     '-ac', str(channels)])
+        if samplerate:
+            cmds.extend(['-ar', str(samplerate)])
+        cmds.extend(['-f', fmt, 'pipe:1'])
+        cmds = self._nice_cmds(cmds, nice)
+
+        return FFMpegJob(self, self._read_arrays, cmds, (channels,), sample_dtype, sample_size, block_frames,
+                         buffers, timeout, source_stream)
+
+    def _sample_type(self, dtype):
+        # Accept NumPy dtypes and scalar types as well as their names.
+        name = getattr(dtype, 'name', None) or getattr(dtype, '__name__', dtype)
+        if name not in self.RAW_SAMPLE_FMTS:
+            raise FFMpegError('Unsupported raw sample type: ' + str(dtype))
+        return name
+
+    def _read_arrays(self, job, cmds, shape, dtype, sample_size, batch, buffers, timeout, source):
+        """
+        Read ffmpeg's raw output as arrays of shape, or batches of them
+        (see read_frames()).
+        """
+        frame_size = sample_size
+        for n in shape:
+            frame_size *= n
+        ring = [bytearray(frame_size * (batch or 1)) for _ in range(buffers)]
+        if numpy is None:
+            views = [memoryview(buf) for buf in ring]
+        elif batch:
+            views = [numpy.frombuffer(buf, dtype).reshape((batch,) + shape) for buf in ring]
+        else:
+            views = [numpy.frombuffer(buf, dtype).reshape(shape) for buf in ring]
+
+        for index, length in self._read_blocks(job, cmds, ring, frame_size, timeout, source):
+            if length == len(ring[index]):
+                yield views[index]
+            elif numpy is None:
+                yield views[index][:length]
+            else:
+                yield views[index][:length // frame_size]
+
+    def _read_blocks(self, job, cmds, ring, unit, timeout, source=None):
+        """
+        Run ffmpeg and read its stdout into the buffers of ring in turn,
+        yielding (index, length) for each one filled. The last one may be
+        partly filled, with a multiple of unit bytes. Its stderr is read
+        along, and FFMpegConvertError raised if ffmpeg fails.
+        """
+        feeder = InputFeeder(source) if source is not None else None
+        capture = OutputCapture(self.STDERR_TAIL_SIZE)
+        try:
             try:
-                signal.signal(signal.SIGVTALRM, on_sigvtalrm)
-            except ValueError:
-                pass
+                p = job._spawn(cmds, feeder.stdin if feeder else PIPE)
+                if feeder:
+                    feeder.start()
+            except OSError:
+                raise FFMpegError('Error while calling ffmpeg binary')
+
+            stderr_fd = p.stderr.fileno()
+            stdout_fd = p.stdout.fileno()
+            stdout = io.FileIO(stdout_fd, 'r', closefd=False)
+            fds = [stderr_fd, stdout_fd]
+            views = [memoryview(buf) for buf in ring]
+            index = pos = 0
+
+            while fds:
+                ready, _, _ = select.select(fds, [], [], timeout or None)
+                if not ready:
+                    self._shutdown(p)
+                    capture.close()
+                    raise FFMpegTimeoutError('No output from ffmpeg for %s seconds' % timeout, ' '.join(cmds),
+                                             capture.getvalue(), pid=p.pid)
+
+                if stderr_fd in ready:
+                    data = os.read(stderr_fd, self.READ_BUFFER_SIZE)
+                    if data:
+                        capture.write(data)
+                    else:
+                        fds.remove(stderr_fd)
+
+                if stdout_fd in ready:
+                    n = stdout.readinto(views[index][pos:])
+                    if not n:
+                        fds.remove(stdout_fd)
+                        pos -= pos % unit
+                        if pos:
+                            yield index, pos
+                        continue
+                    pos += n
+                    if pos == len(ring[index]):
+                        yield index, pos
+                        index = (index + 1) % len(ring)
+                        pos = 0
+
+            capture.close()
+            for f in (p.stdin, p.stdout, p.stderr):
+                if f:
+                    f.close()
+            job._reap(p)
+        finally:
+            job._finish()
+            if feeder:
+                feeder.close(self.TERMINATE_GRACE_PERIOD)
+
+        if feeder and feeder.error:
+            raise FFMpegError('Error while reading the input stream: %s' % feeder.error)
+        self._check_returncode(cmds, capture.getvalue(), p.returncode, p.pid)
+
+    def write_frames(self, outfile, opts, width, height, pix_fmt='rgb24', fps=25, timeout=None, nice=None):
+        """
+        Encode raw frames written from Python to outfile, with opts, the
+        output options (see Converter.write_frames() to build them from
+        conversion options). The frames are width x height, in pix_fmt,
+        one of the packed formats of RAW_PIX_FMTS, at fps frames per
+        second. outfile can be an output sink like for convert().
+
+        Returns a FrameWriter to write the frames with. timeout (None by
+        default, as producing the frames may take time) stops ffmpeg if
+        it doesn't report back for that many seconds.
+        """
+        if pix_fmt not in self.RAW_PIX_FMTS:
+            raise FFMpegError('Unsupported raw pixel format: ' + str(pix_fmt))
 
-        yielded = False
-        buf = []
-        total_output = []
-        pat = re.compile(r'time=([0-9.:]+)')
+        sink = None
+        if self.is_sink(outfile):
+            sink, outfile = outfile, 'pipe:1'
 
-        while True:
-            if timeout:
-                signal.setitimer(signal.ITIMER_VIRTUAL, timeout)
+        cmds = [self.ffmpeg_path, '-hide_banner']
+        cmds.extend(RawvideoFormat().parse_options({'format': 'rawvideo'}))
+        cmds.extend(['-pix_fmt', pix_fmt, '-s', '{0}x{1}'.format(width, height), '-r', str(fps),
+                     '-i', 'pipe:0'])
+        cmds.extend(opts)
+        cmds.extend(['-y', outfile])
 
-            ret = p.stderr.read(10)
+        _, sample_size, channels = self.RAW_PIX_FMTS[pix_fmt]
+        return FrameWriter(self, cmds, width * height * channels * sample_size, timeout, nice, sink)
 
-            if timeout:
-                signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+    def write_audio(self, outfile, opts, samplerate, channels, dtype='int16', timeout=None, nice=None):
+        """
+        Encode audio samples written from Python to outfile, with opts,
+        the output options (see Converter.write_audio() to build them from
+        conversion options). The samples are of dtype, one of the types of
+        RAW_SAMPLE_FMTS, interleaved for the channels, at samplerate. outfile
+        can be an output sink like for convert().
+
+        Returns a FrameWriter, whose write() takes blocks of samples (e.g.
+        NumPy arrays of shape (frames, channels)). timeout is like for
+        write_frames().
+        """
+        _, sample_size, fmt = self.RAW_SAMPLE_FMTS[self._sample_type(dtype)]
 
-            if not ret:
-                break
+        sink = None
+        if self.is_sink(outfile):
+            sink, outfile = outfile, 'pipe:1'
 
-            total_output.append(ret)
-            buf.append(ret)
-            if '\r' in ret:
-                buf = ''.join(buf)
-                buf = buf.decode(console_encoding, 'ignore')
-                line, buf = buf.split('\r', 1)
-                buf = [buf]
-                tmp = pat.search(line)
-                if tmp:
-                    timecode = timecode_to_seconds(tmp.group(1))
+        cmds = [self.ffmpeg_path, '-hide_banner', '-f', fmt, '-ar', str(samplerate), '-ac', str(channels),
+                '-i', 'pipe:0']
+        cmds.extend(opts)
+        cmds.extend(['-y', outfile])
+        return FrameWriter(self, cmds, sample_size * channels, timeout, nice, sink)
+
+    @staticmethod
+    def _nice_cmds(cmds, nice):
+        if nice is not None:
+            if 0 < nice < 20:
+                cmds = ['nice', '-n', str(nice)] + cmds
+            else:
+                raise FFMpegError("Invalid nice value: {0}".format(nice))
+        return cmds
+
+    def _run_ffmpeg(self, job, infile, cmds, timeout=10, nice=None, get_output=False, title=None, progress=False,
+                    stall_timeout=None, deadline=None, capture=None, source=None, sink=None):
+        cmds = self._nice_cmds(cmds, nice)
+        if source is None or isinstance(source, InputFeeder):
+            feeder = source
+        else:
+            feeder = InputFeeder(source)
+        sink = OutputSink(sink) if sink is not None else None
+
+        try:
+            if 'pipe:' in cmds:
+                if infile.upper().endswith('.VOB'):
+                    infile = os.path.dirname(infile)
+                nice = cmds[0:3] if cmds[0] == 'nice' else []
+                piped_cmds = nice + ['tccat', '-i', infile, '-T', str(title) + ',-1']
+                preprocess = job._spawn(piped_cmds)
+            else:
+                preprocess = None
+
+            if preprocess:
+                stdin = preprocess.stdout
+            elif feeder:
+                stdin = feeder.stdin
+            else:
+                stdin = PIPE
+            try:
+                p = job._spawn(cmds, stdin, sink.stdout if sink else PIPE)
+                if preprocess:
+                    preprocess.stdout.close()
+                if feeder:
+                    feeder.start()
+            except OSError:
+                raise FFMpegError('Error while calling ffmpeg binary')
+
+            yielded = False
+            buf = ''
+            if capture is None:
+                capture = OutputCapture(self.STDERR_TAIL_SIZE)
+
+            stderr_fd = p.stderr.fileno()
+            fds = [stderr_fd]
+            stdout_fd = None
+            if p.stdout:
+                stdout_fd = p.stdout.fileno()
+                fds.append(stdout_fd)
+            if progress:
+                parser = ProgressParser()
+
+            # Watchdog state; all limits are measured in wall-clock time so
+            # they work the same from any thread.
+            started = last_activity = last_advance = time.time()
+            last_timecode = -1.0
+
+            while fds:
+                wait = []
+                now = time.time()
+                if timeout:
+                    wait.append(last_activity + timeout - now)
+                if stall_timeout:
+                    wait.append(last_advance + stall_timeout - now)
+                if deadline:
+                    wait.append(started + deadline - now)
+
+                if wait:
+                    ready, _, _ = select.select(fds, [], [], max(min(wait), 0))
+                else:
+                    ready, _, _ = select.select(fds, [], [])
+
+                timecodes = []
+                for fd in ready:
+                    if fd == stdout_fd and sink:
+                        last_activity = time.time()
+                        if not sink.read(fd):
+                            fds.remove(fd)
+                        continue
+
+                    ret = os.read(fd, self.READ_BUFFER_SIZE)
+                    last_activity = time.time()
+                    if not ret:
+                        fds.remove(fd)
+                        continue
+
+                    if fd == stdout_fd:
+                        if progress:
+                            timecodes.extend(parser.feed(ret))
+                        continue
+
+                    capture.write(ret)
+                    if progress:
+                        continue
+
+                    found, buf = parse_stats(buf, ret)
+                    timecodes.extend(found)
+
+                for timecode in timecodes:
+                    if timecode > last_timecode:
+                        last_timecode = timecode
+                        last_advance = time.time()
                     yielded = True
                     yield timecode
 
-        total_output = ''.join(total_output)
-        total_output = total_output.decode(console_encoding, 'ignore')
-        if not yielded:
-            # There may have been a single time, check it
-            tmp = pat.search(total_output)
-            if tmp:
-                timecode = timecode_to_seconds(tmp.group(1))
-                yielded = True
-                yield timecode
+                if not fds:
+                    break
 
-        if timeout:
-            try:
-                signal.signal(signal.SIGVTALRM, signal.SIG_DFL)
-            except ValueError:
-                pass
+                now = time.time()
+                reason = None
+                if timeout and not ready and now - last_activity >= timeout:
+                    reason = 'No output from ffmpeg for %s seconds' % timeout
+                elif stall_timeout and now - last_advance >= stall_timeout:
+                    reason = 'Progress stalled for %s seconds' % stall_timeout
+                elif deadline and now - started >= deadline:
+                    reason = 'Deadline of %s seconds exceeded' % deadline
+
+                if reason:
+                    self._shutdown(p)
+                    if preprocess:
+                        self._shutdown(preprocess, graceful=False)
+                    capture.close()
+                    raise FFMpegTimeoutError(reason, ' '.join(cmds), capture.getvalue(), pid=p.pid)
+
+            capture.close()
+            total_output = capture.getvalue()
+            if not yielded:
+                # There may have been a single time, check it
+                tmp = STATS_TIME_RE.search(total_output)
+                if tmp:
+                    timecode = timecode_to_seconds(tmp.group(1))
+                    yielded = True
+                    yield timecode
 
-        p.communicate()  # wait for process to exit
-        if preprocess:
-            preprocess.terminate()
-            preprocess.wait()
+            for f in (p.stdin, p.stdout, p.stderr):
+                if f:
+                    f.close()
+            job._reap(p)  # wait for process to exit
+            if preprocess:
+                preprocess.terminate()
+                preprocess.wait()
+        finally:
+            job._finish()
+            if feeder:
+                feeder.close(self.TERMINATE_GRACE_PERIOD)
+
+        if feeder and feeder.error:
+            raise FFMpegError('Error while reading the input stream: %s' % feeder.error)
+        if self._check_output(infile, cmds, total_output, yielded, p.pid) and get_output:
+            yield total_output
+        self._check_returncode(cmds, total_output, p.returncode, p.pid)
 
+    @staticmethod
+    def _check_output(infile, cmds, total_output, yielded, pid):
+        """
+        Raise FFMpegConvertError if ffmpeg's stderr output ends with an
+        error. Returns True if the output is complete enough to be parsed.
+        """
         if not total_output:
             raise FFMpegError('Error while calling ffmpeg binary')
 
         cmd = ' '.join(cmds)
-        if '\n' in total_output:
-            line = total_output.split('\n')[-2]
-
-            if line.startswith('Received signal'):
-                # Received signal 15: terminating.
-                raise FFMpegConvertError(line.split(':')[0], cmd, total_output, pid=p.pid)
-            if line.startswith(infile):
-                err = line[len(infile) + 2:]
-                raise FFMpegConvertError('Encoding error', cmd, total_output,
-                                         err, pid=p.pid)
-            if line.startswith('Error while '):
-                raise FFMpegConvertError('Encoding error', cmd, total_output,
-                                         line, pid=p.pid)
-            if not yielded:
-                raise FFMpegConvertError('Unknown ffmpeg error', cmd,
-                                         total_output, line, pid=p.pid)
-            if get_output:
-                yield total_output
-        if p.returncode != 0:
-            raise FFMpegConvertError('Exited with code %d' % p.returncode, cmd,
-                                     total_output, pid=p.pid)
+        if '\n' not in total_output:
+            return False
 
-    def analyze(self, infile, audio_level=True, interlacing=True, crop=False, start=None, duration=None, end=None, timeout=10, nice=None, title=None):
+        line = total_output.split('\n')[-2]
+
+        if line.startswith('Received signal'):
+            # Received signal 15: terminating.
+            raise FFMpegConvertError(line.split(':')[0], cmd, total_output, pid=pid)
+        if line.startswith(infile):
+            err = line[len(infile) + 2:]
+            raise FFMpegConvertError('Encoding error', cmd, total_output,
+                                     err, pid=pid)
+        if line.startswith('Error while '):
+            raise FFMpegConvertError('Encoding error', cmd, total_output,
+                                     line, pid=pid)
+        if not yielded:
+            raise FFMpegConvertError('Unknown ffmpeg error', cmd,
+                                     total_output, line, pid=pid)
+        return True
+
+    @staticmethod
+    def _check_returncode(cmds, total_output, returncode, pid):
+        if returncode != 0:
+            raise FFMpegConvertError('Exited with code %d' % returncode, ' '.join(cmds),
+                                     total_output, pid=pid)
+
+    def analyze(self, infile, audio_level=True, interlacing=True, crop=False, start=None, duration=None, end=None, timeout=10, nice=None, title=None,
+                stall_timeout=None, deadline=None, capture=None, job=None, info=None):
         """
         Analyze the video frames to find if the video need to be deinterlaced
         and/or crop to remove black strips.
         Analyze the audio to find if the audio need to be normalize
         and by how much. All analyses are together so FFMpeg can do them
         in the same pass.
+
+        The per-frame cropdetect output is parsed as it arrives and only
+        the tail of ffmpeg's output is kept, so memory use doesn't grow
+        with the length of the input. An OutputCapture can be passed as
+        capture, e.g. to spill the complete output to a file.
+
+        The crop analysis needs the video size, which is taken from info
+        (a MediaInfo or ffprobe dict, see probe()) if given, instead of
+        probing the file again.
+
+        Returns a job (see FFMpegJob), or a generator running as part of
+        job if one is given.
         """
+        return self._job(job, self._analyze, infile, audio_level, interlacing, crop, start, duration, end,
+                         timeout, nice, title, stall_timeout, deadline, capture, info)
+
+    def _analyze(self, job, infile, audio_level, interlacing, crop, start, duration, end, timeout, nice, title,
+                 stall_timeout, deadline, capture, info):
         if not audio_level and not interlacing and not crop:
             raise FFMpegError('Nothing selected to analyze (audio level, '
                               'interlacing or crop).')
@@ -603,8 +2484,21 @@ class FFMpeg(object):
             else:
                 opts.extend(['-to', end])
 
+        if capture is None:
+            capture = OutputCapture(self.STDERR_TAIL_SIZE)
+
+        crops = {}
+        if crop:
+            def collect_crop(line):
+                match = CROP_RE.search(line)
+                if match:
+                    crops[match.groups()] = crops.get(match.groups(), 0) + 1
+            capture.add_line_handler(collect_crop)
+
         for data in self.convert(infile, '/dev/null',
-                                 opts, timeout, nice=nice, get_output=True):
+                                 opts, timeout, nice=nice, get_output=True,
+                                 stall_timeout=stall_timeout, deadline=deadline,
+                                 capture=capture, job=job):
             if isinstance(data, float):
                 yield data
             else:
@@ -660,41 +2554,42 @@ class FFMpeg(object):
                         interlace = False
 
                 if crop:
-                    info = self.probe(infile, title=title)
-                    video = info['video']
+                    video = self._source_info(infile, info, title=title)['video']
                     size = (video['width'], video['height'])
                     fps = video.get('fps', 29.97)
-                    crop_size = parse_crop(data, size, fps)
+                    crop_size = parse_crop(crops, size, fps)
 
                 yield adjustement, interlace, crop_size
 
     def thumbnails_by_interval(self, source, output_pattern, interval=1,
                                max_width=None, max_height=None, autorotate=False,
-                               sizing_policy=None, skip=False, title=None):
+                               sizing_policy=None, skip=False, title=None, info=None):
         """
         Create one or more thumbnails of video by a specified interval.
+        info is the probe info of the source if it's already known (see
+        probe()).
         """
-        info = self.probe(source, title=title)
+        info = self._source_info(source, info, title=title)
         if 'video' not in info:
             raise ValueError("Video stream not found.")
 
-        video = info['video']
+        video = info.video
 
-        src_width = video['video_width']
-        src_height = video['video_height']
+        src_width = video.video_width
+        src_height = video.video_height
         w, h, filters = self._aspect_corrections(src_width, src_height,
                                                  max_width, max_height,
                                                  sizing_policy)
         w = self._div_by_2(w)
         h = self._div_by_2(h)
 
-        if autorotate and 'rotate' in video['tags']:
+        if autorotate and 'rotate' in video.metadata:
             rotate_filter = {
                 90: "transpose=1",
                 180: "transpose=2,transpose=2",
                 270: "transpose=2"
             }
-            raw_rotate = video['tags'].get('rotate')
+            raw_rotate = video.metadata.get('rotate')
             if raw_rotate and int(raw_rotate) in rotate_filter.keys():
                 src_rotate = int(raw_rotate)
                 # apply filter
@@ -965,16 +2860,22 @@ class FFMpeg(object):
             )
             raise FFMpegError(messages)
 
-    def thumbnails_slow(self, fname, option_list, crop=None, deinterlace=None, errors=None, nice=None):
+    def thumbnails_slow(self, fname, option_list, crop=None, deinterlace=None, errors=None, nice=None, job=None):
         """
         Create one or more thumbnails of video.
         @param option_list: a list of tuples like:
             (time, outfile, size=None, quality=DEFAULT_JPEG_QUALITY)
             see documentation of `converter.FFMpeg.thumbnail()` for details.
 
+        Returns a job (see FFMpegJob), or a generator running as part of
+        job if one is given.
+
         >>> FFMpeg().thumbnails('test1.ogg', [(5, '/tmp/shot.png', '320x240'),
         >>>                                   (10, '/tmp/shot2.png', None, 5)])
         """
+        return self._job(job, self._thumbnails_slow, fname, option_list, crop, deinterlace, errors)
+
+    def _thumbnails_slow(self, job, fname, option_list, crop, deinterlace, errors):
         if not os.path.exists(fname) and not self.is_url(fname):
             raise IOError('No such file: ' + fname)
 
@@ -1014,7 +2915,7 @@ class FFMpeg(object):
         latest_time = timecode_to_seconds(option_list[-1][0])
         start_time = time.time()
 
-        for timecode in self._run_ffmpeg(fname, cmds, nice=15):
+        for timecode in self._run_ffmpeg(job, fname, cmds, nice=15):
             yield int(round((time.time() - start_time) / latest_time * 100))
 
         for options in option_list:
@@ -1029,6 +2930,22 @@ class FFMpeg(object):
             raise FFMpegError(messages)
 
 
+def parse_stats(buf, data):
+    """
+    Scan a chunk of ffmpeg's stderr for stats lines (terminated by \\r).
+    Returns the timecodes of the complete stats lines, in order, and the
+    unterminated remainder to pass back in with the next chunk.
+    """
+    lines = re.split('[\r\n]', buf + data)
+    buf = lines.pop()
+    timecodes = []
+    for line in lines:
+        match = STATS_TIME_RE.search(line)
+        if match:
+            timecodes.append(timecode_to_seconds(match.group(1)))
+    return timecodes, buf
+
+
 def timecode_to_seconds(timecode):
     """
     Convert a valid timecode representation (a str) in seconds (as float).
@@ -1071,42 +2988,43 @@ def time_sort(options):
 
 
 def parse_crop(data, size, fps):
+    """
+    Find the crop size from cropdetect output. data is either the ffmpeg
+    output or a dict counting the (width, height, x, y) crop values seen.
+    """
     width, height = size
     # Maximum width and height of a black border.
     x_limit = width / 4
     y_limit = height / 4
     # Get all the only positive crop values.
-    matches = re.findall('crop=(\d{1,4}):(\d{1,4}):(\d{1,3}):(\d{1,3})', data)
+    if isinstance(data, dict):
+        matches = data
+    else:
+        matches = {}
+        for match in CROP_RE.findall(data):
+            matches[match] = matches.get(match, 0) + 1
     if not matches:
-        raise FFMpegConvertError('No crop data.', data)
+        raise FFMpegConvertError('No crop data.', None, data)
 
     # For each crop values, get or calculate the left, right, top and bottom
-    # values.
-    values = (
-        (
-            int(x), width - int(x) - int(crop_width),
-            int(y), height - int(y) - int(crop_height)
+    # values, and count the number of occurences of each width/height.
+    results = {
+        'left': {},
+        'right': {},
+        'top': {},
+        'bottom': {},
+    }
+    for (crop_width, crop_height, x, y), count in matches.items():
+        values = (
+            ('left', int(x), x_limit),
+            ('right', width - int(x) - int(crop_width), x_limit),
+            ('top', int(y), y_limit),
+            ('bottom', height - int(y) - int(crop_height), y_limit),
         )
-        for crop_width, crop_height, x, y in matches
-    )
-    # Regroup values by side.
-    values = zip(*values)
-
-    # Count the number of occurences of each width/height.
-    def counter(collection, limit):
-        counted = {}
-        for item in set(collection):
+        for pos, item, limit in values:
             if item > limit:
                 continue
-            counted[item] = collection.count(item)
-        return counted
-
-    results = {
-        'left': counter(values[0], x_limit),
-        'right': counter(values[1], x_limit),
-        'top': counter(values[2], y_limit),
-        'bottom': counter(values[3], y_limit),
-    }
+            results[pos][item] = results[pos].get(item, 0) + count
 
     # For each side find the larger gap between the number of frames of each
     # dimension and keep the dimension before the gap.
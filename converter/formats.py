@@ -71,11 +71,16 @@ class BaseMovMp4Format(BaseFormat):
     Base MOV/MP4 format class.
 
     Supported formats are: mov, mp4
+
+    The fragmented option writes a fragmented file, which can be written
+    to a pipe or an output sink as it doesn't need seeking back.
     """
 
     def parse_options(self, opt):
         opt_list = super(BaseMovMp4Format, self).parse_options(opt)
-        if opt.get('faststart'):
+        if opt.get('fragmented'):
+            opt_list = ['-movflags', 'frag_keyframe+empty_moov+default_base_moof'] + opt_list
+        elif opt.get('faststart'):
             opt_list = ['-movflags', 'faststart'] + opt_list
         return opt_list
 
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Cache of probe() results, keyed by the identity of the probed file.
+
+    >>> cache = ProbeCache(max_entries=10000, path='/var/cache/probe.sqlite')
+    >>> c = Converter(probe_cache=cache)
+
+A file is identified by its real path, inode, size and modification time,
+so a cached result is never used for a file that changed since it was
+probed. The results are kept in an in-memory LRU, and optionally in an
+sqlite database shared by all the processes using the same path.
+"""
+
+import collections
+import logging
+import os
+import sqlite3
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+logger = logging.getLogger(__name__)
+
+
+class ProbeCache(object):
+    """
+    LRU cache of probe() results, with an optional persistent store.
+
+    Up to max_entries results are kept in memory. If path is given, the
+    results are also stored in an sqlite database at that path, which is
+    consulted on memory misses. hits and misses count the lookups.
+
+    Cached results are shared by all the callers and must not be modified.
+    """
+
+    def __init__(self, max_entries=1024, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        if path:
+            self._db().execute('CREATE TABLE IF NOT EXISTS probe '
+                               '(key TEXT PRIMARY KEY, path TEXT, info BLOB)')
+            self._db().execute('CREATE INDEX IF NOT EXISTS probe_path ON probe (path)')
+            self._db().commit()
+
+    @staticmethod
+    def key(fname, *variant):
+        """
+        Return the cache key of the file fname, or None if it can't be
+        cached (URLs, missing files). variant holds the probe() arguments
+        that change its result.
+        """
+        try:
+            path = os.path.realpath(fname)
+            st = os.stat(path)
+        except (OSError, TypeError, ValueError):
+            return None
+        mtime_ns = getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 1000000000)
+        return (path, st.st_ino, st.st_size, mtime_ns) + variant
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._entries:
+                return True
+        return self.path is not None and self._load(key) is not None
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key in self._entries:
+                info = self._entries[key] = self._entries.pop(key)
+                self.hits += 1
+                return info
+
+        row = self._load(key) if self.path else None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+        info = pickle.loads(bytes(row[0]))
+        self._remember(key, info)
+        return info
+
+    def __setitem__(self, key, info):
+        self._remember(key, info)
+        if self.path:
+            try:
+                db = self._db()
+                with db:
+                    db.execute('INSERT OR REPLACE INTO probe (key, path, info) VALUES (?, ?, ?)',
+                               (repr(key), key[0], sqlite3.Binary(pickle.dumps(info, 2))))
+            except sqlite3.Error as e:
+                logger.warning("Can't store in probe cache %s: %s", self.path, e)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def invalidate(self, fname=None):
+        """
+        Forget the results of the file fname (all of them if fname is None).
+        """
+        path = None if fname is None else os.path.realpath(fname)
+        with self._lock:
+            for key in list(self._entries):
+                if path is None or key[0] == path:
+                    del self._entries[key]
+
+        if self.path:
+            db = self._db()
+            with db:
+                if path is None:
+                    db.execute('DELETE FROM probe')
+                else:
+                    db.execute('DELETE FROM probe WHERE path = ?', (path,))
+
+    def _remember(self, key, info):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = info
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _load(self, key):
+        try:
+            return self._db().execute('SELECT info FROM probe WHERE key = ?', (repr(key),)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning('Probe cache %s is unreadable: %s', self.path, e)
+            return None
+
+    def _db(self):
+        # sqlite connections can't be shared between threads.
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30)
+        return db
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""
+Run conversions, analyses and thumbnail jobs on a pool of worker threads.
+
+The jobs returned by Converter only make progress while they are iterated.
+JobRunner iterates them on a bounded pool of threads and returns futures,
+so many jobs can be run in parallel without any threading code in the
+application:
+
+    >>> runner = JobRunner(max_workers=8)
+    >>> future = runner.submit_convert('test1.ogg', '/tmp/output.ogg', options,
+    ...                                progress_callback=lambda f, p: log(p))
+    >>> result = future.result()
+    >>> result.outfile, result.run_time, result.returncode
+
+Needs concurrent.futures (the futures backport on Python 2).
+"""
+
+import logging
+import multiprocessing
+import sys
+import threading
+import time
+
+try:
+    from concurrent.futures import Future, ThreadPoolExecutor
+except ImportError:
+    Future = object
+    ThreadPoolExecutor = None
+
+from converter import Converter, ConverterError
+from converter.ffmpeg import FFMpegJob
+
+logger = logging.getLogger(__name__)
+
+
+class JobResult(object):
+    """
+    Result of a job run by JobRunner: what was done, when, and how ffmpeg
+    exited.
+
+    For analyses, value holds the result yielded by Converter.analyze()
+    (the audio adjustment, interlacing and crop size). returncode and pid
+    are those of the last ffmpeg process run by the job, and rusage the
+    resource usage of all its processes; they are None for thumbnail
+    jobs, which can run several short processes.
+    copied lists the streams copied by conversions run with smart_copy.
+    """
+
+    def __init__(self, kind, infile, outfile, submitted):
+        self.kind = kind
+        self.infile = infile
+        self.outfile = outfile
+        self.value = None
+        self.submitted = submitted
+        self.started = None
+        self.finished = None
+        self.returncode = None
+        self.pid = None
+        self.rusage = None
+        self.copied = []
+
+    @property
+    def wait_time(self):
+        """
+        Seconds spent waiting for a free worker, or None if the job
+        didn't start.
+        """
+        if self.started is None:
+            return None
+        return self.started - self.submitted
+
+    @property
+    def run_time(self):
+        """
+        Wall-clock running time of the job in seconds, or None if it
+        didn't start or finish.
+        """
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def __repr__(self):
+        run_time = self.run_time
+        return 'JobResult(kind=%s, infile=%s, outfile=%s, returncode=%s, run_time=%s)' % (
+            self.kind, self.infile, self.outfile, self.returncode,
+            run_time if run_time is None else '%.2f' % run_time)
+
+
+class JobFuture(Future):
+    """
+    Future of a job submitted to JobRunner, resolving to a JobResult.
+
+    Besides the usual done callbacks, progress callbacks can be added;
+    they are called from the worker thread as fn(future, progress) with
+    each progress item yielded by the job. progress holds the last one.
+    cancel() only works for jobs that haven't started yet; use stop() to
+    stop a running job.
+    """
+
+    def __init__(self, kind, infile, outfile):
+        super(JobFuture, self).__init__()
+        self.job = None
+        self.progress = None
+        self.job_result = JobResult(kind, infile, outfile, time.time())
+        self._progress_callbacks = []
+
+    def add_progress_callback(self, fn):
+        self._progress_callbacks.append(fn)
+
+    def stop(self, graceful=True):
+        """
+        Stop the job if it is running (see FFMpegJob.stop()). Returns False
+        if the job isn't running.
+        """
+        job = self.job
+        if not isinstance(job, FFMpegJob):
+            return False
+        job.stop(graceful)
+        return True
+
+    def _set_progress(self, progress):
+        self.progress = progress
+        for fn in self._progress_callbacks:
+            try:
+                fn(self, progress)
+            except Exception:
+                logger.exception('exception calling progress callback for %r', self)
+
+
+class JobRunner(object):
+    """
+    Runs Converter jobs on a pool of at most max_workers threads (the
+    number of CPUs by default), each driving one ffmpeg process at a time.
+    All jobs share the converter, which defaults to a new Converter.
+
+    >>> with JobRunner(max_workers=4) as runner:
+    ...     futures = [runner.submit_convert(f, f + '.ogg', options) for f in files]
+    """
+
+    def __init__(self, converter=None, max_workers=None):
+        if ThreadPoolExecutor is None:
+            raise ConverterError('JobRunner needs concurrent.futures (the futures package on Python 2)')
+
+        if max_workers is None:
+            max_workers = multiprocessing.cpu_count()
+        if max_workers < 1:
+            raise ConverterError('max_workers must be at least 1')
+
+        self.converter = converter or Converter()
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.shutdown()
+        return False
+
+    def submit_convert(self, infile, outfile, options, progress_callback=None, **kwargs):
+        """
+        Submit a conversion. The arguments are those of Converter.convert();
+        the progress is the percentage done.
+        """
+        return self._submit('convert', infile, outfile, progress_callback,
+                            self.converter.convert, (infile, outfile, options), kwargs)
+
+    def submit_analyze(self, infile, progress_callback=None, **kwargs):
+        """
+        Submit an analysis. The arguments are those of Converter.analyze();
+        the result's value holds the analysis results.
+        """
+        return self._submit('analyze', infile, None, progress_callback,
+                            self.converter.analyze, (infile,), kwargs)
+
+    def submit_thumbnails(self, fname, option_list, progress_callback=None, **kwargs):
+        """
+        Submit thumbnails extraction. The arguments are those of
+        Converter.thumbnails(); the result's outfile is the list of the
+        created images.
+        """
+        outfiles = [options[1] for options in option_list]
+        return self._submit('thumbnails', fname, outfiles, progress_callback,
+                            self.converter.thumbnails, (fname, option_list), kwargs)
+
+    def _submit(self, kind, infile, outfile, progress_callback, fn, args, kwargs):
+        future = JobFuture(kind, infile, outfile)
+        if progress_callback is not None:
+            future.add_progress_callback(progress_callback)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._forget)
+        self._executor.submit(self._run, future, fn, args, kwargs)
+        return future
+
+    def _forget(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    @staticmethod
+    def _run(future, fn, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        result = future.job_result
+        result.started = time.time()
+        try:
+            job = future.job = fn(*args, **kwargs)
+            for item in job:
+                if result.kind == 'analyze' and isinstance(item, tuple):
+                    result.value = item
+                else:
+                    future._set_progress(item)
+        except Exception:
+            result.finished = time.time()
+            future.set_exception(sys.exc_info()[1])
+            return
+
+        result.finished = time.time()
+        if isinstance(job, FFMpegJob):
+            result.returncode = job.returncode
+            result.pid = job.pid
+            result.rusage = job.rusage
+            result.copied = job.copied
+        future.set_result(result)
+
+    def stop(self):
+        """
+        Cancel the jobs that haven't started yet and stop the running ones.
+        """
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            if not future.cancel() and isinstance(future.job, FFMpegJob):
+                future.job.terminate()
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting jobs and, if wait is True, wait for the submitted
+        ones to finish.
+        """
+        self._executor.shutdown(wait=wait)
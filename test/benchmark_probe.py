@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Compare the time taken by the probe profiles.
+
+    python benchmark_probe.py [-n ROUNDS] [file ...]
+
+Without files, short MP4 and Matroska samples are created from test1.ogg.
+Each file is probed ROUNDS times with every profile, without a cache.
+"""
+
+# modify the path so that parent directory is in it
+import sys
+
+sys.path.append('../')
+
+import optparse
+import os
+import shutil
+import tempfile
+import time
+
+from converter.ffmpeg import FFMpeg
+
+
+def make_samples(f, temp_dir):
+    samples = []
+    for ext, codecs in (('mp4', ['-c:v', 'libx264', '-c:a', 'aac']),
+                        ('mkv', ['-c:v', 'libvpx', '-c:a', 'libvorbis'])):
+        fname = os.path.join(temp_dir, 'sample.' + ext)
+        list(f.convert('test1.ogg', fname, ['-t', '5', '-s', '320x176'] + codecs))
+        samples.append(fname)
+    return samples
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-n ROUNDS] [file ...]')
+    parser.add_option('-n', '--rounds', type='int', default=50)
+    options, fnames = parser.parse_args()
+
+    f = FFMpeg()
+    temp_dir = None
+    if not fnames:
+        temp_dir = tempfile.mkdtemp()
+        fnames = make_samples(f, temp_dir)
+
+    try:
+        for fname in fnames:
+            print os.path.basename(fname)
+            for profile in f.PROBE_PROFILES:
+                start = time.time()
+                for _ in range(options.rounds):
+                    f.probe(fname, profile=profile)
+                per_probe = (time.time() - start) / options.rounds
+                print '  %-8s %8.2f ms' % (profile, per_probe * 1000)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
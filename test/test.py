@@ -5,14 +5,22 @@ import sys
 
 sys.path.append('../')
 
+import io
+import multiprocessing
 import random
+import resource
 import string
 import shutil
+import threading
+import traceback
 import unittest
 import os
 from os.path import join as pjoin
 
-from converter import ffmpeg, formats, avcodecs, Converter, ConverterError
+from converter import ffmpeg, formats, avcodecs, aio, capabilities, chunks, containers, distributed, runner
+from converter import Converter, ConverterError, Preset
+from converter import ProbeCache
+from converter import ContainerError, is_faststart, make_faststart
 
 
 def verify_progress(p):
@@ -33,6 +41,10 @@ def verify_progress(p):
     return True
 
 
+def run_worker(queue_dir):
+    distributed.Worker(queue_dir, lease_timeout=10).run(poll_interval=0.1, idle_timeout=60)
+
+
 class TestFFMpeg(unittest.TestCase):
     def setUp(self):
         current_dir = os.path.abspath(os.path.dirname(__file__))
@@ -105,6 +117,264 @@ class TestFFMpeg(unittest.TestCase):
                                      'MediaStreamInfo(type=audio, codec=vorbis, channels=2, rate=48000, '
                                      'bitrate=80000, ENCODER=ffmpeg2theora 0.19)])')
 
+    def test_media_info(self):
+        info = ffmpeg.FFMpeg().probe('test1.ogg')
+        self.assertTrue(isinstance(info.video, ffmpeg.MediaStreamInfo))
+
+        # dict-style access keeps the old keys and units
+        self.assertEqual(['ogg'], info['container'])
+        self.assertEqual('ogg', info['extension'])
+        self.assertAlmostEqual(33.00, info['format']['duration'], places=0)
+        self.assertTrue('video' in info and 'audio' in info)
+        self.assertFalse('subtitle' in info)
+        self.assertEqual([info.video], info['videos'])
+        self.assertEqual(720, info['video']['width'])
+        self.assertEqual('theora', info['video']['codec'])
+        self.assertEqual(25.0, info['video'].get('fps', 29.97))
+        self.assertEqual(80, info['audio']['bitrate'])
+        self.assertEqual(48000, info['audio']['samplerate'])
+        self.assertEqual(0.04, info['video']['time_base'])
+
+        raw = {'format': {'format_name': 'mov,mp4', 'duration': '10.5', 'bit_rate': '1500000'},
+               'streams': [{'index': 0, 'codec_type': 'video', 'codec_name': 'H264', 'width': 640,
+                            'avg_frame_rate': '0/0', 'r_frame_rate': '30000/1001', 'level': 31,
+                            'tags': {'rotate': '90'}}]}
+        info = ffmpeg.MediaInfo(raw)
+        self.assertEqual('h264', info.video.codec)
+        self.assertAlmostEqual(29.97, info.video.video_fps, places=2)
+        self.assertEqual(0, info['video']['fps'])
+        self.assertEqual(3.1, info['video']['level'])
+        self.assertEqual(90, info['video']['tags']['rotate'])
+
+        # the values can be changed in place, as in the dicts
+        info['video']['tags']['rotate'] = 180
+        info['video']['language'] = 'eng'
+        self.assertEqual(180, info['video']['tags']['rotate'])
+        self.assertEqual('eng', info['video']['language'])
+        self.assertTrue('language' in info['video'].keys())
+        self.assertEqual('90', raw['streams'][0]['tags']['rotate'])
+        self.assertEqual(1.5, info['format']['bitrate'])
+        self.assertEqual(1500000, info.format.bitrate)
+        self.assertEqual(None, info.audio)
+        self.assertEqual(None, info.video.bitrate)
+
+    def test_probe_cache(self):
+        source = pjoin(self.temp_dir, 'source.ogg')
+        shutil.copy('test1.ogg', source)
+        db = pjoin(self.temp_dir, 'probe.sqlite')
+
+        cache = ProbeCache(max_entries=1, path=db)
+        f = ffmpeg.FFMpeg(probe_cache=cache)
+        info = f.probe(source)
+        self.assertTrue(f.probe(source) is info)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        self.assertFalse(f.probe(source, posters_as_video=True) is info)
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+        self.assertEqual(1, len(cache))
+
+        # the store is shared with other caches (and processes)
+        other = ProbeCache(path=db)
+        self.assertEqual(info, ffmpeg.FFMpeg(probe_cache=other).probe(source))
+        self.assertEqual(1, other.hits)
+
+        # a modified file is probed again
+        with open(source, 'ab') as fd:
+            fd.write(b'\0')
+        f.probe(source)
+        self.assertEqual(1, cache.hits)
+
+        cache.invalidate(source)
+        self.assertEqual(0, len(cache))
+        self.assertEqual(None, cache.key('nonexistent'))
+        f.probe(source)
+        self.assertEqual(1, cache.hits)
+
+    def test_probe_many(self):
+        c = Converter()
+        fnames = ['test1.ogg', 'nonexistent', 'test.mp3', '/etc/passwd'] * 3
+        results = list(c.probe_many(iter(fnames), concurrency=4))
+        self.assertEqual(sorted(fnames), sorted(fname for fname, _ in results))
+        for fname, info in results:
+            if fname == 'nonexistent':
+                self.assertEqual(None, info)
+            elif fname == 'test1.ogg':
+                self.assertEqual(c.probe(fname), info)
+
+        # abandoning the batch doesn't leave ffprobe processes behind
+        batch = c.probe_many(['test1.ogg'] * 10, concurrency=5)
+        next(batch)
+        batch.close()
+
+    def test_probe_profiles(self):
+        f = ffmpeg.FFMpeg(probe_profile='fast')
+        self.assertRaisesSpecific(ffmpeg.FFMpegError, ffmpeg.FFMpeg, probe_profile='nonexistent')
+        self.assertTrue('-probesize' in f._probe_cmds('test1.ogg'))
+        self.assertTrue('-show_streams' in f._probe_cmds('test1.ogg', 'full'))
+
+        full = f.probe('test1.ogg', profile='full')
+        fast = f.probe('test1.ogg')
+        self.assertEqual(full.format.duration, fast.format.duration)
+        self.assertEqual(repr(full.video), repr(fast.video))
+        self.assertEqual(repr(full.audio), repr(fast.audio))
+        self.assertEqual(None, f._deeper_probe_profile('fast', fast))
+
+        # incomplete results are probed again with the deeper profile
+        del fast._raw['streams'][0]['width']
+        fast = ffmpeg.MediaInfo(fast._raw)
+        self.assertEqual('full', f._deeper_probe_profile('fast', fast))
+        self.assertEqual(None, f._deeper_probe_profile('full', fast))
+
+        info = f.probe('test1.ogg', select_streams='a')
+        self.assertEqual(['audio'], [s.type for s in info.streams])
+
+        self.assertEqual(full, dict(f.probe_many(['test1.ogg'], profile='full'))['test1.ogg'])
+
+    def test_probe_native(self):
+        f = ffmpeg.FFMpeg(probe_profile='native')
+        sources = {
+            'mp4': ['-c:v', 'libx264', '-c:a', 'aac', '-ac', '2'],
+            'mov': ['-c:v', 'mjpeg', '-c:a', 'aac'],
+            'mkv': ['-c:v', 'libvpx', '-c:a', 'libvorbis', '-metadata:s:a', 'language=fre'],
+        }
+        for ext, codecs in sources.items():
+            source = pjoin(self.temp_dir, 'source.' + ext)
+            list(f.convert('test1.ogg', source, ['-t', '2', '-s', '320x176'] + codecs))
+
+            raw = containers.read_header(source)
+            self.assertTrue(raw is not None, ext)
+            native = f.probe(source)
+            full = f.probe(source, profile='full')
+            self.assertEqual(raw, native._raw)
+            self.assertEqual(full['container'], native['container'])
+            self.assertAlmostEqual(full.format.duration, native.format.duration, places=1)
+            self.assertEqual([s.type for s in full.streams], [s.type for s in native.streams])
+            for attr in ('codec', 'video_width', 'video_height', 'video_fps', 'audio_channels',
+                         'audio_samplerate'):
+                self.assertEqual(getattr(full.video, attr), getattr(native.video, attr), (ext, attr))
+                self.assertEqual(getattr(full.audio, attr), getattr(native.audio, attr), (ext, attr))
+            self.assertEqual(full.audio.metadata.get('language'), native.audio.metadata.get('language'))
+
+        # other formats fall back to ffprobe
+        self.assertEqual(None, containers.read_header('test1.ogg'))
+        self.assertEqual(repr(f.probe('test1.ogg', profile='full')), repr(f.probe('test1.ogg')))
+        self.assertEqual(None, f.probe('/etc/passwd'))
+        self.assertEqual(None, containers.read_header('nonexistent'))
+
+    def test_faststart(self):
+        f = ffmpeg.FFMpeg()
+        source = pjoin(self.temp_dir, 'source.mp4')
+        fast = pjoin(self.temp_dir, 'fast.mp4')
+        list(f.convert('test1.ogg', source, ['-t', '5', '-c:v', 'libx264', '-c:a', 'aac']))
+        self.assertFalse(is_faststart(source))
+        self.assertFalse(is_faststart('test1.ogg'))
+
+        make_faststart(source, fast)
+        self.assertTrue(is_faststart(fast))
+        self.assertEqual(os.path.getsize(source), os.path.getsize(fast))
+
+        # the packets are unchanged
+        digests = []
+        for fname in (source, fast):
+            digest = fname + '.md5'
+            list(f.convert(fname, digest, ['-map', '0', '-c', 'copy', '-f', 'md5']))
+            with open(digest) as fd:
+                digests.append(fd.read())
+        self.assertEqual(digests[0], digests[1])
+
+        self.assertRaisesSpecific(ContainerError, make_faststart, 'test1.ogg', pjoin(self.temp_dir, 'x.mp4'))
+        self.assertRaisesSpecific(ContainerError, make_faststart, fast, fast)
+
+    def test_capabilities(self):
+        cache_dir = capabilities.CACHE_DIR
+        capabilities.CACHE_DIR = pjoin(self.temp_dir, 'cache')
+        capabilities.clear_cache()
+        try:
+            c = Converter(check_capabilities=True)
+            caps = c.ffmpeg.capabilities
+            self.assertTrue(caps.version)
+            self.assertTrue('libtheora' in caps.encoders and 'libvorbis' in caps.encoders)
+            self.assertTrue('ogg' in caps.muxers and 'matroska' in caps.muxers)
+            self.assertTrue('scale' in caps.filters)
+            self.assertTrue(c.ffmpeg.capabilities is caps)
+            self.assertEqual(1, len(os.listdir(capabilities.CACHE_DIR)))
+
+            # other processes reuse the results stored on disk
+            capabilities.clear_cache()
+            run, capabilities._run = capabilities._run, None
+            try:
+                self.assertEqual(caps.as_dict(), c.ffmpeg.capabilities.as_dict())
+            finally:
+                capabilities._run = run
+
+            # unsupported codecs and formats are rejected before running ffmpeg
+            key = capabilities._key(c.ffmpeg.ffmpeg_path)
+            capabilities._cache[key] = capabilities.Capabilities(encoders=['libvorbis'], muxers=['ogg'])
+            opts = {'format': 'ogg', 'audio': {'codec': 'vorbis'}}
+            video = {'codec': 'theora', 'max_width': 320, 'max_height': 200, 'src_width': 720, 'src_height': 400}
+            self.assertEqual(['-acodec', 'libvorbis', '-vn', '-sn', '-f', 'ogg'], c.parse_options(opts))
+            self.assertRaisesSpecific(ConverterError, c.parse_options, dict(opts, format='mkv'))
+            self.assertRaisesSpecific(ConverterError, c.parse_options,
+                                      dict(opts, video=video))
+            # unknown capabilities don't reject anything
+            capabilities._cache[key] = capabilities.Capabilities()
+            c.parse_options(dict(opts, format='mkv'))
+            c.check_capabilities = False
+            c.parse_options(dict(opts, video=video))
+        finally:
+            capabilities.CACHE_DIR = cache_dir
+            capabilities.clear_cache()
+
+    def test_capabilities_parse(self):
+        encoders = ('Encoders:\n V..... = Video\n A..... = Audio\n ------\n'
+                    ' V....D libx264              libx264 H.264 (codec h264)\n'
+                    ' A....D libvorbis            libvorbis\n')
+        filters = ' TSC scale             V->V       Scale the input video size\n'
+        for muxers in ('File formats:\n D. = Demuxing supported\n .E = Muxing supported\n --\n'
+                       '  E 3g2             3GP2 (3GPP2 file format)\n'
+                       ' DE matroska,webm   Matroska / WebM\n'
+                       ' D  aac             raw ADTS AAC\n',
+                       'Formats:\n D.. = Demuxing supported\n .E. = Muxing supported\n'
+                       ' ..d = Is a device\n ---\n'
+                       '  E  3g2             3GP2 (3GPP2 file format)\n'
+                       ' DE  matroska,webm   Matroska / WebM\n'
+                       ' D   aac             raw ADTS AAC\n'):
+            caps = capabilities.parse('ffmpeg version 6.0 Copyright\n', encoders, muxers, filters)
+            self.assertEqual('6.0', caps.version)
+            self.assertEqual(set(['libx264', 'h264', 'libvorbis']), caps.encoders)
+            self.assertEqual(set(['3g2', 'matroska', 'webm']), caps.muxers)
+            self.assertEqual(set(['scale']), caps.filters)
+
+        self.assertEqual(None, capabilities.parse('', encoders, 'Formats:\n', filters))
+
+    def test_probe_info_reuse(self):
+        c = Converter()
+        info = c.probe('test1.ogg')
+        self.assertTrue(c.ffmpeg._source_info('test1.ogg', info) is info)
+        self.assertEqual(info, c.ffmpeg._source_info('test1.ogg', info._raw))
+        self.assertRaisesSpecific(ffmpeg.FFMpegError, c.ffmpeg._source_info, 'test1.ogg', 'bogus')
+
+        def no_probe(*args, **kwargs):
+            raise AssertionError('source probed again')
+        c.ffmpeg.probe = no_probe
+
+        conv = c.convert('test1.ogg', self.video_file_path, {
+            'format': 'ogg', 'duration': 1,
+            'audio': {'codec': 'copy'}, 'video': {'codec': 'copy'}}, info=info._raw)
+        self.assertTrue(list(conv))
+        self.assertTrue(os.path.exists(self.video_file_path))
+
+        results = list(c.analyze('test1.ogg', audio_level=False, interlacing=False, crop=True,
+                                 duration=2, info=info))[-1]
+        self.assertEqual(4, len(results[2].split(':')))
+
+        self.assertFalse('error' in list(c.validate('test1.ogg', duration=1, info=info)))
+
+        self.ensure_notexist(self.shot_file_path)
+        c.thumbnails_by_interval('test1.ogg', self.shot_file_path, interval=60, max_width=360,
+                                 max_height=200, info=info)
+        self.assertTrue(os.path.exists(self.shot_file_path))
+        os.unlink(self.shot_file_path)
+
     def test_ffmpeg_convert(self):
         f = ffmpeg.FFMpeg()
 
@@ -130,6 +400,152 @@ class TestFFMpeg(unittest.TestCase):
 
         self._assert_converted_video_file()
 
+    def test_ffmpeg_convert_stream(self):
+        f = ffmpeg.FFMpeg()
+        convert_options = [
+            '-acodec', 'libvorbis', '-ab', '16k', '-ac', '1', '-ar', '11025',
+            '-vcodec', 'libtheora', '-r', '15', '-s', '360x200', '-b', '128k']
+
+        with open('test1.ogg', 'rb') as source:
+            self.assertTrue(list(f.convert(source, self.video_file_path, list(convert_options))))
+        self._assert_converted_video_file()
+
+        with open('test1.ogg', 'rb') as source:
+            blocks = iter(lambda: source.read(4096), b'')
+            self.assertTrue(list(f.convert(blocks, self.video_file_path, list(convert_options))))
+        self._assert_converted_video_file()
+
+        fd = os.open('test1.ogg', os.O_RDONLY)
+        try:
+            self.assertTrue(list(f.convert(fd, self.video_file_path, list(convert_options))))
+        finally:
+            os.close(fd)
+        self._assert_converted_video_file()
+
+        def failing():
+            yield b'OggS'
+            raise IOError('connection lost')
+
+        self.assertRaisesSpecific(ffmpeg.FFMpegError, list,
+                                  f.convert(failing(), self.video_file_path, list(convert_options)))
+
+        c = Converter()
+        options = {'format': 'ogg', 'audio': {'codec': 'vorbis'}, 'video': {'codec': 'theora'}}
+        with open('test1.ogg', 'rb') as source:
+            self.assertRaisesSpecific(ConverterError, list, c.convert(source, self.video_file_path, options))
+            self.assertRaisesSpecific(ConverterError, list,
+                                      c.convert(source, self.video_file_path, options, twopass=True,
+                                                info=c.probe('test1.ogg')))
+
+        with open('test1.ogg', 'rb') as source:
+            conv = c.convert(source, self.video_file_path, options, info=c.probe('test1.ogg'))
+            self.assertTrue(verify_progress(conv))
+
+    def test_ffmpeg_convert_sink(self):
+        f = ffmpeg.FFMpeg()
+        convert_options = [
+            '-acodec', 'libvorbis', '-ab', '16k', '-ac', '1', '-ar', '11025',
+            '-vcodec', 'libtheora', '-r', '15', '-s', '360x200', '-b', '128k', '-f', 'ogg']
+
+        with open(self.video_file_path, 'wb') as sink:
+            self.assertTrue(list(f.convert('test1.ogg', sink, list(convert_options))))
+        self._assert_converted_video_file()
+
+        blocks = []
+        self.assertTrue(list(f.convert('test1.ogg', lambda block: blocks.append(block.tobytes()),
+                                       list(convert_options))))
+        with open(self.video_file_path, 'wb') as out:
+            out.write(b''.join(blocks))
+        self._assert_converted_video_file()
+
+        def failing(block):
+            raise IOError('upload failed')
+
+        self.assertRaisesSpecific(IOError, list, f.convert('test1.ogg', failing, list(convert_options)))
+        self.assertRaisesSpecific(ffmpeg.FFMpegError, f.convert, 'test1.ogg', failing, [], progress=True)
+
+        self.assertEqual(['-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4'],
+                         formats.Mp4Format().parse_options({'format': 'mp4', 'fragmented': True}))
+
+    def test_ffmpeg_read_frames(self):
+        if ffmpeg.numpy is None:
+            self.skipTest('numpy is not available')
+        f = ffmpeg.FFMpeg()
+
+        frames = [frame.copy() for frame in f.read_frames('test1.ogg', size=(64, 48), fps=5, duration=2)]
+        self.assertEqual(10, len(frames))
+        self.assertEqual((48, 64, 3), frames[0].shape)
+        self.assertEqual('uint8', frames[0].dtype)
+        self.assertTrue(frames[0].any())
+
+        batches = list(f.read_frames('test1.ogg', 'gray', size=(64, 48), fps=5, duration=2, batch=4))
+        self.assertEqual([(4, 48, 64), (4, 48, 64), (2, 48, 64)], [batch.shape for batch in batches])
+        # the batches share the two buffers of the ring
+        self.assertTrue(batches[0].base is batches[2].base)
+
+        frame = next(iter(f.read_frames('test1.ogg', duration=1)))
+        self.assertEqual((400, 720, 3), frame.shape)
+
+        self.assertRaisesSpecific(ffmpeg.FFMpegError, f.read_frames, 'test1.ogg', 'yuv420p')
+        self.assertRaisesSpecific(ffmpeg.FFMpegError, f.read_frames, io.BytesIO(b''))
+
+    def test_write_frames(self):
+        if ffmpeg.numpy is None:
+            self.skipTest('numpy is not available')
+        numpy = ffmpeg.numpy
+        c = Converter()
+        options = {'format': 'ogg', 'video': {'codec': 'theora', 'max_width': 160, 'fps': 10}}
+
+        frame = numpy.zeros((120, 320, 3), numpy.uint8)
+        with c.write_frames(self.video_file_path, options, 320, 120, fps=10) as writer:
+            for i in range(20):
+                frame[:, :, 0] = i * 10
+                writer.write(frame)
+            writer.write(numpy.zeros((5, 120, 320, 3), numpy.uint8))
+            self.assertRaisesSpecific(ffmpeg.FFMpegError, writer.write, frame[:, :100])
+
+        info = c.probe(self.video_file_path)
+        self.assertEqual('theora', info.video.codec)
+        self.assertEqual(160, info.video.video_width)
+        self.assertAlmostEqual(2.5, info.format.duration, places=0)
+
+        frames = list(f.copy() for f in c.ffmpeg.read_frames(self.video_file_path, size=(160, 60)))
+        self.assertEqual(25, len(frames))
+        self.assertTrue(frames[10][:, :, 0].mean() > frames[1][:, :, 0].mean())
+
+        self.assertRaisesSpecific(ConverterError, c.write_frames, self.video_file_path,
+                                  {'format': 'ogg', 'audio': {'codec': 'vorbis'}}, 320, 120)
+
+    def test_audio_blocks(self):
+        if ffmpeg.numpy is None:
+            self.skipTest('numpy is not available')
+        numpy = ffmpeg.numpy
+        c = Converter()
+
+        blocks = list(b.copy() for b in c.ffmpeg.read_audio('test1.ogg', 16000, 1, 'float32', 4000, duration=2))
+        self.assertEqual([(4000, 1)] * 8, [block.shape for block in blocks])
+        self.assertEqual('float32', blocks[0].dtype)
+        self.assertTrue(numpy.abs(numpy.concatenate(blocks)).max() <= 1.0)
+
+        block = next(iter(c.ffmpeg.read_audio('test1.ogg', block_frames=1024, buffers=1)))
+        self.assertEqual((1024, 2), block.shape)
+        self.assertEqual('int16', block.dtype)
+
+        options = {'format': 'wav', 'audio': {'codec': 'wav', 'channels': 1, 'samplerate': 8000}}
+        tone = (numpy.sin(numpy.arange(16000) * 2 * numpy.pi * 440 / 16000) * 10000).astype(numpy.int16)
+        wav_file_path = pjoin(self.temp_dir, 'output.wav')
+        with c.write_audio(wav_file_path, options, 16000, 1) as writer:
+            for start in range(0, len(tone), 4000):
+                writer.write(tone[start:start + 4000])
+
+        info = c.probe(wav_file_path)
+        self.assertEqual('pcm_s16le', info.audio.codec)
+        self.assertEqual(8000, info.audio.audio_samplerate)
+        self.assertAlmostEqual(1.0, info.format.duration, places=1)
+
+        self.assertRaisesSpecific(ffmpeg.FFMpegError, c.ffmpeg.read_audio, 'test1.ogg', dtype='float64')
+        self.assertRaisesSpecific(ConverterError, c.write_audio, wav_file_path, {'format': 'wav'}, 16000, 1)
+
     def _assert_converted_video_file(self):
         """
             Asserts converted test1.ogg (in path self.video_file_path) is converted correctly
@@ -151,6 +567,231 @@ class TestFFMpeg(unittest.TestCase):
         self.assertEqual(1, info.audio.audio_channels)
         self.assertEqual(11025, info.audio.audio_samplerate)
 
+    def test_ffmpeg_progress(self):
+        parser = ffmpeg.ProgressParser()
+        self.assertEqual([], parser.feed(b'frame=10\nfps=25.0\nbitrate= 128.5kbits/s\ntotal_size=4096\n'))
+        records = parser.feed(b'out_time_us=1500000\nspeed=1.5x\nprogress=continue\nframe=N/A\nprogress=end\n')
+        self.assertEqual(2, len(records))
+        self.assertAlmostEqual(1.5, records[0].out_time)
+        self.assertEqual(10, records[0].frame)
+        self.assertAlmostEqual(128.5, records[0].bitrate)
+        self.assertAlmostEqual(1.5, records[0].speed)
+        self.assertEqual(4096, records[0].total_size)
+        self.assertEqual('continue', records[0].status)
+        self.assertEqual(None, records[1].frame)
+        self.assertEqual('end', records[1].status)
+
+        timecodes, buf = ffmpeg.parse_stats(b'', b'Input #0\nframe=1 time=00:00:01.00 x\r'
+                                                 b'frame=2 time=00:00:02.50 x\rfr')
+        self.assertEqual(([1.0, 2.5], b'fr'), (timecodes, buf))
+        self.assertEqual(([3.0], b''), ffmpeg.parse_stats(buf, b'ame=3 time=00:00:03.00 x\r'))
+
+        f = ffmpeg.FFMpeg()
+        convert_options = [
+            '-acodec', 'libvorbis', '-ab', '16k', '-ac', '1', '-ar', '11025',
+            '-vcodec', 'libtheora', '-r', '15', '-s', '360x200', '-b', '128k']
+        conv = f.convert('test1.ogg', self.video_file_path, convert_options, progress=True)
+        records = list(conv)
+        self.assertTrue(records)
+        self.assertTrue(all(isinstance(r, ffmpeg.FFMpegProgress) for r in records))
+        self.assertEqual(sorted(records), records)
+        self.assertEqual('end', records[-1].status)
+        self.assertTrue(records[-1].frame > 0)
+
+    def test_ffmpeg_capture(self):
+        lines = []
+        capture = ffmpeg.OutputCapture(tail_size=16, line_handler=lines.append)
+        capture.write(b'frame=1 crop=100:80:2:4\rframe=2 crop=100:80:2:4\nError while dec')
+        capture.write(b'oding stream #0:0\nsummary')
+        capture.close()
+        self.assertEqual(['frame=1 crop=100:80:2:4', 'frame=2 crop=100:80:2:4',
+                          'Error while decoding stream #0:0', 'summary'], lines)
+        self.assertEqual('eam #0:0\nsummary', capture.getvalue())
+        self.assertEqual(88, capture.total_size)
+
+        crops = {('100', '80', '2', '4'): 40, ('104', '80', '0', '4'): 2}
+        self.assertEqual('92:72:6:8', ffmpeg.parse_crop(crops, (104, 88), 25))
+        self.assertEqual(ffmpeg.parse_crop(crops, (104, 88), 25),
+                         ffmpeg.parse_crop('crop=100:80:2:4\n' * 40 + 'crop=104:80:0:4\n' * 2, (104, 88), 25))
+
+        f = ffmpeg.FFMpeg()
+        spill_path = pjoin(self.temp_dir, 'ffmpeg.log')
+        capture = ffmpeg.OutputCapture(tail_size=1024, spill_path=spill_path)
+        convert_options = ['-vcodec', 'libtheora', '-an', '-t', '2']
+        list(f.convert('test1.ogg', self.video_file_path, convert_options, capture=capture))
+        self.assertEqual(capture.total_size, os.path.getsize(spill_path))
+        self.assertTrue(len(capture.getvalue()) <= 1024)
+
+    def test_ffmpeg_watchdog(self):
+        # the limits must work outside the main thread
+        f = ffmpeg.FFMpeg()
+        p_list = {}
+        f._spawn = lambda *args: p_list.setdefault('', ffmpeg.FFMpeg._spawn(*args))
+        # the realtime filter slows the conversion down to playback speed
+        convert_options = ['-vcodec', 'libtheora', '-vf', 'realtime', '-an']
+        errors = []
+
+        def run():
+            try:
+                list(f.convert('test1.ogg', self.video_file_path, convert_options, deadline=1))
+            except ffmpeg.FFMpegTimeoutError:
+                errors.append(sys.exc_info()[1])
+
+        t = threading.Thread(target=run)
+        t.start()
+        t.join(30)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(1, len(errors))
+        self.assertNotEqual(None, p_list[''].poll())
+
+    def test_ffmpeg_jobs(self):
+        # the resource usage of the processes of a job is added up
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        total = ffmpeg._rusage_sum(ffmpeg._rusage_sum(None, usage), usage)
+        self.assertEqual(2 * usage.ru_utime, total.ru_utime)
+        self.assertEqual(usage.ru_maxrss, total.ru_maxrss)
+
+        f = ffmpeg.FFMpeg()
+        job = f.convert('test1.ogg', self.video_file_path, ['-vcodec', 'libtheora', '-an', '-t', '2'])
+        self.assertEqual(None, job.pid)
+        self.assertTrue(list(job))
+        self.assertEqual(0, job.returncode)
+        self.assertTrue(job.rusage.ru_utime > 0)
+        self.assertTrue(job.elapsed > 0)
+        self.assertEqual([], f.jobs)
+
+        # several jobs on the same object, one of them stopped
+        slow = f.convert('test1.ogg', pjoin(self.temp_dir, 'slow.ogg'), ['-vcodec', 'libtheora', '-vf', 'realtime', '-an'])
+        fast = f.convert('test1.ogg', self.video_file_path, ['-vcodec', 'libtheora', '-an', '-t', '2'])
+        next(slow)
+        next(fast)
+        self.assertEqual([slow, fast], f.jobs)
+        slow.stop()
+        self.assertTrue(list(fast))
+        self.assertEqual(0, fast.returncode)
+        list(slow)  # stopped gracefully: the output is finished properly
+        self.assertEqual(0, slow.returncode)
+        self.assertEqual([], f.jobs)
+
+        job = f.convert('test1.ogg', self.video_file_path, ['-vcodec', 'libtheora', '-vf', 'realtime', '-an'])
+        next(job)
+        f.stop()
+        self.assertRaisesSpecific(ffmpeg.FFMpegConvertError, list, job)
+        self.assertFalse(job.running)
+
+        jobs = [f.convert('test1.ogg', pjoin(self.temp_dir, 'stop%d.ogg' % i),
+                          ['-vcodec', 'libtheora', '-vf', 'realtime', '-an']) for i in range(2)]
+        for job in jobs:
+            next(job)
+        f.stop_all()
+        for job in jobs:
+            self.assertRaisesSpecific(ffmpeg.FFMpegConvertError, list, job)
+        self.assertEqual([], f.jobs)
+
+        c = Converter()
+        conv = c.convert('test1.ogg', self.video_file_path, {
+            'format': 'ogg',
+            'video': {'codec': 'theora', 'bitrate': 128, 'width': 160, 'height': 120},
+            'audio': {'codec': 'vorbis', 'channels': 1, 'bitrate': 32}
+        }, twopass=True)
+        self.assertTrue(verify_progress(conv))
+        self.assertEqual(2, len(conv.processes))
+        self.assertEqual([], c.ffmpeg.jobs)
+
+    def test_job_runner(self):
+        if runner.ThreadPoolExecutor is None:
+            self.skipTest('concurrent.futures is not available')
+
+        # results of jobs that never ran can be printed
+        result = runner.JobResult('convert', 'test1.ogg', self.video_file_path, 0)
+        self.assertEqual(None, result.run_time)
+        self.assertEqual(None, result.wait_time)
+        self.assertTrue(repr(result).endswith('returncode=None, run_time=None)'))
+        result.started, result.finished = 1.0, 3.5
+        self.assertTrue(repr(result).endswith('run_time=2.50)'))
+
+        options = {
+            'format': 'ogg', 'duration': 2,
+            'video': {'codec': 'theora', 'width': 160, 'height': 120},
+            'audio': {'codec': 'vorbis', 'channels': 1, 'bitrate': 32}
+        }
+        progress = {}
+        with runner.JobRunner(max_workers=2) as r:
+            futures = [r.submit_convert('test1.ogg', pjoin(self.temp_dir, '%d.ogg' % i), options,
+                                        progress_callback=lambda f, p: progress.setdefault(f, []).append(p))
+                       for i in range(3)]
+            failed = r.submit_convert('nonexistent', self.video_file_path, options)
+            analysis = r.submit_analyze('test1.ogg', audio_level=False, crop=True, duration=2)
+
+            for i, future in enumerate(futures):
+                result = future.result(60)
+                self.assertEqual(pjoin(self.temp_dir, '%d.ogg' % i), result.outfile)
+                self.assertEqual(0, result.returncode)
+                self.assertTrue(result.run_time > 0)
+                self.assertTrue(verify_progress(progress[future]))
+                self.assertTrue(os.path.exists(result.outfile))
+            self.assertRaisesSpecific(ConverterError, failed.result, 60)
+            self.assertEqual(3, len(analysis.result(60).value))
+
+    def test_async_api(self):
+        # only the methods that don't block the event loop are left usable
+        for cls, base, error, usable in (
+                (aio.AsyncFFMpeg, ffmpeg.FFMpeg, ffmpeg.FFMpegError,
+                 ['convert', 'is_sink', 'is_stream', 'is_url', 'probe']),
+                (aio.AsyncConverter, Converter, ConverterError, ['convert', 'parse_options', 'preset', 'probe'])):
+            obj = cls.__new__(cls)
+            names = [name for name, value in vars(base).items()
+                     if not name.startswith('_') and (callable(getattr(base, name)) or isinstance(value, property))]
+            for name in names:
+                try:
+                    value = getattr(obj, name)
+                    if callable(value):
+                        value()
+                except error:
+                    continue
+                except Exception:
+                    pass
+                self.assertTrue(name in usable, '%s.%s is not disabled' % (cls.__name__, name))
+            self.assertTrue(set(usable) <= set(names))
+
+    def test_async_converter(self):
+        if aio.asyncio is None:
+            self.skipTest('asyncio (or trollius) is not available')
+
+        loop = aio.asyncio.new_event_loop()
+        aio.asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+
+        @aio.asyncio.coroutine
+        def collect(it):
+            # the end of the iteration doesn't end the coroutine
+            items = []
+            while True:
+                try:
+                    item = yield aio.asyncio.From(it.__anext__())
+                except aio.StopAsyncIteration:
+                    break
+                items.append(item)
+            raise aio.asyncio.Return(items)
+
+        def consume(it):
+            return loop.run_until_complete(collect(it))
+
+        c = aio.AsyncConverter()
+        infos = loop.run_until_complete(aio.asyncio.gather(c.probe('test1.ogg'), c.probe('test1.ogg'), loop=loop))
+        self.assertEqual('theora', infos[0]['video']['codec'])
+        self.assertEqual(None, loop.run_until_complete(c.probe('nonexistent')))
+
+        conv = c.convert('test1.ogg', self.video_file_path, {
+            'format': 'ogg',
+            'video': {'codec': 'theora', 'fps': 15},
+            'audio': {'codec': 'vorbis', 'channels': 1, 'bitrate': 32}
+        }, progress=True)
+        self.assertTrue(verify_progress(consume(conv)))
+
+        self.assertRaisesSpecific(ffmpeg.FFMpegConvertError, consume,
+                                  c.ffmpeg.convert('/etc/passwd', self.video_file_path, []))
+
     def test_ffmpeg_termination(self):
         # test when ffmpeg is killed
         f = ffmpeg.FFMpeg()
@@ -296,21 +937,247 @@ class TestFFMpeg(unittest.TestCase):
 
         self.assertTrue(verify_progress(conv))
 
+    def test_converter_multi(self):
+        c = Converter()
+
+        graph, optlists = c._multi_output_graph(
+            ffmpeg.MediaInfo({'format': {}, 'streams': [
+                {'index': 0, 'codec_type': 'video'}, {'index': 1, 'codec_type': 'audio'}]}),
+            [['-an', '-vcodec', 'libtheora', '-vf', 'yadif,scale=320:-2', '-sn', '-f', 'ogg'],
+             ['-acodec', 'libvorbis', '-vcodec', 'libtheora', '-vf', 'yadif,scale=640:-2', '-sn', '-f', 'ogg'],
+             ['-acodec', 'libvorbis', '-vn', '-sn', '-f', 'ogg']])
+        self.assertEqual('[0:0]yadif,split=2[s0][s1];[s0]scale=320:-2[v0];[s1]scale=640:-2[v1]', graph)
+        self.assertEqual([['-map', '[v0]', '-an', '-vcodec', 'libtheora', '-sn', '-f', 'ogg'],
+                          ['-map', '[v1]', '-map', '0:1', '-acodec', 'libvorbis', '-vcodec', 'libtheora',
+                           '-sn', '-f', 'ogg'],
+                          ['-map', '0:1', '-acodec', 'libvorbis', '-vn', '-sn', '-f', 'ogg']], optlists)
+
+        small = pjoin(self.temp_dir, 'small.ogg')
+        conv = c.convert_multi('test1.ogg', [
+            (small, {'format': 'ogg', 'video': {'codec': 'theora', 'width': 160, 'height': 120}}),
+            (self.video_file_path, {'format': 'ogg', 'audio': {'codec': 'vorbis'},
+                                    'video': {'codec': 'theora', 'width': 320, 'height': 240}})])
+        percents = list(conv)
+        self.assertTrue(percents)
+        self.assertTrue(verify_progress(p[small] for p in percents))
+        self.assertEqual(160, c.probe(small).video.video_width)
+        self.assertEqual(320, c.probe(self.video_file_path).video.video_width)
+
+        self.assertRaisesSpecific(ConverterError, list, c.convert_multi('test1.ogg', []))
+        self.assertRaisesSpecific(ConverterError, list, c.convert_multi('test1.ogg', [
+            (small, {'format': 'ogg', 'map': 0, 'video': {'codec': 'theora'}})]))
+
+    def test_converter_chunks(self):
+        self.assertEqual([(0, 4.0), (4.0, 2.0), (6.0, 4.0)],
+                         chunks.split_ranges([0.0, 2.0, 4.0, 6.0, 8.0], 0, 10.0, 3))
+        self.assertEqual([(3, 7)], chunks.split_ranges([0.0], 3, 10, 4))
+
+        # at most workers jobs run at once, and a failure keeps its traceback
+        class Job(object):
+            def __init__(self, target):
+                self.target = target
+
+            def __iter__(self):
+                return self.target()
+
+            def terminate(self):
+                pass
+
+        running = []
+        peak = []
+
+        def sleeper():
+            running.append(None)
+            peak.append(len(running))
+            threading.Event().wait(0.05)
+            running.pop()
+            yield 1
+
+        events = list(chunks.run_jobs([lambda: Job(sleeper)] * 8, 2))
+        self.assertEqual(8, len([event for event in events if event[0] == 'done']))
+        self.assertEqual(2, max(peak))
+
+        def failing():
+            raise ValueError('chunk failed')
+            yield
+
+        try:
+            list(chunks.run_jobs([lambda: Job(failing)], 1))
+        except ValueError:
+            self.assertEqual('failing', traceback.extract_tb(sys.exc_info()[2])[-1][2])
+        else:
+            self.fail('ValueError not raised')
+
+        c = Converter()
+        keyframes = c.ffmpeg.keyframes('test1.ogg')
+        self.assertEqual(0.0, keyframes[0])
+        self.assertEqual(sorted(keyframes), keyframes)
+
+        conv = c.convert('test1.ogg', self.video_file_path, {
+            'format': 'ogg',
+            'video': {'codec': 'theora', 'width': 160, 'height': 120},
+            'audio': {'codec': 'vorbis', 'channels': 1}
+        }, chunks=3)
+        self.assertTrue(verify_progress(conv))
+
+        conv = c.convert('test1.ogg', self.video_file_path, {
+            'format': 'ogg', 'video': {'codec': 'theora'}, 'start': 10, 'duration': 10}, chunks=2)
+        self.assertEqual(100, list(conv)[-1])
+        # the chunks are removed once joined
+        self.assertEqual(['output.ogg'], os.listdir(self.temp_dir))
+
+        info = c.probe(self.video_file_path)
+        self.assertAlmostEqual(10, info.format.duration, places=0)
+
+        # a source without audio has no audio part, even if the options have audio
+        options = {'format': 'ogg', 'video': {'codec': 'theora', 'width': 160, 'height': 120},
+                   'audio': {'codec': 'vorbis', 'channels': 1}}
+        video_only = pjoin(self.temp_dir, 'video.ogg')
+        list(c.ffmpeg.convert('test1.ogg', video_only, ['-an', '-vcodec', 'copy']))
+        info = c.probe(video_only)
+        self.assertEqual(None, info.audio)
+        parts = c._chunk_options(video_only, c._source_options(info, options)[0], info, 10, 2)
+        self.assertFalse([opts for opts, chunk_duration in parts if chunk_duration is None])
+
+        conv = c.convert(video_only, self.video_file_path, options, chunks=2)
+        self.assertEqual(100, list(conv)[-1])
+        self.assertEqual([], conv.subjobs)
+        info = c.probe(self.video_file_path)
+        self.assertEqual(None, info.audio)
+        self.assertEqual(160, info.video.video_width)
+
+        self.assertRaisesSpecific(ConverterError, list, c.convert('test1.ogg', self.video_file_path, {
+            'format': 'ogg', 'video': {'codec': 'theora'}}, twopass=True, chunks=2))
+        self.assertRaisesSpecific(ConverterError, list, c.convert('test1.ogg', self.video_file_path, {
+            'format': 'ogg', 'video': {'codec': 'theora'}}, chunks=2, chunk_workers=0))
+
+        conv = c.convert('test1.ogg', self.video_file_path, {
+            'format': 'ogg', 'video': {'codec': 'theora'}, 'duration': 4}, chunks=3, chunk_workers=1)
+        self.assertEqual(100, list(conv)[-1])
+
+    def test_distributed(self):
+        queue_dir = pjoin(self.temp_dir, 'queue')
+        coordinator = distributed.Coordinator(queue_dir, poll_interval=0.1)
+
+        worker = distributed.Worker(queue_dir, lease_timeout=60)
+        lease = pjoin(self.temp_dir, 'lease')
+        held = worker._acquire(lease)
+        self.assertEqual(lease + '.0', held)
+        self.assertEqual(None, worker._acquire(lease))
+        self.assertTrue(worker._heartbeat(held, 12.5))
+        self.assertEqual(12.5, distributed.Worker._lease_progress(lease))
+
+        # an expired lease is taken over by creating its next generation,
+        # and the worker that held it leaves it alone
+        other = distributed.Worker(queue_dir, lease_timeout=60)
+        os.utime(held, (0, 0))
+        taken = other._acquire(lease)
+        self.assertEqual(lease + '.1', taken)
+        self.assertFalse(worker._heartbeat(held, 20))
+        worker._release(held)
+        self.assertEqual(0, distributed.Worker._lease_progress(lease))
+        self.assertEqual(None, worker._acquire(lease))
+        other._release(taken)
+        self.assertEqual(lease + '.2', worker._acquire(lease))
+
+        parts = [({'format': 'ogg'}, 10.0)]
+        title_dir = coordinator._submit('test1.ogg', parts, 0)
+        self.assertRaisesSpecific(ConverterError, list, coordinator._wait(title_dir, parts, 10.0, 0.2))
+        shutil.rmtree(title_dir)
+
+        workers = [multiprocessing.Process(target=run_worker, args=(queue_dir,)) for _ in range(3)]
+        for p in workers:
+            p.start()
+        try:
+            conv = coordinator.convert('test1.ogg', self.video_file_path, {
+                'format': 'ogg',
+                'video': {'codec': 'theora', 'width': 160, 'height': 120},
+                'audio': {'codec': 'vorbis', 'channels': 1}
+            }, chunks=4)
+            self.assertTrue(verify_progress(conv))
+        finally:
+            for p in workers:
+                p.terminate()
+                p.join()
+
+        self.assertEqual([], os.listdir(queue_dir))
+        info = Converter().probe(self.video_file_path)
+        self.assertEqual(160, info.video.video_width)
+        self.assertAlmostEqual(33, info.format.duration, places=0)
+
+    def test_converter_smart_copy(self):
+        c = Converter()
+        info = ffmpeg.MediaInfo({'format': {'duration': '10'}, 'streams': [
+            {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'width': 1280, 'height': 720,
+             'avg_frame_rate': '25/1', 'bit_rate': '2000000', 'pix_fmt': 'yuv420p', 'profile': 'High', 'level': 31},
+            {'index': 1, 'codec_type': 'audio', 'codec_name': 'aac', 'channels': 2, 'sample_rate': '48000',
+             'bit_rate': '128000'}]})
+        options = {'format': 'mp4',
+                   'video': {'codec': 'h264', 'max_width': 1920, 'max_height': 1080, 'bitrate': 3,
+                             'profile': 'high', 'level': '4.0'},
+                   'audio': {'codec': 'aac', 'channels': 2, 'bitrate': 160}}
+        self.assertEqual(({'format': 'mp4', 'video': {'codec': 'copy'}, 'audio': {'codec': 'copy'}},
+                          ['video', 'audio']), c._smart_copy(info, options))
+
+        self.assertFalse(avcodecs.H264Codec().can_copy(dict(options['video'], max_width=640), info.video))
+        self.assertFalse(avcodecs.H264Codec().can_copy(dict(options['video'], profile='baseline'), info.video))
+        self.assertFalse(avcodecs.AacCodec().can_copy(dict(options['audio'], channels=1), info.audio))
+        self.assertFalse(avcodecs.VorbisCodec().can_copy({'codec': 'vorbis'}, info.audio))
+        self.assertEqual(['audio'], c._smart_copy(info, dict(options, start=3))[1])
+
+        conv = c.convert('test1.ogg', self.video_file_path, {
+            'format': 'ogg',
+            'video': {'codec': 'theora', 'max_width': 1280},
+            'audio': {'codec': 'vorbis', 'channels': 2}
+        }, smart_copy=True)
+        self.assertTrue(verify_progress(conv))
+        self.assertEqual(['video', 'audio'], conv.copied)
+
+    def test_preset(self):
+        c = Converter()
+        options = {'format': 'ogg', 'start': 5, 'duration': 10,
+                   'video': {'codec': 'theora', 'max_width': 320, 'max_height': 240, 'fps': 15},
+                   'audio': {'codec': 'vorbis', 'channels': 1}}
+        preset = c.preset(options)
+        self.assertEqual(options, preset)
+        self.assertRaisesSpecific(TypeError, preset.__setitem__, 'format', 'mkv')
+        self.assertRaisesSpecific(ConverterError, c.preset, {'format': 'ogg', 'video': {'codec': 'bogus'}})
+
+        info = c.probe('test1.ogg')
+        bound, _ = c._source_options(info, preset)
+        plain, _ = c._source_options(info, options)
+        self.assertTrue(isinstance(bound, Preset))
+        for twopass in (None, 1, 2):
+            self.assertEqual(c.parse_options(plain, twopass, '/tmp/job'), c.parse_options(bound, twopass, '/tmp/job'))
+
+        path = pjoin(self.temp_dir, 'preset.json')
+        preset.save(path)
+        self.assertEqual(preset, Preset.load(path, c))
+
+        conv = c.convert('test1.ogg', self.video_file_path, preset)
+        self.assertTrue(verify_progress(conv))
+
     def test_converter_2pass(self):
         c = Converter()
-        self.video_file_path = 'xx.ogg'
         options = {
             'format': 'ogg',
             'audio': {'codec': 'vorbis', 'samplerate': 11025, 'channels': 1, 'bitrate': 16},
             'video': {'codec': 'theora', 'bitrate': 128, 'width': 360, 'height': 200, 'fps': 15}
         }
         options_repr = repr(options)
+        optlist = c.parse_options(options, 1, '/tmp/job')
+        self.assertEqual('-an', optlist[0])
+        self.assertEqual(['-sn', '-f', 'null', '-pass', '1', '-passlogfile', '/tmp/job'], optlist[-7:])
+
+        before = set(os.listdir('.'))
         conv = c.convert('test1.ogg', self.video_file_path, options, twopass=True)
 
         verify_progress(conv)
 
         # Convert should not change options dict
         self.assertEqual(options_repr, repr(options))
+        # The pass statistics are kept out of the working directory
+        self.assertEqual(set(), set(os.listdir('.')) - before)
 
         self._assert_converted_video_file()
 